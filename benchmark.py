@@ -0,0 +1,351 @@
+from os import (
+    makedirs,
+    rename,
+    walk
+)
+from os.path import (
+    join,
+    getsize
+)
+from random import (
+    Random
+)
+from tempfile import (
+    TemporaryDirectory
+)
+from time import (
+    time,
+    sleep
+)
+from queue import (
+    Empty,
+    Queue
+)
+from json import (
+    dump
+)
+from argparse import (
+    ArgumentParser
+)
+from statistics import (
+    median
+)
+
+from savemon import (
+    STORAGES,
+    BackUpThread,
+    CommitThread,
+    tracer
+)
+
+# actions of `MonitorThread`
+CREATED, DELETED, UPDATED, RENAMED_FROM, RENAMED_TO = range(1, 6)
+
+
+def dir_size(path):
+    return sum(
+        getsize(join(d, n)) for d, _, names in walk(path) for n in names
+    )
+
+
+# Workload generator
+####################
+
+def make_content(rnd, size, compressible):
+    if not compressible:
+        return rnd.getrandbits(size << 3).to_bytes(size, "little")
+
+    # looks like a JSON/XML save: structured text with random values
+    lines = []
+    total = 0
+    while total < size:
+        line = '{"id": %u, "hp": %u, "pos": [%u, %u], "flags": "%x"},\n' % (
+            len(lines), rnd.randrange(1000), rnd.randrange(1 << 16),
+            rnd.randrange(1 << 16), rnd.getrandbits(32)
+        )
+        lines.append(line)
+        total += len(line)
+    return "".join(lines).encode("ascii")[:size]
+
+
+def patch_content(rnd, data, changeSize):
+    # a game usually rewrites few records in place, sometimes inserts
+    data = bytearray(data)
+    part = max(1, changeSize // 4)
+    for _ in range(4):
+        offset = rnd.randrange(len(data))
+        data[offset:offset + part] = rnd.getrandbits(part << 3).to_bytes(
+            part, "little"
+        )
+    offset = rnd.randrange(len(data))
+    data[offset:offset] = b"\0" * 64
+    return bytes(data)
+
+
+class SaveTree(object):
+    "Synthetic save directory and its write patterns."
+
+    def __init__(self, root, seed = 0, compressible = True):
+        self.root = root
+        self.rnd = Random(seed)
+        self.compressible = compressible
+        # events as `MonitorThread` reports them
+        self.events = Queue()
+        self.content = {}
+
+    def write(self, relN, data):
+        created = relN not in self.content
+        with open(join(self.root, relN), "wb") as f:
+            f.write(data)
+        self.content[relN] = data
+        self.events.put((CREATED if created else UPDATED, relN))
+
+    def generate(self, files, size, depth = 0, prefix = ""):
+        # `files` of `size` bytes, spread over `depth` nested directories
+        dirs = [prefix]
+        for d in range(depth):
+            dirs.append(join(dirs[-1], "dir%u" % d))
+        for d in dirs:
+            makedirs(join(self.root, d), exist_ok = True)
+
+        names = []
+        for i in range(files):
+            relN = join(dirs[i % len(dirs)], "file%u.sav" % i)
+            self.write(relN, make_content(self.rnd, size, self.compressible))
+            names.append(relN)
+        return names
+
+    # write patterns
+
+    def rewrite(self, names, changeSize):
+        for relN in names:
+            self.write(relN,
+                patch_content(self.rnd, self.content[relN], changeSize)
+            )
+
+    def autosave(self, relN, count, interval, changeSize):
+        for i in range(count):
+            if i:
+                sleep(interval)
+            self.rewrite([relN], changeSize)
+
+    def rename_dir(self, old, new):
+        rename(join(self.root, old), join(self.root, new))
+        for relN in list(self.content):
+            if relN.startswith(old + "/") or relN.startswith(old + "\\"):
+                self.content[new + relN[len(old):]] = self.content.pop(relN)
+        self.events.put((RENAMED_FROM, old))
+        self.events.put((RENAMED_TO, new))
+
+
+# Measurement
+#############
+
+class BenchCommitThread(CommitThread):
+
+    def __init__(self, *a, **kw):
+        super(BenchCommitThread, self).__init__(*a, **kw)
+        # (start, end, files)
+        self.commits = Queue()
+
+    def _do_commit(self):
+        files = len(self.doCommit)
+        t0 = time()
+        super(BenchCommitThread, self)._do_commit()
+        if files:
+            self.commits.put((t0, time(), files))
+
+
+class BenchBackUpThread(BackUpThread):
+    committerClass = BenchCommitThread
+
+
+class Bench(object):
+
+    def __init__(self, storage, tmp, args):
+        self.storageName = storage
+        self.args = args
+        self.saveDir = join(tmp, storage + ".save")
+        self.backupDir = join(tmp, storage + ".backup")
+        makedirs(self.saveDir)
+        makedirs(self.backupDir)
+        self.tree = SaveTree(self.saveDir,
+            compressible = not args.incompressible
+        )
+        self.results = []
+        self.thread = None
+
+    def result(self, workload, metric, value, unit):
+        self.results.append(dict(
+            storage = self.storageName,
+            workload = workload,
+            metric = metric,
+            value = value,
+            unit = unit,
+        ))
+
+    def start(self):
+        bt = BenchBackUpThread(self.saveDir, self.backupDir,
+            self.tree.events,
+            storage = STORAGES[self.storageName](self.backupDir)
+        )
+        bt.delay = self.args.delay
+        t0 = time()
+        bt.start()
+        bt.scanned.wait()
+        self.thread = bt
+        return time() - t0
+
+    def stop(self):
+        bt = self.thread
+        bt.exit_request = True
+        bt.join()
+        self.thread = None
+
+    def drain_commits(self):
+        commits = []
+        while True:
+            try:
+                commits.append(self.thread.committer.commits.get_nowait())
+            except Empty:
+                return commits
+
+    def replay(self, workload, rounds, write):
+        latencies = []
+        commitTime = 0.
+        files = 0
+        for _ in range(rounds):
+            self.drain_commits()
+            write()
+            lastWrite = time()
+            start, end, n = self.thread.committer.commits.get(
+                timeout = self.args.delay + 60.
+            )
+            latencies.append(end - lastWrite)
+            commitTime += end - start
+            files += n
+
+        self.result(workload, "latency.median", median(latencies), "s")
+        self.result(workload, "latency.max", max(latencies), "s")
+        self.result(workload, "commit.throughput",
+            files / commitTime if commitTime else 0., "files/s"
+        )
+
+    def run(self):
+        args = self.args
+        tree = self.tree
+
+        big = tree.generate(1, args.big << 20, prefix = "big")
+        tiny = tree.generate(args.files, args.tiny, args.depth,
+            prefix = "tiny"
+        )
+        auto = tree.generate(1, 64 << 10, prefix = "auto")
+        tree.generate(max(1, args.files // 10), 4 << 10, prefix = "slot")
+        # existing content is backed up by start up scan
+        while not tree.events.empty():
+            tree.events.get()
+
+        self.result("startup", "scan.cold", self.start(), "s")
+        self.stop()
+        self.result("startup", "scan.warm", self.start(), "s")
+
+        change = args.change << 10
+        self.replay("big", args.rounds,
+            lambda : tree.rewrite(big, change)
+        )
+        self.replay("tiny", args.rounds,
+            lambda : tree.rewrite(tiny[::10], 64)
+        )
+        self.replay("autosave", args.rounds,
+            lambda : tree.autosave(auto[0], 10, args.delay / 4., 256)
+        )
+        names = ["slot", "slot.old"]
+        self.replay("rename", args.rounds,
+            lambda : tree.rename_dir(*names) or names.reverse()
+        )
+        self.stop()
+
+        self.result("all", "disk", dir_size(self.backupDir), "B")
+
+        storage = STORAGES[self.storageName](self.backupDir)
+        storage.open()
+        try:
+            latest = first = storage.current()
+            while first.parents:
+                first = first.parents[0]
+
+            t0 = time()
+            storage.checkout(first, self.saveDir)
+            self.result("restore", "checkout.first", time() - t0, "s")
+
+            t0 = time()
+            storage.checkout(latest, self.saveDir)
+            self.result("restore", "checkout.latest", time() - t0, "s")
+        finally:
+            storage.close()
+
+        for relN, data in tree.content.items():
+            with open(join(self.saveDir, relN), "rb") as f:
+                assert f.read() == data, relN
+
+        return self.results
+
+
+def main():
+    ap = ArgumentParser(
+        description = "Measures savemon pipeline on synthetic save"
+            " directories: change to commit latency, commit throughput,"
+            " startup scan and restore times."
+    )
+    ap.add_argument("-b", "--big", type = int, default = 32,
+        help = "big save file size, MiB"
+    )
+    ap.add_argument("-c", "--change", type = int, default = 4,
+        help = "size of changes of big save, KiB"
+    )
+    ap.add_argument("-f", "--files", type = int, default = 500,
+        help = "number of tiny files"
+    )
+    ap.add_argument("-t", "--tiny", type = int, default = 256,
+        help = "tiny file size, bytes"
+    )
+    ap.add_argument("-d", "--depth", type = int, default = 3,
+        help = "nesting depth of tiny files"
+    )
+    ap.add_argument("-r", "--rounds", type = int, default = 5)
+    ap.add_argument("--delay", type = float, default = 0.5,
+        help = "seconds without changes before backing up"
+    )
+    ap.add_argument("--incompressible", action = "store_true")
+    ap.add_argument("-o", "--output",
+        help = "write results to that file as a JSON list"
+    )
+    ap.add_argument("--trace",
+        help = "write timings of pipeline stages to that file in Chrome"
+            " trace event format"
+    )
+    ap.add_argument("storages", nargs = "*", default = list(STORAGES))
+    args = ap.parse_args()
+
+    tracer.enabled = bool(args.trace)
+
+    results = []
+    with TemporaryDirectory() as tmp:
+        for name in args.storages:
+            results.extend(Bench(name, tmp, args).run())
+
+    if args.output:
+        with open(args.output, "w") as f:
+            dump(results, f, indent = 1)
+
+    if args.trace:
+        tracer.save(args.trace)
+
+    for r in results:
+        print("%-8s %-10s %-20s %14.4f %s" % (
+            r["storage"], r["workload"], r["metric"], r["value"], r["unit"]
+        ))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,32 +2,76 @@ from os import (
     makedirs
 )
 from os.path import (
+    abspath,
+    normcase,
+    realpath,
+    getmtime,
     dirname,
     exists,
     join,
     expanduser,
     isdir,
-    isfile
+    isfile,
+    getsize,
+    normpath,
+    splitdrive
 )
 from shutil import (
-    copyfile,
+    copyfileobj,
     move
 )
 from os import (
+    environ,
+    rmdir,
+    readlink,
+    getpid,
+    altsep,
     sep,
     mkdir,
     listdir,
-    remove
+    walk,
+    remove,
+    replace,
+    fsync,
+    fstat,
+    stat
 )
 from pprint import (
     PrettyPrinter
 )
+from collections import (
+    OrderedDict,
+    deque
+)
+from itertools import (
+    count
+)
+from atexit import (
+    register as atexit_register
+)
+from contextlib import (
+    contextmanager,
+    nullcontext
+)
+from ctypes import (
+    CDLL
+)
+from platform import (
+    machine
+)
 from threading import (
+    current_thread,
+    get_ident,
+    get_native_id,
+    local,
+    Condition,
+    Event,
     Lock,
     Thread
 )
 from queue import (
     Empty,
+    Full,
     Queue
 )
 from traceback import (
@@ -35,19 +79,85 @@ from traceback import (
     format_exc
 )
 from time import (
+    perf_counter,
     time,
     sleep
 )
 from re import (
-    compile
+    compile,
+    escape
 )
 import sys
 from subprocess import (
+    PIPE,
     Popen
 )
 from datetime import (
     datetime
 )
+from hashlib import (
+    sha1
+)
+from json import (
+    dump,
+    dumps,
+    loads
+)
+from struct import (
+    Struct
+)
+from bisect import (
+    bisect_left,
+    bisect_right
+)
+from io import (
+    BytesIO
+)
+from difflib import (
+    unified_diff
+)
+from tarfile import (
+    BLOCKSIZE,
+    PAX_FORMAT,
+    RECORDSIZE,
+    TarInfo,
+    open as tar_open
+)
+from gzip import (
+    open as gzip_open
+)
+from bz2 import (
+    open as bz2_open
+)
+from lzma import (
+    open as lzma_open
+)
+from tempfile import (
+    TemporaryDirectory
+)
+from heapq import (
+    heappop,
+    heappush
+)
+from http.server import (
+    BaseHTTPRequestHandler,
+    ThreadingHTTPServer
+)
+from socketserver import (
+    StreamRequestHandler,
+    ThreadingTCPServer
+)
+from socket import (
+    create_connection,
+    socket
+)
+from argparse import (
+    ArgumentParser
+)
+from zlib import (
+    compress as zlib_compress,
+    decompress as zlib_decompress
+)
 
 
 try:
@@ -97,6 +207,12 @@ try:
         Menu,
         ID_ABOUT,
         CheckBox,
+        Choice,
+        Timer,
+        EVT_TIMER,
+        TE_MULTILINE,
+        TE_READONLY,
+        HSCROLL,
         EVT_CHECKBOX,
         EVT_MENU
     )
@@ -110,14 +226,65 @@ except ImportError:
 
 try:
     from git import (
+        Actor,
+        Blob,
+        Head,
         Repo,
         InvalidGitRepositoryError
     )
+    from git.index.typ import (
+        BaseIndexEntry,
+        IndexEntry
+    )
 except ImportError:
     print_exc()
     print("try python -m pip install --upgrade gitpython")
     exit(-1)
 
+try:
+    from zstandard import (
+        ZstdCompressor,
+        ZstdDecompressor
+    )
+except ImportError:
+    # optional, zlib is used instead
+    ZstdCompressor = ZstdDecompressor = None
+
+try:
+    from os import (
+        setpriority,
+        PRIO_PROCESS
+    )
+except ImportError:
+    # Windows
+    setpriority = None
+
+try:
+    from fcntl import (
+        LOCK_EX,
+        LOCK_UN,
+        lockf
+    )
+except ImportError:
+    # Windows
+    lockf = None
+    from msvcrt import (
+        LK_LOCK,
+        LK_UNLCK,
+        locking
+    )
+
+try:
+    from socket import (
+        AF_UNIX
+    )
+    from socketserver import (
+        ThreadingUnixStreamServer
+    )
+except ImportError:
+    # Windows, TCP on localhost is used instead
+    AF_UNIX = ThreadingUnixStreamServer = None
+
 # Windows
 #########
 try:
@@ -131,12 +298,22 @@ try:
         CloseHandle
     )
     from win32con import (
+        GENERIC_READ,
         FILE_NOTIFY_CHANGE_FILE_NAME,
         FILE_NOTIFY_CHANGE_DIR_NAME,
         FILE_NOTIFY_CHANGE_SIZE,
         FILE_NOTIFY_CHANGE_LAST_WRITE,
         FILE_FLAG_BACKUP_SEMANTICS
     )
+    from win32api import (
+        GetCurrentThread
+    )
+    from win32process import (
+        SetThreadPriority
+    )
+    from pywintypes import (
+        error as pywin_error
+    )
 except ImportError:
     print_exc()
     print("try python -m pip install --upgrade pywin32")
@@ -151,9 +328,122 @@ ACTIONS = {
   5 : "Renamed to something"
 }
 
+# not from Windows: content of the directory must be checked completely
+RESCAN = 0
+
+ERROR_SHARING_VIOLATION = 32
+THREAD_MODE_BACKGROUND_BEGIN = 0x00010000
+
 def open_directory_in_explorer(path):
     Popen('explorer "%s"' % path)
 
+
+# Yields (pid, fd, path) of files opened by processes, as far as /proc
+# permits. It must exist.
+def iter_opened_files():
+    for pid in listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        fds = join("/proc", pid, "fd")
+        try:
+            for fd in listdir(fds):
+                yield pid, fd, readlink(join(fds, fd))
+        except OSError:
+            # not permitted, the process is finished or the file is closed
+            continue
+
+
+# Returns whether a process has `path` opened, `None` if it's unknown.
+def file_in_use(path):
+    if sys.platform == "win32":
+        # exclusive access is denied while another handle is opened
+        try:
+            h = CreateFile(path, GENERIC_READ, 0, None, OPEN_EXISTING, 0,
+                None
+            )
+        except pywin_error as e:
+            if e.winerror == ERROR_SHARING_VIOLATION:
+                return True
+            return None
+        CloseHandle(h)
+        return False
+
+    if isdir("/proc"):
+        path = realpath(path)
+        return any(p == path for _, _, p in iter_opened_files())
+
+    return None
+
+
+# ioprio_set syscall numbers
+SYS_IOPRIO_SET = {
+    "x86_64" : 251,
+    "i386" : 289,
+    "i686" : 289,
+    "aarch64" : 30,
+    "armv7l" : 314,
+}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+
+# Makes CPU and I/O priority of current thread low. Returns `False` if it's
+# not supported.
+def lower_thread_priority():
+    if sys.platform == "win32":
+        try:
+            SetThreadPriority(GetCurrentThread(), THREAD_MODE_BACKGROUND_BEGIN)
+        except pywin_error:
+            return False
+        return True
+
+    if setpriority is None or not sys.platform.startswith("linux"):
+        return False
+
+    # a thread is a process for those Linux APIs
+    tid = get_native_id()
+    try:
+        setpriority(PRIO_PROCESS, tid, 19)
+    except OSError:
+        return False
+
+    nr = SYS_IOPRIO_SET.get(machine())
+    if nr is None:
+        return False
+    libc = CDLL(None, use_errno = True)
+    return libc.syscall(nr, IOPRIO_WHO_PROCESS, tid,
+        IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT
+    ) == 0
+
+
+O_ACCMODE = 0o3
+
+# Returns set of `paths` opened for writing by a process, `None` if it's
+# unknown.
+def files_being_written(paths):
+    if sys.platform == "win32" or not isdir("/proc"):
+        return None
+
+    real = dict((realpath(p), p) for p in paths)
+    ret = set()
+    for pid, fd, path in iter_opened_files():
+        path = real.get(path)
+        if path is None or path in ret:
+            continue
+        try:
+            with open(join("/proc", pid, "fdinfo", fd), "r") as f:
+                for l in f:
+                    if l.startswith("flags:"):
+                        # O_WRONLY or O_RDWR
+                        if int(l.split()[1], 8) & O_ACCMODE:
+                            ret.add(path)
+                        break
+        except OSError:
+            # the file is closed meanwhile
+            continue
+    return ret
+
+
 # Generic
 #########
 
@@ -174,30 +464,655 @@ class NullStream(object):
 
     write = lambda *_: None
     flush = lambda *_: None
+    close = lambda *_: None
 
 nullStream = NullStream()
 
-logLock = Lock()
-globalLogStream = nullStream
 
+class LruCache(object):
+    """Values are `bytes` (or have other `len`), the least recently used are
+evicted when total length is over `capacity`."""
+
+    def __init__(self, capacity = 64 << 20):
+        self.capacity = capacity
+        self.size = 0
+        self.items = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            try:
+                value = self.items[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self.items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            items = self.items
+            prev = items.pop(key, None)
+            if prev is not None:
+                self.size -= len(prev)
+            items[key] = value
+            self.size += len(value)
+            while self.size > self.capacity:
+                _, evicted = items.popitem(last = False)
+                self.size -= len(evicted)
+
+
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+LEVELS = dict(
+    DEBUG = DEBUG,
+    INFO = INFO,
+    WARNING = WARNING,
+    ERROR = ERROR,
+)
+
+
+class RotatingFile(object):
+    "Log file which is moved to `path.1` (`path.2`, ...) when it's too big."
+
+    def __init__(self, path, maxSize = 10 << 20, backups = 3):
+        self.path = path
+        self.maxSize = maxSize
+        self.backups = backups
+        self._open()
+
+    def _open(self):
+        self.f = open(self.path, "a+")
+        self.size = self.f.tell()
+
+    def _rotate(self):
+        self.f.close()
+        path = self.path
+        for i in range(self.backups - 1, 0, -1):
+            if exists("%s.%u" % (path, i)):
+                replace("%s.%u" % (path, i), "%s.%u" % (path, i + 1))
+        if self.backups:
+            replace(path, path + ".1")
+        else:
+            remove(path)
+        self._open()
+
+    def write(self, text):
+        if self.size + len(text) > self.maxSize and self.size:
+            self._rotate()
+        self.f.write(text)
+        self.size += len(text)
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+class LogPipeline(Thread):
+    """Log records are put to a bounded ring buffer and written to console
+and log file by this thread. The oldest records are dropped on overflow.
+Records which cannot be written are counted and reported to `stderr`."""
+
+    def __init__(self, capacity = 1 << 14):
+        super(LogPipeline, self).__init__(name = "Log Writer", daemon = True)
+        self.level = INFO
+        self.capacity = capacity
+        # (console stream, text)
+        self.records = deque(maxlen = capacity)
+        self.dropped = 0
+        # write errors since last report, the last one
+        self.failed = 0
+        self.error = None
+        self.file = nullStream
+        self._wake = Event()
+        self._writeLock = Lock()
+
+    def put(self, level, stream, text):
+        if level < self.level:
+            return
+        records = self.records
+        if len(records) == self.capacity:
+            # the oldest is dropped by `append`
+            self.dropped += 1
+        records.append((stream, text))
+        if not self._wake.is_set():
+            self._wake.set()
+
+    def run(self):
+        while True:
+            self._wake.wait(0.5)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        records = self.records
+        with self._writeLock:
+            f = self.file
+            streams = set()
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                records.appendleft((sys.__stderr__,
+                    "[%u log records are dropped]\n" % dropped
+                ))
+            while records:
+                stream, text = records.popleft()
+                if stream is not None:
+                    self._write(stream.write, text)
+                    streams.add(stream)
+                self._write(f.write, text)
+            for stream in streams:
+                self._write(stream.flush)
+            self._write(f.flush)
+            if self.failed:
+                text = "[%u log records are not written: %r]\n" % (
+                    self.failed, self.error
+                )
+                # failures of the report are not reported again
+                for stream in (sys.__stderr__, f):
+                    if stream is not None:
+                        self._write(stream.write, text)
+                        self._write(stream.flush)
+                self.failed = 0
+
+    # A failure, e.g. `UnicodeEncodeError` of console, does not stop
+    # writing of other records.
+    def _write(self, method, *args):
+        try:
+            method(*args)
+        except Exception as e:
+            self.failed += 1
+            self.error = e
+
+    def set_file(self, f):
+        self.flush()
+        with self._writeLock:
+            self.file = f or nullStream
+
+
+logPipeline = LogPipeline()
+logPipeline.start()
+atexit_register(logPipeline.flush)
+
+
+def log(level, fmt, *args):
+    if level < logPipeline.level:
+        return
+    if args:
+        fmt = fmt % args
+    logPipeline.put(level,
+        sys.__stderr__ if level >= WARNING else sys.__stdout__,
+        fmt + "\n"
+    )
+
+def debug(fmt, *args):
+    log(DEBUG, fmt, *args)
+
+
+class LogStream(object):
+    "Redirects writes to `logPipeline`."
+
+    def __init__(self, level, stream):
+        self.level = level
+        self.stream = stream
+
+    def write(self, text):
+        logPipeline.put(self.level, self.stream, text)
+
+    def flush(self):
+        logPipeline._wake.set()
+
+sys.stderr = LogStream(ERROR, sys.stderr)
+sys.stdout = LogStream(INFO, sys.stdout)
+
+
+# Metrics
+#########
+
+class Histogram(object):
+
+    # upper bounds, seconds
+    buckets = (.001, .005, .01, .05, .1, .5, 1., 5., 10., 30., 60.)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricTimer(object):
+
+    def __init__(self, metrics, name, root):
+        self.metrics = metrics
+        self.name = name
+        self.root = root
+
+    def __enter__(self):
+        self.start = time()
+        return self
+
+    def __exit__(self, *_):
+        self.metrics.observe(self.name, self.root, time() - self.start)
+
+
+class Metrics(object):
+    "Registry of counters, gauges and histograms per monitored root."
+
+    def __init__(self):
+        self.lock = Lock()
+        # name -> "counter" | "gauge" | "histogram"
+        self.types = {}
+        # (name, root) -> number or `Histogram`
+        self.values = {}
+        # (name, root) -> getter, evaluated on export
+        self.getters = {}
+
+    def inc(self, name, root, value = 1):
+        key = (name, root)
+        with self.lock:
+            self.types[name] = "counter"
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, root, value):
+        with self.lock:
+            self.types[name] = "gauge"
+            self.values[(name, root)] = value
+
+    def observe(self, name, root, value):
+        key = (name, root)
+        with self.lock:
+            self.types[name] = "histogram"
+            try:
+                h = self.values[key]
+            except KeyError:
+                h = self.values[key] = Histogram()
+            h.observe(value)
+
+    def timer(self, name, root):
+        return MetricTimer(self, name, root)
+
+    def watch(self, name, root, getter, kind = "gauge"):
+        with self.lock:
+            self.types[name] = kind
+            self.getters[(name, root)] = getter
+
+    def unwatch(self, root):
+        # last values are kept
+        with self.lock:
+            for key in list(self.getters):
+                if key[1] == root:
+                    self.values[key] = self.getters.pop(key)()
+
+    def prometheus(self):
+        with self.lock:
+            values = dict(self.values)
+            for key, getter in self.getters.items():
+                values[key] = getter()
+            types = dict(self.types)
+
+        byName = {}
+        for (name, root), v in values.items():
+            byName.setdefault(name, []).append((root, v))
+
+        lines = []
+        for name in sorted(byName):
+            kind = types[name]
+            lines.append("# TYPE %s %s" % (name, kind))
+            for root, v in sorted(byName[name], key = lambda rv : rv[0]):
+                label = 'root="%s"' % prometheus_escape(root)
+                if kind != "histogram":
+                    lines.append("%s{%s} %s" % (name, label, v))
+                    continue
+                total = 0
+                for le, n in zip(v.buckets + ("+Inf",), v.counts):
+                    total += n
+                    lines.append('%s_bucket{%s,le="%s"} %u' % (
+                        name, label, le, total
+                    ))
+                lines.append("%s_sum{%s} %s" % (name, label, v.sum))
+                lines.append("%s_count{%s} %u" % (name, label, v.count))
+        lines.append("")
+        return "\n".join(lines)
+
+
+def prometheus_escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace(
+        "\n", "\\n"
+    )
+
+
+metrics = Metrics()
+
+
+class MetricsFileWriter(Thread):
+    "Writes metrics in Prometheus text format to a file periodically."
+
+    def __init__(self, path, period = 10.0):
+        super(MetricsFileWriter, self).__init__(name = "Metrics Writer",
+            daemon = True
+        )
+        self.path = path
+        self.period = period
+
+    def run(self):
+        path = self.path
+        while True:
+            try:
+                with open(path + ".tmp", "w") as f:
+                    f.write(metrics.prometheus())
+                replace(path + ".tmp", path)
+            except:
+                print_exc()
+                print("Cannot write metrics to %s" % path)
+                return
+            sleep(self.period)
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = metrics.prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *_):
+        pass
+
+
+def serve_metrics(port, host = "127.0.0.1"):
+    server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    Thread(
+        name = "Metrics Server",
+        target = server.serve_forever,
+        daemon = True
+    ).start()
+    print("Metrics are served at http://%s:%u/metrics" % (host, port))
+    return server
+
+
+# Tracing
+#########
+
+class NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        pass
+
+nullSpan = NullSpan()
 
-def cloneStream(stream):
 
-    class StreamClone(object):
+class Span(object):
 
-        def write(self, *a, **kw):
-            with logLock:
-                globalLogStream.write(*a, **kw)
-                stream.write(*a, **kw)
+    __slots__ = ("tracer", "name", "args", "start")
 
-        def flush(self):
-            globalLogStream.flush()
-            stream.flush()
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *_):
+        self.tracer.complete(self.name, self.start, perf_counter(),
+            **self.args
+        )
+
+
+class Tracer(object):
+    """Records spans of pipeline stages in Chrome trace event format
+(chrome://tracing, https://ui.perfetto.dev). Spans are tagged with
+identifier of change batch being processed by current thread."""
+
+    def __init__(self, capacity = 1 << 18):
+        self.enabled = False
+        self.events = deque(maxlen = capacity)
+        self.threads = {}
+        self.local = local()
+        self.pid = getpid()
+        self._batches = count(1)
+        # root -> batch collecting its changes, see `open_batch`
+        self._opened = {}
+        self._openedLock = Lock()
+
+    def new_batch(self):
+        return next(self._batches)
+
+    # Returns the batch collecting changes of `root`, it's begun by the
+    # first thread delivering them (`MonitorThread` or `BackUpThread`).
+    def open_batch(self, root):
+        with self._openedLock:
+            batch = self._opened.get(root)
+            if batch is None:
+                batch = self._opened[root] = self.new_batch()
+                self.begin_batch(batch, perf_counter(), root = root)
+            return batch
+
+    # Following changes of `root` are collected by a new batch.
+    def close_batch(self, root):
+        with self._openedLock:
+            self._opened.pop(root, None)
+
+    @property
+    def batch(self):
+        return getattr(self.local, "batch", None)
+
+    @batch.setter
+    def batch(self, batch):
+        self.local.batch = batch
+
+    # Use: `with tracer.span("name", arg = value):`.
+    def span(self, name, **args):
+        if not self.enabled:
+            return nullSpan
+        return Span(self, name, args)
+
+    def _event(self, ph, name, ts, args, **extra):
+        tid = get_ident()
+        if tid not in self.threads:
+            self.threads[tid] = current_thread().name
+        batch = getattr(self.local, "batch", None)
+        if batch is not None:
+            args["batch"] = batch
+        e = dict(
+            name = name,
+            ph = ph,
+            ts = ts * 1e6,
+            pid = self.pid,
+            tid = tid,
+            args = args,
+        )
+        e.update(extra)
+        self.events.append(e)
+
+    # `start` and `end` are `perf_counter` values.
+    def complete(self, name, start, end, **args):
+        if self.enabled:
+            self._event("X", name, start, args, dur = (end - start) * 1e6)
+
+    # Asynchronous (cross-thread) span of a change batch.
+    def begin_batch(self, batch, ts, **args):
+        if self.enabled:
+            self._event("b", "batch", ts, args, cat = "batch", id = batch)
+
+    def end_batch(self, batch, ts, **args):
+        if self.enabled:
+            self._event("e", "batch", ts, args, cat = "batch", id = batch)
+
+    def save(self, path):
+        events = [
+            dict(
+                name = "thread_name",
+                ph = "M",
+                pid = self.pid,
+                tid = tid,
+                args = dict(name = name),
+            ) for tid, name in list(self.threads.items())
+        ]
+        events.extend(list(self.events))
+        with open(path + ".tmp", "w") as f:
+            dump(dict(traceEvents = events, displayTimeUnit = "ms"), f)
+        replace(path + ".tmp", path)
+        print("Trace is saved to %s" % path)
+
+
+tracer = Tracer()
+
+
+# Scheduling
+############
+
+class TokenBucket(object):
+    "Limits rate of a resource usage, e.g. bytes per second."
+
+    def __init__(self, rate = None, burst = None):
+        # `None` means no limit
+        self.rate = rate
+        # amount available at once, `rate` per second by default
+        self.burst = burst
+        self.tokens = 0.
+        self.last = perf_counter()
+        self._lock = Lock()
+
+    # Takes `n` tokens and returns the time to wait for them. A caller can
+    # go into debt, following callers will wait for it to be paid.
+    def take(self, n):
+        rate = self.rate
+        if not rate:
+            return 0.
+        with self._lock:
+            t = perf_counter()
+            burst = self.burst or rate
+            self.tokens = tokens = min(burst,
+                self.tokens + (t - self.last) * rate
+            ) - n
+            self.last = t
+        if tokens >= 0:
+            return 0.
+        return -tokens / rate
+
+
+class Pacer(object):
+    """Adapts pauses between I/O blocks to their latency. When a block takes
+`factor` times more than usually, the disk is likely busy with something
+more important and the pause is doubled. Otherwise, it's halved."""
+
+    factor = 2.0
+    minPause = 0.01
+    maxPause = 0.5
+    # smaller blocks are dominated by overhead
+    minBlock = 64 << 10
+
+    def __init__(self):
+        # seconds per MiB
+        self.usual = None
+        self.pause = 0.
+
+    # Returns pause to make after I/O of `n` bytes took `elapsed` seconds.
+    def observe(self, elapsed, n):
+        if n < self.minBlock:
+            return self.pause
+
+        latency = elapsed * (1 << 20) / n
+        usual = self.usual
+        if usual is None or latency < usual:
+            self.usual = usual = latency
+        else:
+            # follows slowly, so a long slow down is still detected
+            self.usual = usual + (latency - usual) * 0.01
+
+        if latency > usual * self.factor:
+            self.pause = min(self.maxPause, max(self.minPause, self.pause * 2))
+        else:
+            self.pause /= 2
+            if self.pause < self.minPause:
+                self.pause = 0.
+        return self.pause
+
+
+class FairScheduler(object):
+    """Limits number of concurrently working threads by `slots`. Waiting
+threads get slots in round-robin order of their roots. So, a root with a
+lot of work does not delay others."""
+
+    def __init__(self, slots = 2):
+        self.slots = slots
+        self.busy = 0
+        # root -> number of waiting threads, in order of turns
+        self.waiting = OrderedDict()
+        self._changed = Condition()
+        # `root` of the slot held by current thread
+        self._held = local()
+
+    def acquire(self, root):
+        waiting = self.waiting
+        with self._changed:
+            waiting[root] = waiting.get(root, 0) + 1
+            while self.busy >= self.slots or next(iter(waiting)) != root:
+                self._changed.wait()
+            self.busy += 1
+            # other threads of the root wait for next turn
+            n = waiting.pop(root) - 1
+            if n:
+                waiting[root] = n
+            self._changed.notify_all()
+
+    def release(self):
+        with self._changed:
+            self.busy -= 1
+            self._changed.notify_all()
+
+    @contextmanager
+    def slot(self, root):
+        t0 = time()
+        with tracer.span("wait slot"):
+            self.acquire(root)
+        metrics.observe("savemon_slot_wait_seconds", root, time() - t0)
+        held = self._held
+        outer = getattr(held, "root", None)
+        held.root = root
+        try:
+            yield
+        finally:
+            held.root = outer
+            self.release()
+
+    # Sleeps `delay` seconds. Other threads can use the slot of current
+    # thread meanwhile, it waits for its turn again after.
+    def pause(self, delay):
+        root = getattr(self._held, "root", None)
+        if root is None:
+            sleep(delay)
+            return
+        self.release()
+        try:
+            with tracer.span("throttle"):
+                sleep(delay)
+        finally:
+            self.acquire(root)
 
-    return StreamClone()
 
-sys.stderr = cloneStream(sys.stderr)
-sys.stdout = cloneStream(sys.stdout)
+# shared by all roots, see `Settings`
+scheduler = FairScheduler()
+ioLimiter = TokenBucket()
 
 
 # Domain specific
@@ -206,6 +1121,143 @@ sys.stdout = cloneStream(sys.stdout)
 re_system_name = compile("^.git$")
 
 
+# Translates a gitignore-style glob to Python's re syntax.
+def glob_to_re(glob):
+    ret = []
+    i, n = 0, len(glob)
+    while i < n:
+        c = glob[i]
+        i += 1
+        if c == "*":
+            if glob.startswith("*/", i):
+                # "**/", any number of directories
+                ret.append("(?:.*/)?")
+                i += 2
+            elif glob.startswith("*", i):
+                ret.append(".*")
+                i += 1
+            else:
+                ret.append("[^/]*")
+        elif c == "?":
+            ret.append("[^/]")
+        elif c == "[":
+            j = glob.find("]", i + 1)
+            if j < 0:
+                ret.append("\\[")
+            else:
+                chars = glob[i:j]
+                if chars.startswith("!"):
+                    chars = "^" + chars[1:]
+                ret.append("[" + chars + "]")
+                i = j + 1
+        elif c == "\\" and i < n:
+            ret.append(escape(glob[i]))
+            i += 1
+        else:
+            ret.append(escape(c))
+    return "".join(ret)
+
+
+class PathFilter(object):
+    """Filters out paths relative to a save directory by gitignore-style
+patterns and/or a regular expression. Content of a filtered out directory is
+filtered out too, so it's neither scanned nor reported by `MonitorThread`.
+"""
+
+    # decisions about that many directories are cached
+    cacheSize = 4096
+
+    def __init__(self, patterns = (), regex = None):
+        self.regex = regex
+
+        # Last matching pattern wins. So, patterns are grouped in runs of
+        # same sign and runs are checked in reverse order. A run is
+        # (ignore, names, paths, re, dirNames, dirPaths, dirRe). `names` are
+        # literal base names, `paths` are literal anchored paths, `re` is
+        # compiled from all other patterns of the run. `dir*` are for
+        # patterns matching directories only.
+        runs = []
+        for pattern in patterns:
+            pattern = pattern.strip()
+            if not pattern or pattern.startswith("#"):
+                continue
+            ignore = not pattern.startswith("!")
+            if not ignore:
+                pattern = pattern[1:]
+            dirOnly = pattern.endswith("/")
+            pattern = pattern.rstrip("/")
+            anchored = "/" in pattern
+            pattern = pattern.lstrip("/")
+            if not pattern:
+                continue
+
+            if not runs or runs[-1][0] != ignore:
+                runs.append((ignore, [set(), set(), []], [set(), set(), []]))
+            names, paths, res = runs[-1][2 if dirOnly else 1]
+
+            if not any(c in pattern for c in "*?[\\"):
+                (paths if anchored else names).add(pattern)
+            elif anchored:
+                res.append(glob_to_re(pattern))
+            else:
+                res.append("(?:.*/)?" + glob_to_re(pattern))
+
+        self.runs = [
+            (ignore,) + tuple(
+                (names, paths, compile("(?:%s)\\Z" % ")|(?:".join(res))
+                    if res else None
+                ) for names, paths, res in (anyKind, dirKind)
+            )
+            for ignore, anyKind, dirKind in reversed(runs)
+        ]
+        self._dirs = {}
+
+    @classmethod
+    def parse(cls, text, regex = None):
+        "`text` contains patterns separated by `;` or new lines."
+        return cls(text.replace(";", "\n").split("\n"), regex)
+
+    def __bool__(self):
+        return bool(self.runs or self.regex)
+
+    def _match(self, path, isDir):
+        name = path.rpartition("/")[2]
+        for ignore, (names, paths, r), (dirNames, dirPaths, dirR) in self.runs:
+            if name in names or path in paths or r and r.match(path):
+                return ignore
+            if name in dirNames or path in dirPaths or \
+                dirR and dirR.match(path):
+                if callable(isDir):
+                    isDir = isDir()
+                if isDir:
+                    return ignore
+        regex = self.regex
+        return bool(regex and regex.match(path.replace("/", sep)))
+
+    def _dir_ignored(self, d):
+        dirs = self._dirs
+        try:
+            return dirs[d]
+        except KeyError:
+            pass
+        parent = d.rpartition("/")[0]
+        ret = bool(parent) and self._dir_ignored(parent) or \
+            self._match(d, True)
+        if len(dirs) >= self.cacheSize:
+            dirs.clear()
+        dirs[d] = ret
+        return ret
+
+    # `isDir` is either a `bool` or a callable returning it. It's only
+    # called if needed.
+    def ignored(self, relN, isDir = False):
+        path = relN.replace(sep, "/")
+        parent = path.rpartition("/")[0]
+        if parent and self._dir_ignored(parent):
+            return True
+        return self._match(path, isDir)
+
+
 class Settings(object):
 
     def __init__(self):
@@ -214,6 +1266,30 @@ class Settings(object):
         self.hidden = set()
         self.logging = False
         self.logFile = expanduser(join("~", "savemon.log"))
+        # DEBUG, INFO, WARNING or ERROR
+        self.logLevel = "INFO"
+        self.logMaxSize = 10 << 20
+        self.logBackups = 3
+        # Prometheus text format file and/or HTTP port on localhost
+        self.metricsFile = None
+        self.metricsPort = None
+        self.tracing = False
+        self.traceFile = expanduser(join("~", "savemon.trace.json"))
+        # number of roots being checked or committed concurrently
+        self.workers = scheduler.slots
+        # bytes per second read and written by all roots, `None` - no limit
+        self.ioLimit = ioLimiter.rate
+        # bytes per second of each save in "Low impact" mode
+        self.lowImpactRate = BackUpThread.lowImpactRate
+        # see `BackUpThread`
+        self.stableMaxWait = BackUpThread.stableMaxWait
+        self.checkWriters = BackUpThread.checkWriters
+        # directory of objects shared by all backups, `None` - not shared
+        self.sharedStore = Storage.sharedStore
+        # control commands are accepted at Unix socket `controlSocket` or,
+        # if Unix sockets are not supported, at TCP `controlPort` on localhost
+        self.controlSocket = expanduser(join("~", "savemon.sock"))
+        self.controlPort = CONTROL_PORT
 
     def __enter__(self, *_):
         try:
@@ -244,6 +1320,21 @@ class Settings(object):
                 "saves",
                 "hidden",
                 "logging",
+                "logLevel",
+                "logMaxSize",
+                "logBackups",
+                "metricsFile",
+                "metricsPort",
+                "tracing",
+                "traceFile",
+                "stableMaxWait",
+                "checkWriters",
+                "workers",
+                "ioLimit",
+                "lowImpactRate",
+                "controlSocket",
+                "controlPort",
+                "sharedStore",
             ]
         )
         try:
@@ -255,18 +1346,348 @@ class Settings(object):
             move(self.path + ".tmp", self.path)
 
 
+class ChangeQueue(object):
+    """Queue of changed paths with bounded memory. A path is kept once, with
+its last action. When there are more than `capacity` paths, deepest ones
+are replaced with their parent directories to be rescanned (`RESCAN`) until
+less than a half of `capacity` remains. Changes inside a directory waiting
+for rescan are dropped. Interface is a subset of `Queue`'s."""
+
+    def __init__(self, capacity = 10000, root = None):
+        self.capacity = capacity
+        # for metrics
+        self.root = root
+        # relN -> action
+        self.paths = OrderedDict()
+        self.rescans = set()
+        self._changed = Condition()
+
+    # Is `relN` or a directory containing it waiting for rescan?
+    def _in_rescan(self, relN):
+        rescans = self.rescans
+        if not rescans:
+            return False
+        while relN not in rescans:
+            if not relN:
+                return False
+            relN = dirname(relN)
+        return True
+
+    def _collapse(self):
+        paths = self.paths
+        target = self.capacity // 2
+        while len(paths) > target:
+            depth = max(relN.count(sep) + bool(relN) for relN in paths)
+            if not depth:
+                break
+            collapsed = OrderedDict()
+            for relN, action in paths.items():
+                if relN.count(sep) + bool(relN) == depth:
+                    # the parent is rescanned even if it has own change
+                    parent = dirname(relN)
+                    collapsed.pop(parent, None)
+                    collapsed[parent] = RESCAN
+                elif collapsed.get(relN) != RESCAN:
+                    collapsed[relN] = action
+            paths = collapsed
+
+        self.rescans = rescans = set(
+            relN for relN, action in paths.items() if action == RESCAN
+        )
+        self.paths = OrderedDict(
+            (relN, action) for relN, action in paths.items()
+            if not (relN and self._in_rescan(dirname(relN))) and
+                (action == RESCAN or relN not in rescans)
+        )
+        metrics.inc("savemon_change_collapses_total", self.root)
+
+    def put(self, change):
+        action, relN = change
+        with self._changed:
+            if self._in_rescan(relN):
+                return
+            paths = self.paths
+            if relN not in paths:
+                paths[sys.intern(relN)] = action
+                if len(paths) > self.capacity:
+                    self._collapse()
+            elif paths[relN] != RESCAN:
+                paths[relN] = action
+            self._changed.notify()
+
+    def get(self, block = True, timeout = None):
+        with self._changed:
+            if block:
+                self._changed.wait_for(lambda : self.paths, timeout)
+            try:
+                relN, action = self.paths.popitem(last = False)
+            except KeyError:
+                raise Empty
+            if action == RESCAN:
+                self.rescans.discard(relN)
+            return action, relN
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def qsize(self):
+        return len(self.paths)
+
+    __len__ = qsize
+
+    def empty(self):
+        return not self.paths
+
+    def __iter__(self):
+        for relN, action in list(self.paths.items()):
+            yield action, relN
+
+    def clear(self):
+        with self._changed:
+            self.paths.clear()
+            self.rescans.clear()
+
+
+class Journal(object):
+    """Append-only file of changed paths which are not committed yet. Syncing
+is batched, at most once per `syncInterval` unless `maxPending` paths are
+waiting. Time of last sync (the file's modification time) is also recorded
+by the file: a change which is not journaled happened after it (`margin` is
+a delivery delay). Over `maxJournaled` paths are replaced with `RESCAN`
+marker, i.e. everything is to be checked."""
+
+    syncInterval = 0.5
+    maxPending = 1 << 10
+    maxJournaled = 1 << 16
+    margin = 5.0
+
+    def __init__(self, path):
+        # `None` if the storage does not support it, nothing is journaled
+        self.path = path
+        self.f = None
+        self.pending = []
+        # since last `clear`
+        self.journaled = set()
+        self.overflowed = False
+        self.lastSync = 0.
+
+    # Returns paths from the journal, `None` if there were no journal or it
+    # has `RESCAN` marker. Also, returns the time changes are not journaled
+    # since.
+    def replay(self):
+        path = self.path
+        if path is None or not exists(path):
+            return None, None
+        since = getmtime(path) - self.margin
+        ret = []
+        with open(path, "r", encoding = "utf-8") as f:
+            for l in f:
+                try:
+                    relN = loads(l)
+                except ValueError:
+                    # last line is torn by a crash
+                    continue
+                if relN == RESCAN:
+                    return None, None
+                if relN not in self.journaled:
+                    self.journaled.add(relN)
+                    ret.append(relN)
+        return ret, since
+
+    def open(self):
+        if self.path is not None:
+            self.f = open(self.path, "a", encoding = "utf-8")
+            self.f.flush()
+            fsync(self.f.fileno())
+
+    def add(self, relN):
+        journaled = self.journaled
+        if self.overflowed or relN in journaled:
+            return
+        if len(journaled) < self.maxJournaled:
+            journaled.add(relN)
+            self.pending.append(relN)
+        else:
+            self.overflowed = True
+            journaled.clear()
+            self.pending[:] = [RESCAN]
+
+    def sync(self, force = False):
+        f = self.f
+        if f is None:
+            return
+        t = perf_counter()
+        if (not force and t - self.lastSync < self.syncInterval and
+            len(self.pending) < self.maxPending
+        ):
+            return
+        self.lastSync = t
+        pending = self.pending
+        if pending:
+            f.write("".join(dumps(relN) + "\n" for relN in pending))
+            del pending[:]
+        f.flush()
+        fsync(f.fileno())
+
+    # When all journaled changes are committed.
+    def clear(self):
+        f = self.f
+        if f is None or not (self.journaled or self.overflowed):
+            return
+        del self.pending[:]
+        self.journaled.clear()
+        self.overflowed = False
+        f.seek(0)
+        f.truncate()
+        f.flush()
+        fsync(f.fileno())
+
+    def close(self):
+        if self.f is not None:
+            self.sync(force = True)
+            self.f.close()
+            self.f = None
+
+
+class PathIndex(object):
+    """Snapshots changing each path, with id and size of the content. New
+snapshots are appended by `CommitThread`, missing ones (e.g. made before
+the index) are indexed by `update`. An index is shared by all users of its
+file in this process."""
+
+    indexes = {}
+    indexesLock = Lock()
+
+    @classmethod
+    def of(cls, path):
+        key = normcase(realpath(path))
+        with cls.indexesLock:
+            index = cls.indexes.get(key)
+            if index is None:
+                index = cls.indexes[key] = cls(path)
+            return index
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        # "/" separated path -> [(timestamp, hexsha, blob id, size)], blob
+        # id is `None` if the file is removed
+        self.paths = {}
+        # hexsha -> number in order of indexing
+        self.indexed = {}
+        # hexsha -> position in `iter_history` at last `update`, commit
+        # times have one second resolution
+        self.order = {}
+
+        if exists(path):
+            with open(path, "r", encoding = "utf-8") as f:
+                for l in f:
+                    try:
+                        record = loads(l)
+                    except ValueError:
+                        # last line is torn by a crash
+                        continue
+                    self._add(*record)
+
+    def _add(self, timestamp, hexsha, changes):
+        if hexsha in self.indexed:
+            return False
+        self.indexed[hexsha] = len(self.indexed)
+        paths = self.paths
+        for key, blobId, size in changes:
+            paths.setdefault(key, []).append(
+                (timestamp, hexsha, blobId, size)
+            )
+        return True
+
+    # `changes` are (key, blob id, size) of paths changed by `snapshot`
+    # since its first parent.
+    def add(self, snapshot, changes):
+        record = [snapshot.committed_datetime.timestamp(), snapshot.hexsha,
+            [list(c) for c in changes]
+        ]
+        with self.lock:
+            if not self._add(*record):
+                return
+            with open(self.path, "a", encoding = "utf-8") as f:
+                f.write(dumps(record) + "\n")
+
+    # Indexes snapshots of `storage` which are not indexed yet. `check` is
+    # called per snapshot, it may raise to stop.
+    def update(self, storage, check = None):
+        # files of recently diffed snapshots, parents usually follow children
+        files = OrderedDict()
+
+        def files_of(snapshot):
+            try:
+                return files[snapshot.hexsha]
+            except KeyError:
+                ret = files[snapshot.hexsha] = dict(
+                    (key, (blobId, size)) for key, blobId, size in
+                        storage.iter_file_ids(snapshot)
+                )
+                if len(files) > 4:
+                    files.popitem(last = False)
+                return ret
+
+        order = {}
+        for snapshot in storage.iter_history():
+            if check is not None:
+                check()
+            order[snapshot.hexsha] = len(order)
+            if snapshot.hexsha in self.indexed:
+                continue
+            cur = files_of(snapshot)
+            parents = snapshot.parents
+            prev = files_of(parents[0]) if parents else {}
+            changes = [
+                (key, blobId, size) for key, (blobId, size) in cur.items()
+                    if prev.get(key, (None,))[0] != blobId
+            ]
+            changes.extend(
+                (key, None, 0) for key in prev if key not in cur
+            )
+            self.add(snapshot, changes)
+        with self.lock:
+            self.order = order
+
+    # Returns [(timestamp, hexsha, blob id, size)] of snapshots changing
+    # `relN`, the newest first.
+    def history(self, relN):
+        with self.lock:
+            versions = list(self.paths.get(relN.replace(sep, "/"), ()))
+            order = self.order
+            indexed = self.indexed
+
+        # snapshots of same second are ordered as in history, ones indexed
+        # after `update` are newer
+        def rank(version):
+            timestamp, hexsha = version[:2]
+            position = order.get(hexsha)
+            if position is None:
+                return timestamp, 1 + indexed[hexsha]
+            return timestamp, -position
+
+        versions.sort(key = rank, reverse = True)
+        return versions
+
+
 class MonitorThread(Thread):
 
-    def __init__(self, rootPath, onExit):
+    def __init__(self, rootPath, onExit, pathFilter = None):
         super(MonitorThread, self).__init__(name = "Directory Monitor Thread")
         self.rootPath = rootPath
         self.onExit = onExit
+        # Watching is recursive, events in filtered out directories are
+        # dropped here.
+        self.pathFilter = pathFilter
         self._exit_request = False
         self.trigger_file = join(rootPath, ".savemon.trigger")
-        self.changes = Queue()
+        self.changes = ChangeQueue(root = rootPath)
 
     def run(self):
         root = self.rootPath
+        pathFilter = self.pathFilter
         print("Start monitoring of '%s'" % root)
         hDir = CreateFile(root, FILE_LIST_DIRECTORY,
             FILE_SHARE_READ | FILE_SHARE_WRITE,
@@ -284,14 +1705,22 @@ class MonitorThread(Thread):
                 None,
                 None
             )
-            for action, file in changes:
-                changed = join(root, file)
-                if changed == self.trigger_file:
-                    continue
-                self.changes.put((action, file))
-                print(changed,
-                    ACTIONS.get(action, "[unknown 0x%X]" % action)
-                )
+            if tracer.enabled:
+                tracer.batch = tracer.open_batch(root)
+            with tracer.span("deliver", events = len(changes)):
+                for action, file in changes:
+                    changed = join(root, file)
+                    if changed == self.trigger_file:
+                        continue
+                    if pathFilter and pathFilter.ignored(file,
+                        lambda : isdir(changed)
+                    ):
+                        metrics.inc("savemon_ignored_events_total", root)
+                        continue
+                    self.changes.put((action, file))
+                    debug("%s %s", changed,
+                        ACTIONS.get(action, "[unknown 0x%X]" % action)
+                    )
 
         print("Stop monitoring of '%s'" % root)
         CloseHandle(hDir)
@@ -314,117 +1743,421 @@ class MonitorThread(Thread):
         remove(self.trigger_file)
 
 
-class BackUpThread(Thread):
+class CommitThread(Thread):
+    "Commits batches of changes staged by `BackUpThread`."
 
-    def __init__(self, saveDir, backupDir, changesQueue, filterOut = None):
-        super(BackUpThread, self).__init__(name = "Backing Up Thread")
+    # Index lock file of Git is either held by another process or has
+    # been forgotten (there is known bug). Removing a held lock is a very
+    # bad idea. So, commit is retried with exponential backoff and the lock
+    # is only removed when nobody holds it. Batches are accumulated
+    # meanwhile.
+    # Also, user should not work with the repo while monitoring is active.
+    retryMin = 0.5
+    retryMax = 30.0
+    # a lock file, nobody has opened, may be held by existence only during
+    # that time
+    lockGrace = 2.0
+    # when it's unknown whether the lock file is opened
+    lockStaleAge = 60.0
+
+    def __init__(self, saveDir, storage, capacity = 2):
+        super(CommitThread, self).__init__(name = "Committing Thread")
 
         self.saveDir = saveDir
-        self.backupDir = backupDir
-        self.qchanges = changesQueue
-        self.exit_request = False
-        self.filterOut = filterOut
+        self.storage = storage
+        # Staging of next batches is blocked while that many batches are
+        # waiting for commit.
+        self.batches = Queue(maxsize = capacity)
 
+        # changes of all taken batches, in order
         self.doCommit = []
+        # tracing identifiers of taken batches
+        self.traceBatches = []
+        # time of next commit attempt if it's deferred
+        self.retryAt = None
+        self.retryDelay = self.retryMin
+
+        # numbers of batches
+        self.handedOff = 0
+        self.committed = 0
+        self._committed = Condition()
+
+        # run with low priority, see `BackUpThread`
+        self.lowImpact = False
+        # (hexsha, ISO date) of last commit
+        self.lastCommit = None
+        # `PathIndex` of the backup, if supported
+        self.pathIndex = None
+        # see `finish`
+        self.aborted = False
+
+    # Blocks while the queue of batches is full. Returns number of the batch.
+    def put(self, changes, traceBatch = None):
+        saveDir = self.saveDir
+        t0 = time()
+        with tracer.span("hand off"):
+            while True:
+                if not self.is_alive():
+                    raise RuntimeError("Committing of '%s' is failed" %
+                        saveDir
+                    )
+                try:
+                    self.batches.put((changes, traceBatch), timeout = 0.5)
+                except Full:
+                    continue
+                break
+        metrics.observe("savemon_handoff_wait_seconds", saveDir, time() - t0)
+        self.handedOff += 1
+        return self.handedOff
+
+    # Waits for commit of `n` batches.
+    def wait(self, n):
+        with self._committed:
+            while self.committed < n and self.is_alive():
+                self._committed.wait(0.5)
+
+    # Commits remaining batches unless `abort`ed. Committing in progress is
+    # always finished.
+    def finish(self, abort = False):
+        self.aborted = abort
+        while self.is_alive():
+            try:
+                self.batches.put(None, timeout = 0.5)
+            except Full:
+                continue
+            break
+        self.join()
+
+    def run(self):
+        if self.lowImpact:
+            lower_thread_priority()
+
+        batches = self.batches
+        taken = 0
+        exit = False
+
+        metrics.watch("savemon_handoff_depth", self.saveDir, batches.qsize)
+
+        while not exit or self.doCommit:
+            retryAt = self.retryAt
+            if retryAt is None:
+                timeout = None
+            else:
+                timeout = max(0., retryAt - time())
+
+            try:
+                batch = batches.get(timeout = timeout)
+                # coalesce all waiting batches
+                while True:
+                    if batch is None:
+                        exit = True
+                    else:
+                        changes, traceBatch = batch
+                        self.doCommit.extend(changes)
+                        if traceBatch is not None:
+                            self.traceBatches.append(traceBatch)
+                        taken += 1
+                    batch = batches.get_nowait()
+            except Empty:
+                pass
+
+            if exit and self.aborted:
+                if self.doCommit:
+                    print("%u changes are left uncommitted" %
+                        len(self.doCommit)
+                    )
+                break
+
+            if self.commit():
+                with self._committed:
+                    self.committed = taken
+                    self._committed.notify_all()
+
+    def _lock_is_stale(self, lock):
+        inUse = file_in_use(lock)
+        if inUse:
+            return False
+        try:
+            age = time() - getmtime(lock)
+        except OSError:
+            # already removed
+            return False
+        if inUse is None:
+            return age > self.lockStaleAge
+        return age > self.lockGrace
+
+    # Returns `False` if commit is deferred.
+    def commit(self):
+        retryAt = self.retryAt
+        if retryAt is not None and time() < retryAt:
+            return False
 
-    def commit(self, attempts = 5, period = 5):
         try:
             self._do_commit()
         except:
-            print("Checking for index.lock")
-            lock = join(self.backupDir, ".git", "index.lock")
-            # XXX: If lock file exists then another Git process can operate.
-            # And removing of the lock is likely a very bad idea.
-            # However, if it still exists after some time then it likely
-            # has been forgotten (there is known bug).
-            # Also, user should not work with the repo while monitoring is
-            # active.
-            if exists(lock):
-                while attempts > 0:
-                    print("Waiting for %d sec. (%d)" % (period, attempts))
-                    sleep(period)
-                    if not exists(lock):
-                        break
-                    attempts -= 1
-                else:
-                    print("Removing " + lock)
-                    remove(lock)
-
-                self._do_commit()
-            else:
+            lock = self.storage.lock_file()
+            if lock is None or not exists(lock):
                 # some other error
                 raise
 
-    def _do_commit(self):
-        repo, doCommit = self.repo, self.doCommit
+            metrics.inc("savemon_index_lock_total", self.saveDir)
+
+            if self._lock_is_stale(lock):
+                print("Removing " + lock)
+                remove(lock)
+                metrics.inc("savemon_stale_locks_removed_total",
+                    self.saveDir
+                )
+                delay = 0.
+            else:
+                delay = self.retryDelay
+                self.retryDelay = min(delay * 2, self.retryMax)
+                print("%s is held, retrying commit in %.1f sec." % (
+                    lock, delay
+                ))
+            self.retryAt = time() + delay
+            return False
+
+        self.retryAt = None
+        self.retryDelay = self.retryMin
+        return True
+
+    def _do_commit(self):
+        doCommit = self.doCommit
+        traceBatches = self.traceBatches
+        if traceBatches:
+            tracer.batch = traceBatches[-1]
         if doCommit:
             print("Committing changes")
-            for method, node in doCommit:
-                if method == "add":
-                    repo.index.add([node])
-                elif method == "remove":
-                    repo.index.remove([node], working_tree = True)
             message = " ".join(
                 c[1] for c in doCommit[0 : min(5, len(doCommit))]
             )
-            repo.index.commit(message)
+            with scheduler.slot(self.saveDir):
+                with metrics.timer("savemon_commit_seconds", self.saveDir):
+                    with tracer.span("commit", files = len(doCommit)):
+                        snapshot = self.storage.commit(doCommit, message)
+            if snapshot is None:
+                metrics.inc("savemon_empty_commits_skipped_total",
+                    self.saveDir
+                )
+                print("Nothing changed since last commit")
+            else:
+                self.lastCommit = (snapshot.hexsha,
+                    snapshot.committed_datetime.isoformat()
+                )
+                if self.pathIndex is not None:
+                    self.pathIndex.add(snapshot, self.storage.lastChanges)
+                metrics.inc("savemon_commits_total", self.saveDir)
+                metrics.inc("savemon_committed_files_total", self.saveDir,
+                    len(doCommit)
+                )
+                print("Committing finished")
             del doCommit[:]
-            print("Committing finished")
+        if traceBatches:
+            t = perf_counter()
+            for traceBatch in traceBatches:
+                tracer.end_batch(traceBatch, t)
+            del traceBatches[:]
+            tracer.batch = None
+
 
-    def check(self, relN):
+class BackUpThread(Thread):
+    """Checks changed files and stages their content. Staged batches are
+committed by `CommitThread`. So, checking of next batch is overlapped with
+committing of previous one."""
+
+    # seconds without changes before checking, give game a chance to made
+    # save data consistent
+    delay = 5.0
+
+    # A game may write a save in several steps during more than `delay`.
+    # So, changed files are sampled (size & modification time) each
+    # `stableInterval` until the samples stop changing. But a snapshot is
+    # not postponed more than `stableMaxWait` seconds.
+    stableInterval = 1.0
+    stableMaxWait = 60.0
+    # also wait while a process has a changed file opened for writing
+    # (Linux only)
+    checkWriters = False
+
+    # Low impact mode lets a game use the disk while backing up: threads
+    # get idle I/O and lowest CPU priority, I/O of the save is limited by
+    # `lowImpactRate` bytes per second and paced by `Pacer`.
+    lowImpactRate = 16 << 20
+
+    committerClass = CommitThread
+
+    def __init__(self, saveDir, backupDir, changesQueue, filterOut = None,
+        storage = None,
+        lowImpact = False
+    ):
+        super(BackUpThread, self).__init__(name = "Backing Up Thread")
+
+        self.saveDir = saveDir
+        self.backupDir = backupDir
+        self.qchanges = changesQueue
+        self.exit_request = False
+        self.filterOut = filterOut
+        if storage is None:
+            storage = GitStorage(backupDir)
+        self.storage = storage
+
+        # staged changes: ("add", relN, blob) or ("remove", relN, None)
+        self.doCommit = []
+        self.committer = self.committerClass(saveDir, storage)
+        # set when current content of save directory is backed up
+        self.scanned = Event()
+
+        self.lowImpact = lowImpact
+        if lowImpact:
+            storage.limiter = TokenBucket(self.lowImpactRate)
+            storage.pacer = Pacer()
+            self.committer.lowImpact = True
+
+        # changes are accumulated but not checked while paused
+        self.paused = False
+        # events to set when changes are committed
+        self.flushes = deque()
+        # changes to check, they are moved from `qchanges` immediately
+        self.changes = ChangeQueue(root = saveDir)
+
+    # Requests checking and committing of changes immediately. Returned
+    # event is set when they are committed.
+    def request_flush(self):
+        done = Event()
+        self.flushes.append(done)
+        return done
+
+    # Returns `False` on timeout.
+    def flush(self, timeout = None):
+        return self.request_flush().wait(timeout)
+
+    def status(self):
+        committer = self.committer
+        lastCommit = committer.lastCommit
+        return dict(
+            root = self.saveDir,
+            backup = self.backupDir,
+            scanned = self.scanned.is_set(),
+            paused = self.paused,
+            pending = self.qchanges.qsize() + len(self.changes),
+            staged = len(self.doCommit),
+            uncommittedBatches = committer.handedOff - committer.committed,
+            lastCommit = lastCommit and lastCommit[0],
+            lastCommitDate = lastCommit and lastCommit[1],
+        )
+
+    # Passes staged changes to the committer. Returns number of the batch.
+    def hand_off(self, traceBatch = None):
+        doCommit = self.doCommit
+        if not doCommit and traceBatch is None:
+            return self.committer.handedOff
+        self.doCommit = []
+        return self.committer.put(doCommit, traceBatch)
+
+    def sample(self, relN):
+        try:
+            st = stat(join(self.saveDir, relN))
+        except OSError:
+            return None
+        return (st.st_size, st.st_mtime_ns)
+
+    # `samples` are updated. Returns names which are still being written.
+    def unstable(self, relNames, samples):
+        ret = []
+        for relN in relNames:
+            sample = self.sample(relN)
+            if samples.get(relN) != sample:
+                samples[relN] = sample
+                ret.append(relN)
+
+        if self.checkWriters:
+            saveDir = self.saveDir
+            fullNames = [join(saveDir, relN) for relN in relNames]
+            writing = files_being_written(fullNames)
+            if writing:
+                ret.extend(relN for relN, fullN in zip(relNames, fullNames)
+                    if fullN in writing and relN not in ret
+                )
+        return ret
+
+    def ignored(self, relN):
+        if re_system_name.match(relN):
+            return True
+        filterOut = self.filterOut
+        if filterOut and filterOut.ignored(relN,
+            lambda : isdir(join(self.saveDir, relN))
+        ):
+            debug("Ignoring '%s' (Filter Out)", relN)
+            return True
+        return False
+
+    # `check` in a slot of `scheduler`
+    def check_in_slot(self, relN, force = False):
+        with scheduler.slot(self.saveDir):
+            self.check(relN, force)
+
+    @staticmethod
+    def changed_since(fullN, since):
+        try:
+            st = stat(fullN)
+        except OSError:
+            return True
+        # a copied file may keep its modification time
+        return max(st.st_mtime, st.st_ctime) > since
+
+    def rescan(self, relDir):
+        if isdir(join(self.saveDir, relDir)):
+            self.scan(relDir)
+        else:
+            self.check_in_slot(relDir)
+
+    # `force` is for changes which may be staged but not committed.
+    def check(self, relN, force = False):
         fullN = join(self.saveDir, relN)
-        fullBackN = join(self.backupDir, relN)
+        storage = self.storage
 
         if isfile(fullN):
-            if exists(fullBackN):
-                with open(fullN, "rb") as f0:
-                    with open(fullBackN, "rb") as f1:
-                        doChanged = f0.read() != f1.read()
-                if doChanged:
-                    print("Replacing %s with %s" % (fullBackN, fullN))
-                    copyfile(fullN, fullBackN)
-                    self.doCommit.append(("add", relN))
-            else:
-                fullBackNDir = dirname(fullBackN)
-                if not exists(fullBackNDir):
-                    print("Creating directories '%s'" % fullBackNDir)
-                    makedirs(fullBackNDir)
-                print("Copying '%s' to '%s'" % (fullN, fullBackN))
-                copyfile(fullN, fullBackN)
-                self.doCommit.append(("add", relN))
+            blob = storage.stage(relN, fullN, force)
+            if blob is not None:
+                self.doCommit.append(("add", relN, blob))
+        elif storage.has(relN) or force and not isdir(fullN):
+            print("Removing '%s'" % relN)
+            storage.remove(relN)
+            self.doCommit.append(("remove", relN, None))
         else:
-            if isfile(fullBackN):
-                print("Removing '%s'" % fullBackN)
-                self.doCommit.append(("remove", relN))
-
-    def run(self):
-        backupDir = self.backupDir
+            # Changes are not reported for content of a renamed, moved in
+            # or removed directory.
+            self.check_dir(relN)
+
+    def check_dir(self, relDir):
+        fullDir = join(self.saveDir, relDir)
+        if isdir(fullDir):
+            names = set(listdir(fullDir))
+        else:
+            names = set()
+        # Only appeared and disappeared entries. Changed files are reported.
+        for n in names.symmetric_difference(self.storage.listdir(relDir)):
+            relN = join(relDir, n)
+            if not self.ignored(relN):
+                self.check(relN)
+
+    # Only files changed `since` (a time) are checked, if given. Files in
+    # `skip` are not checked.
+    def scan(self, top = "", since = None, skip = ()):
         saveDir = self.saveDir
-        filterOut = self.filterOut
+        storage = self.storage
 
-        try:
-            self.repo = Repo(backupDir)
-        except InvalidGitRepositoryError:
-            print("Initializing Git repository in '%s'" % backupDir)
-            self.repo = Repo.init(backupDir)
-
-        print("Backing up current content of '%s'" % saveDir)
-        stack = [""]
+        stack = [top]
         while stack:
             cur = stack.pop()
             curSave = join(saveDir, cur)
-            curBackup = join(backupDir, cur)
             toCheck = set(listdir(curSave))
-            if isdir(curBackup):
-                toCheck.update(listdir(curBackup))
+            toCheck.update(storage.listdir(cur))
             for n in toCheck:
                 relN = join(cur, n)
 
-                if re_system_name.match(relN):
-                    continue
-
-                if filterOut and filterOut.match(relN):
-                    print("Ignoring '%s' (Filter Out)" % relN)
+                if self.ignored(relN):
                     continue
 
                 fullN = join(saveDir, relN)
@@ -432,163 +2165,2460 @@ class BackUpThread(Thread):
                 if isdir(fullN):
                     # Note, directories are created by `check` if needed
                     stack.append(relN)
-                else:
-                    self.check(relN)
+                elif relN in skip:
+                    continue
+                elif since is None or not storage.has(relN) or \
+                    self.changed_since(fullN, since):
+                    self.check_in_slot(relN)
+
+    def run(self):
+        saveDir = self.saveDir
 
-        self.commit()
+        if self.lowImpact and not lower_thread_priority():
+            print("Cannot lower priority of backing up '%s'" % saveDir)
 
-        changes = set()
+        storage = self.storage
+        storage.open()
 
-        lastChange = time()
+        self.journal = journal = Journal(storage.journal_file())
 
-        # Do not exit until detected changes are committed
-        while not self.exit_request or changes:
+        committer = self.committer
+        pathIndexFile = storage.path_index_file()
+        if pathIndexFile is not None:
+            committer.pathIndex = PathIndex.of(pathIndexFile)
+        cur = storage.current()
+        if cur is not None:
+            committer.lastCommit = (cur.hexsha,
+                cur.committed_datetime.isoformat()
+            )
+        committer.start()
+        try:
+            self._run()
+        finally:
+            # Uncommitted changes are in the journal, no need to wait.
+            journal.close()
+            committer.finish(abort = journal.path is not None)
+            storage.close()
+            # do not let flushing clients wait forever
+            while self.flushes:
+                self.flushes.popleft().set()
+            metrics.unwatch(saveDir)
+            tracer.close_batch(saveDir)
+            print("Stop backing up of '%s'" % saveDir)
+
+    # Checks changes journaled by previous run and files changed since it.
+    # Returns `False` if there is no journal.
+    def replay(self):
+        journaled, since = self.journal.replay()
+        if journaled is None:
+            return False
+
+        print("Checking %u journaled changes of '%s'" % (
+            len(journaled), self.saveDir
+        ))
+        # ensure a directory are always precede its files
+        for relN in sorted(journaled, key = len):
+            if not self.ignored(relN):
+                self.check_in_slot(relN, force = True)
+        self.scan(since = since, skip = set(journaled))
+        return True
+
+    def _run(self):
+        saveDir = self.saveDir
+        storage = self.storage
+
+        changes = self.changes
+
+        metrics.watch("savemon_queue_depth", saveDir, self.qchanges.qsize)
+        metrics.watch("savemon_pending_changes", saveDir, changes.__len__)
+        metrics.watch("savemon_read_bytes_total", saveDir,
+            lambda : storage.bytesRead, "counter"
+        )
+        metrics.watch("savemon_written_bytes_total", saveDir,
+            lambda : storage.bytesWritten, "counter"
+        )
+
+        journal = self.journal
+        committer = self.committer
+
+        scanStart = time()
+        with tracer.span("scan"):
+            if not self.replay():
+                print("Backing up current content of '%s'" % saveDir)
+                self.scan()
+            journal.open()
+            committer.wait(self.hand_off())
+        metrics.set("savemon_scan_seconds", saveDir, time() - scanStart)
+        self.scanned.set()
+
+        # time to check `changes`
+        checkAt = time()
+        # relN -> (size, mtime), last samples of changed files
+        samples = {}
+        # time of first sample of current changes which is not stable
+        waitStart = None
+        # Tracing: current change batch, perf_counter of its first and last
+        # changes.
+        batch = None
+        batchStart = batchLast = None
+        # (batch number, flush event) to set once the batch is committed
+        flushed = deque()
+
+        # Changes are journaled. So, exit is immediate.
+        while not self.exit_request:
             try:
                 change = self.qchanges.get(timeout = 0.1)
             except Empty:
-                # give game a chance to made save data consistent
+                journal.sync()
+                committed = committer.committed
+                if not changes and committed == committer.handedOff:
+                    journal.clear()
+                while flushed and flushed[0][0] <= committed:
+                    flushed.popleft()[1].set()
+
+                # delivered changes are checked immediately when flushing
+                flushing = len(self.flushes)
+
                 t = time()
-                if changes and t - lastChange > 5.0:
+                if changes and (flushing or t > checkAt and not self.paused):
+                    if not flushing:
+                        relNames = list(set(c[1] for c in changes))
+                        unstable = self.unstable(relNames, samples)
+                        if unstable:
+                            if waitStart is None:
+                                waitStart = t
+                            if t - waitStart < self.stableMaxWait:
+                                metrics.inc("savemon_unstable_samples_total",
+                                    saveDir
+                                )
+                                debug("Waiting for writing of\n    %s" %
+                                    "\n    ".join(unstable)
+                                )
+                                checkAt = t + self.stableInterval
+                                continue
+                            print("Files are still being written after"
+                                " %.1f sec., backing up anyway" % (
+                                    t - waitStart
+                                )
+                            )
+                            metrics.inc("savemon_unstable_snapshots_total",
+                                saveDir
+                            )
+                    samples.clear()
+                    waitStart = None
+
                     # ensure a directory are always precede its files
                     toCheck = sorted(changes, key = lambda c : len(c[1]))
 
+                    if batch is not None:
+                        tracer.close_batch(saveDir)
+                        tracer.batch = batch
+                        checkStart = perf_counter()
+                        tracer.complete("collect", batchStart, batchLast,
+                            changes = len(changes)
+                        )
+                        tracer.complete("debounce", batchLast, checkStart)
+
                     print("Checking\n    %s" % "\n    ".join(
                         c[1] for c in toCheck)
                     )
-                    for c in toCheck:
-                        cur = c[1]
-                        self.check(cur)
+                    for action, cur in toCheck:
+                        with metrics.timer("savemon_check_seconds", saveDir):
+                            with tracer.span("check", path = cur):
+                                if action == RESCAN:
+                                    self.rescan(cur)
+                                else:
+                                    self.check_in_slot(cur)
+
+                    changes.clear()
+                    self.hand_off(batch)
+                    tracer.batch = batch = None
+
+                for _ in range(flushing):
+                    flushed.append((committer.handedOff,
+                        self.flushes.popleft()
+                    ))
+                continue
+
+            metrics.inc("savemon_events_total", saveDir)
+            if self.ignored(change[1]):
+                metrics.inc("savemon_ignored_events_total", saveDir)
+                continue
+            if tracer.enabled:
+                batchLast = perf_counter()
+                if batch is None:
+                    batch = tracer.open_batch(saveDir)
+                    batchStart = batchLast
+            changes.put(change)
+            journal.add(change[1])
+            # a storm of events does not delay syncing
+            journal.sync()
+            if len(samples) > changes.capacity:
+                # checking stability of a storm is wasteful
+                samples.clear()
+            samples[change[1]] = self.sample(change[1])
+            checkAt = time() + self.delay
+
+
+def start_backup(root2threads, root, backup,
+    storage = "git",
+    pathFilter = None,
+    lowImpact = False
+):
+    mt = MonitorThread(root, lambda : root2threads.pop(root),
+        pathFilter = pathFilter
+    )
+    bt = BackUpThread(root, backup, mt.changes, pathFilter,
+        storage = STORAGES[storage](backup),
+        lowImpact = lowImpact
+    )
+    root2threads[root] = (mt, bt)
+    mt.start()
+    bt.start()
+    return mt, bt
+
+
+# Starts backing up of a save from `Settings.saves` without GUI.
+def start_save(root2threads, saveDir, backupDir,
+    filterOut = None,
+    storage = None,
+    ignore = None,
+    lowImpact = False
+):
+    if not saveDir or not exists(saveDir):
+        print("No such save directory '%s'" % saveDir)
+        return None
+    if not backupDir:
+        print("No backup directory for '%s'" % saveDir)
+        return None
+    if saveDir in root2threads:
+        return root2threads[saveDir] # already monitored
+
+    makedirs(backupDir, exist_ok = True)
+
+    filterOutRe = None
+    if filterOut:
+        try:
+            filterOutRe = compile(filterOut)
+        except:
+            print_exc()
+            print("Incorrect filter expression of '%s', continuing without"
+                " filter" % saveDir
+            )
+
+    return start_backup(root2threads, saveDir, backupDir,
+        storage = storage or "git",
+        pathFilter = PathFilter.parse(ignore or "", regex = filterOutRe),
+        lowImpact = lowImpact
+    )
+
+
+# Control
+#########
+
+class Controller(object):
+    """Executes commands of control clients. A command is a line
+`name [root]`, without root it's applied to all monitored roots."""
+
+    def __init__(self, root2threads, flushTimeout = 300.):
+        self.root2threads = root2threads
+        self.flushTimeout = flushTimeout
+
+    def execute(self, line):
+        name, _, root = line.strip().partition(" ")
+        command = getattr(self, "do_" + name, None)
+        if command is None:
+            return dict(ok = False, error = "Unknown command '%s'" % name)
+
+        root = root.strip()
+        root2threads = self.root2threads
+        if root:
+            threads = root2threads.get(root) or \
+                root2threads.get(abspath(expanduser(root)))
+            if threads is None:
+                return dict(ok = False, error = "'%s' is not monitored" % root)
+            backups = [threads[1]]
+        else:
+            backups = [threads[1] for threads in list(root2threads.values())]
+
+        return command(backups)
+
+    def do_status(self, backups):
+        return dict(ok = True, roots = [bt.status() for bt in backups])
+
+    def do_flush(self, backups):
+        # roots are flushed concurrently
+        requests = [(bt, bt.request_flush()) for bt in backups]
+        deadline = time() + self.flushTimeout
+        timedOut = [
+            bt.saveDir for bt, done in requests
+                if not done.wait(max(0., deadline - time()))
+        ]
+        if timedOut:
+            return dict(ok = False,
+                error = "Flush timed out",
+                roots = timedOut
+            )
+        return self.do_status(backups)
+
+    def do_pause(self, backups):
+        for bt in backups:
+            bt.paused = True
+        return self.do_status(backups)
+
+    def do_resume(self, backups):
+        for bt in backups:
+            bt.paused = False
+        return self.do_status(backups)
+
+
+class ControlRequestHandler(StreamRequestHandler):
+    "A client may send many commands, a JSON object is replied per line."
+
+    def handle(self):
+        controller = self.server.controller
+        for line in self.rfile:
+            line = line.decode("utf-8").strip()
+            if not line:
+                continue
+            try:
+                reply = controller.execute(line)
+            except Exception as e:
+                print_exc()
+                reply = dict(ok = False, error = str(e))
+            self.wfile.write((dumps(reply) + "\n").encode("utf-8"))
+            self.wfile.flush()
+
+
+# default `Settings.controlPort`
+CONTROL_PORT = None if ThreadingUnixStreamServer is not None else 47913
+
+
+def serve_control(root2threads,
+    path = None,
+    port = None,
+    host = "127.0.0.1"
+):
+    if path and ThreadingUnixStreamServer is not None:
+        if exists(path):
+            try:
+                with socket(AF_UNIX) as s:
+                    s.connect(path)
+            except OSError:
+                # left by a previous run
+                remove(path)
+            else:
+                raise RuntimeError("Another instance listens at " + path)
+        server = ThreadingUnixStreamServer(path, ControlRequestHandler)
+        atexit_register(lambda : exists(path) and remove(path))
+        address = path
+    elif port:
+        server = ThreadingTCPServer((host, port), ControlRequestHandler)
+        address = "%s:%u" % (host, port)
+    else:
+        log(WARNING, "Warning: control commands are not accepted, set"
+            " controlSocket or controlPort"
+        )
+        return None
+
+    server.daemon_threads = True
+    server.controller = Controller(root2threads)
+    Thread(
+        name = "Control Server",
+        target = server.serve_forever,
+        daemon = True
+    ).start()
+    print("Control commands are accepted at " + address)
+    return server
+
+
+# Sends a command to a running instance and returns the reply.
+def send_control(command,
+    path = None,
+    port = None,
+    host = "127.0.0.1"
+):
+    if path and AF_UNIX is not None:
+        s = socket(AF_UNIX)
+        try:
+            s.connect(path)
+        except:
+            s.close()
+            raise
+    elif port:
+        s = create_connection((host, port))
+    else:
+        raise RuntimeError("Neither controlSocket nor controlPort is set")
+    with s, s.makefile("rwb") as f:
+        f.write((command + "\n").encode("utf-8"))
+        f.flush()
+        return loads(f.readline().decode("utf-8"))
+
+
+# Storage
+#########
+
+class Storage(object):
+    "Back-end keeping snapshots of a save directory in `backupDir`."
+
+    # Directory of object store shared by all backups, see `Settings`.
+    # Objects already kept in `backupDir` remain there.
+    sharedStore = None
+
+    def __init__(self, backupDir):
+        self.backupDir = backupDir
+        # by `stage`
+        self.bytesRead = 0
+        self.bytesWritten = 0
+        # low impact mode, see `BackUpThread`
+        self.limiter = None
+        self.pacer = None
+
+    # I/O of `stage` is accounted by blocks of that size
+    ioBlock = 1 << 20
+
+    # Accounts I/O of `stage`, it's limited by `ioLimiter` and `limiter`.
+    # `elapsed` is duration of the I/O for `pacer`. The slot of `scheduler`
+    # is not held during pauses.
+    def account(self, read = 0, written = 0, elapsed = None):
+        self.bytesRead += read
+        self.bytesWritten += written
+        n = read + written
+        delay = ioLimiter.take(n)
+        limiter = self.limiter
+        if limiter is not None:
+            delay = max(delay, limiter.take(n))
+        pacer = self.pacer
+        if pacer is not None and elapsed is not None:
+            delay += pacer.observe(elapsed, n)
+        if delay:
+            scheduler.pause(delay)
+
+    def read_file(self, path):
+        blocks = []
+        with open(path, "rb") as f:
+            while True:
+                t0 = perf_counter()
+                block = f.read(self.ioBlock)
+                if not block:
+                    break
+                self.account(read = len(block), elapsed = perf_counter() - t0)
+                blocks.append(block)
+        return b"".join(blocks)
+
+    def write_file(self, path, data):
+        view = memoryview(data)
+        ioBlock = self.ioBlock
+        with open(path, "wb") as f:
+            for i in range(0, len(view), ioBlock):
+                t0 = perf_counter()
+                n = f.write(view[i:i + ioBlock])
+                self.account(written = n, elapsed = perf_counter() - t0)
+
+    # Nothing is created or changed if `readOnly`, e.g. for reports. Then
+    # there must be a backup already.
+    def open(self, readOnly = False):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    # Names of backed up files and directories in `relDir`.
+    def listdir(self, relDir):
+        raise NotImplementedError
+
+    def has(self, relN):
+        raise NotImplementedError
+
+    # `stage` and `remove` are called by the thread which checks changes,
+    # `commit` is called by another thread concurrently.
+
+    # Stages content of `fullN` as `relN`. Returns a blob for `commit` or
+    # `None` if the content is same as already staged. The blob is always
+    # returned if `force`d, e.g. when staged content may be uncommitted.
+    def stage(self, relN, fullN, force = False):
+        raise NotImplementedError
+
+    def remove(self, relN):
+        raise NotImplementedError
+
+    # `changes` is a list of ("add", relN, blob) and ("remove", relN, None)
+    # in order of staging. Content of a blob must not depend on later
+    # staging. Returns the new snapshot, `None` if nothing is committed
+    # because the content is same as in the current snapshot. Then
+    # `lastChanges` are (key, blob id, size) of actually changed paths, see
+    # `PathIndex`.
+    def commit(self, changes, message):
+        raise NotImplementedError
+
+    # Snapshots with no children, e.g. branch heads.
+    def heads(self):
+        raise NotImplementedError
+
+    # Returns the snapshot backup is continued from, `None` if empty.
+    def current(self):
+        raise NotImplementedError
+
+    def snapshot(self, hexsha):
+        raise NotImplementedError
+
+    # Yields snapshots reachable from `heads`, newer first. A snapshot
+    # precedes its parents unless clock was turned back.
+    def iter_history(self):
+        queue = []
+        seen = set()
+        order = count()
+
+        def push(snapshot):
+            if snapshot.hexsha in seen:
+                return
+            seen.add(snapshot.hexsha)
+            heappush(queue, (-snapshot.committed_datetime.timestamp(),
+                next(order), snapshot
+            ))
+
+        for head in self.heads():
+            push(head)
+        while queue:
+            snapshot = heappop(queue)[2]
+            yield snapshot
+            for parent in snapshot.parents:
+                push(parent)
+
+    def is_dirty(self):
+        return False
+
+    # A file which existence prevents `commit`, if any.
+    def lock_file(self):
+        return None
+
+    # Where `Journal` is kept, if supported.
+    def journal_file(self):
+        return None
+
+    # Where `PathIndex` is kept, if supported.
+    def path_index_file(self):
+        return None
+
+    # Makes `target` current. The current snapshot must remain reachable.
+    def switch(self, target):
+        raise NotImplementedError
+
+    # Returns name for a branch keeping `cur` reachable or `None` if there
+    # is such a branch already.
+    def _backup_name(self, branches, cur):
+        backups = []
+        for name, hexsha in branches:
+            mi = backup_re.match(name)
+            if mi:
+                if hexsha == cur.hexsha:
+                    return None
+                backups.append(int(mi.group(1), base = 10))
+
+        if backups:
+            n = max(backups) + 1
+        else:
+            n = 0
+        return "backup_%u" % n
+
+    # Makes `target` current and replaces files of current snapshot in
+    # `saveDir` with files of `target`.
+    def checkout(self, target, saveDir, progress = None):
+        if self.is_dirty():
+            raise RuntimeError("Backup repository is dirty")
+
+        cur = self.current()
+
+        if cur.hexsha != target.hexsha:
+            self.switch(target)
+
+        self.restore(cur, target, saveDir, progress)
+
+    # Yields (relN, blob) for each file in `snapshot`.
+    def iter_files(self, snapshot):
+        raise NotImplementedError
+
+    def stream_data(self, blob, f):
+        raise NotImplementedError
+
+    # Returns (size, blob) of file `relN` in `snapshot`, `None` if there is
+    # no such file. Equal blobs have equal content.
+    def find_file(self, snapshot, relN):
+        raise NotImplementedError
+
+    # Yields (id, size) of stored objects keeping file content of
+    # `snapshot`, see `dedup_report`.
+    def iter_objects(self, snapshot):
+        raise NotImplementedError
+
+    # Yields ("/" separated path, blob id, size) of files in `snapshot`.
+    def iter_file_ids(self, snapshot):
+        raise NotImplementedError
+
+    # Blob for `stream_data` by id from `iter_file_ids`.
+    def blob_of(self, blobId):
+        return blobId
+
+    # Returns sorted ("/" separated path, old size, new size) of files
+    # differing in `old` and `new` snapshots, size is `None` if there is no
+    # such file. Content is not read.
+    def diff(self, old, new):
+        oldFiles = {} if old is None else dict(
+            (key, (blobId, size))
+                for key, blobId, size in self.iter_file_ids(old)
+        )
+        changes = []
+        for key, blobId, size in self.iter_file_ids(new):
+            prev = oldFiles.pop(key, None)
+            if prev is None:
+                changes.append((key, None, size))
+            elif prev[0] != blobId:
+                changes.append((key, prev[1], size))
+        changes.extend(
+            (key, size, None) for key, (_, size) in oldFiles.items()
+        )
+        changes.sort()
+        return changes
+
+    # `progress(relN)` is called before each file, it may raise to stop.
+    def restore(self, cur, target, saveDir, progress = None):
+        # remove files of current
+        if cur is not None:
+            for relN, _ in self.iter_files(cur):
+                fullN = join(saveDir, relN)
+                if exists(fullN):
+                    remove(fullN)
+
+        # copy files from target
+        for relN, blob in self.iter_files(target):
+            if progress is not None:
+                progress(relN)
+            fullN = join(saveDir, relN)
+            makedirs(dirname(fullN), exist_ok = True)
+            with open(fullN, "wb+") as f:
+                self.stream_data(blob, f)
+
+
+# no console windows for child processes of a GUI application
+CREATE_NO_WINDOW = 0x08000000 if sys.platform == "win32" else 0
+
+
+class GitBatch(object):
+    """Long-lived git process answering a line per request line, e.g.
+`git hash-object --stdin-paths`. It saves process start per request."""
+
+    def __init__(self, workDir, *args, env = None):
+        self.workDir = workDir
+        self.args = ("git",) + args
+        self.env = env
+        self.proc = None
+        self._lock = Lock()
+
+    def request(self, line):
+        with self._lock:
+            proc = self.proc
+            if proc is None or proc.poll() is not None:
+                self.proc = proc = Popen(self.args,
+                    cwd = self.workDir,
+                    env = self.env,
+                    stdin = PIPE,
+                    stdout = PIPE,
+                    creationflags = CREATE_NO_WINDOW
+                )
+            try:
+                proc.stdin.write(line.encode("utf-8") + b"\n")
+                proc.stdin.flush()
+                ret = proc.stdout.readline()
+            except OSError:
+                ret = b""
+            if not ret:
+                proc.kill()
+                raise RuntimeError("'%s' failed on '%s'" % (
+                    " ".join(self.args), line
+                ))
+            return ret.decode("utf-8").strip()
+
+    def close(self):
+        with self._lock:
+            proc = self.proc
+            if proc is not None:
+                self.proc = None
+                proc.stdin.close()
+                proc.wait()
+
+
+class WorkTree(object):
+    """Cleanness of working tree of a Git backup as known by this process.
+It's shared by `GitStorage`s of the backup and saves `git status`."""
+
+    trees = {}
+    treesLock = Lock()
+
+    @classmethod
+    def of(cls, backupDir):
+        key = normcase(realpath(backupDir))
+        with cls.treesLock:
+            tree = cls.trees.get(key)
+            if tree is None:
+                tree = cls.trees[key] = cls()
+            return tree
+
+    def __init__(self):
+        self.lock = Lock()
+        # staged and removed files which are not committed yet
+        self.uncommitted = set()
+        # stat of index when working tree was clean, `None` - unknown
+        self.cleanStamp = None
+
+    def changed(self, relN):
+        with self.lock:
+            self.uncommitted.add(relN)
+
+    def committed(self, relNames, stamp):
+        with self.lock:
+            self.uncommitted.difference_update(relNames)
+            if not self.uncommitted:
+                self.cleanStamp = stamp
+
+    def clean(self, stamp):
+        with self.lock:
+            self.uncommitted.clear()
+            self.cleanStamp = stamp
+
+    # E.g. changes of an aborted run may be left or committed by another
+    # process.
+    def forget(self):
+        with self.lock:
+            self.uncommitted.clear()
+            self.cleanStamp = None
+
+    # Returns `None` if it's unknown, e.g. index was changed by another
+    # process since.
+    def is_dirty(self, stamp):
+        with self.lock:
+            if self.uncommitted:
+                return True
+            if stamp is not None and stamp == self.cleanStamp:
+                return False
+            return None
+
+
+class GitStorage(Storage):
+    "Backup directory is a working tree of a Git repository."
+
+    def __init__(self, backupDir):
+        # paths are sent to Git processes running in `backupDir`
+        super(GitStorage, self).__init__(abspath(backupDir))
+
+    def open(self, readOnly = False):
+        backupDir = self.backupDir
+        try:
+            self.repo = Repo(backupDir)
+        except InvalidGitRepositoryError:
+            if readOnly:
+                raise
+            print("Initializing Git repository in '%s'" % backupDir)
+            self.repo = Repo.init(backupDir)
+
+        if not readOnly:
+            # `git status` tells what is left by previous users
+            self.workTree.forget()
+
+        # environment of object writing processes
+        self.objectsEnv = None
+        if self.sharedStore and not readOnly:
+            self._share_objects(abspath(join(self.sharedStore, "git")))
+
+    # Objects of the repository are also looked up in `shared` repository
+    # and blobs and commits are written there.
+    def _share_objects(self, shared):
+        if not exists(shared):
+            print("Initializing shared Git repository in '%s'" % shared)
+            sharedRepo = Repo.init(shared, bare = True)
+            # it has no references, objects must not be pruned
+            with sharedRepo.config_writer() as cw:
+                cw.set_value("gc", "auto", "0")
+                cw.set_value("gc", "pruneExpire", "never")
+            sharedRepo.close()
+
+        sharedObjects = join(shared, "objects")
+        objects = join(self.backupDir, ".git", "objects")
+        alternates = join(objects, "info", "alternates")
+        try:
+            with open(alternates, "r") as f:
+                paths = [l.strip() for l in f]
+        except FileNotFoundError:
+            paths = []
+        if sharedObjects not in paths:
+            print("Sharing '%s' with other backups" % shared)
+            makedirs(dirname(alternates), exist_ok = True)
+            with open(alternates, "a") as f:
+                f.write(sharedObjects + "\n")
+
+        self.objectsEnv = dict(environ,
+            GIT_OBJECT_DIRECTORY = sharedObjects,
+            GIT_ALTERNATE_OBJECT_DIRECTORIES = abspath(objects)
+        )
+
+    def close(self):
+        self.repo.close()
+        for batch in ("blobs", "commits"):
+            batch = self.__dict__.get(batch)
+            if batch is not None:
+                batch.close()
+
+    # Objects are written by long-lived processes. Blobs are written during
+    # staging from working tree files. Commits are written from
+    # `commitFile`.
+
+    @lazy
+    def blobs(self):
+        return GitBatch(self.backupDir,
+            "hash-object", "-w", "--no-filters", "--stdin-paths",
+            env = self.objectsEnv
+        )
+
+    @lazy
+    def commits(self):
+        return GitBatch(self.backupDir,
+            "hash-object", "-w", "-t", "commit", "--stdin-paths",
+            env = self.objectsEnv
+        )
+
+    @property
+    def commitFile(self):
+        return join(self.backupDir, ".git", "SAVEMON_COMMIT")
+
+    @lazy
+    def workTree(self):
+        return WorkTree.of(self.backupDir)
+
+    def _index_stamp(self):
+        try:
+            st = stat(join(self.backupDir, ".git", "index"))
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def listdir(self, relDir):
+        curBackup = join(self.backupDir, relDir)
+        if isdir(curBackup):
+            return listdir(curBackup)
+        return []
+
+    def has(self, relN):
+        return isfile(join(self.backupDir, relN))
+
+    def stage(self, relN, fullN, force = False):
+        fullBackN = join(self.backupDir, relN)
+
+        data = self.read_file(fullN)
+
+        if exists(fullBackN):
+            if data == self.read_file(fullBackN):
+                if not force:
+                    return None
+            else:
+                print("Replacing %s with %s" % (fullBackN, fullN))
+                self.write_file(fullBackN, data)
+        else:
+            fullBackNDir = dirname(fullBackN)
+            if not exists(fullBackNDir):
+                print("Creating directories '%s'" % fullBackNDir)
+                makedirs(fullBackNDir)
+            print("Copying '%s' to '%s'" % (fullN, fullBackN))
+            self.write_file(fullBackN, data)
+
+        blob = bytes.fromhex(self.blobs.request(fullBackN))
+        self.workTree.changed(relN)
+        return blob, len(data)
+
+    def remove(self, relN):
+        backupDir = self.backupDir
+        fullBackN = join(backupDir, relN)
+        self.workTree.changed(relN)
+        if exists(fullBackN):
+            remove(fullBackN)
+        # as `git rm` does
+        d = dirname(fullBackN)
+        while d != backupDir and isdir(d) and not listdir(d):
+            rmdir(d)
+            d = dirname(d)
+
+    def commit(self, changes, message):
+        index = self.repo.index
+        with tracer.span("index"):
+            entries = index.entries
+            # path -> blob id in current snapshot, staged size
+            before = {}
+            sizes = {}
+            for method, relN, blob in changes:
+                path = relN.replace(sep, "/")
+                if path not in before:
+                    entry = entries.get((path, 0))
+                    before[path] = None if entry is None else entry.binsha
+                if method == "add":
+                    binsha, sizes[path] = blob
+                    entries[(path, 0)] = IndexEntry.from_base(
+                        BaseIndexEntry((0o100644, binsha, 0, path))
+                    )
+                elif method == "remove":
+                    entries.pop((path, 0), None)
+            index.write()
+
+        self.lastChanges = lastChanges = []
+        for path, binsha in before.items():
+            entry = entries.get((path, 0))
+            if entry is None:
+                if binsha is not None:
+                    lastChanges.append((path, None, 0))
+            elif entry.binsha != binsha:
+                lastChanges.append((path, entry.binsha.hex(), sizes[path]))
+
+        with tracer.span("write commit"):
+            tree = index.write_tree()
+            cur = self.current()
+            if cur is not None and cur.tree.binsha == tree.binsha:
+                commit = None
+            else:
+                commit = self._write_commit(tree, cur, message)
+        self.workTree.committed((c[1] for c in changes),
+            self._index_stamp()
+        )
+        return commit
+
+    # As `git commit-tree` & `git update-ref` do.
+    def _write_commit(self, tree, parent, message):
+        repo = self.repo
+        cr = repo.config_reader()
+        author = Actor.author(cr)
+        committer = Actor.committer(cr)
+        now = datetime.now().astimezone()
+        date = "%u %s" % (int(now.timestamp()), now.strftime("%z"))
+
+        lines = ["tree " + tree.hexsha]
+        if parent is not None:
+            lines.append("parent " + parent.hexsha)
+        lines.append("author %s <%s> %s" % (author.name, author.email, date))
+        lines.append("committer %s <%s> %s" % (
+            committer.name, committer.email, date
+        ))
+        lines.append("")
+        lines.append(message)
+
+        commitFile = self.commitFile
+        with open(commitFile, "wb") as f:
+            f.write("\n".join(lines).encode("utf-8"))
+        hexsha = self.commits.request(commitFile)
+        commit = repo.commit(hexsha)
+
+        if parent is None:
+            head = Head.create(repo, repo.head.ref, commit,
+                logmsg = "commit (initial): " + message
+            )
+            repo.head.set_reference(head)
+        else:
+            repo.head.set_commit(commit, logmsg = "commit: " + message)
+        return commit
+
+    def heads(self):
+        return [h.commit for h in self.repo.heads]
+
+    def current(self):
+        try:
+            return self.repo.active_branch.commit
+        except ValueError:
+            # no commits yet
+            return None
+
+    def snapshot(self, hexsha):
+        return self.repo.commit(hexsha)
+
+    def iter_history(self):
+        heads = [h.hexsha for h in self.heads()]
+        if heads:
+            # streamed by `git rev-list`, it also sorts topologically
+            yield from self.repo.iter_commits(heads, date_order = True)
+
+    def is_dirty(self):
+        stamp = self._index_stamp()
+        dirty = self.workTree.is_dirty(stamp)
+        if dirty is not None:
+            return dirty
+
+        git = self.repo.git
+        if sys.platform in ("win32", "darwin") and git.version_info >= (2, 36):
+            # built-in file system monitor
+            git = git(c = "core.fsmonitor=true")
+        dirty = bool(git.status("--porcelain", "--untracked-files=no",
+            "--no-renames", "--ignore-submodules"
+        ))
+        if not dirty:
+            # `git status` may refresh index
+            self.workTree.clean(self._index_stamp())
+        return dirty
+
+    def lock_file(self):
+        return join(self.backupDir, ".git", "index.lock")
+
+    def journal_file(self):
+        return join(self.backupDir, ".git", "savemon.journal")
+
+    def path_index_file(self):
+        return join(self.backupDir, ".git", "savemon.paths")
+
+    def switch(self, target):
+        repo = self.repo
+        active = repo.active_branch
+        cur = active.commit
+
+        # TODO: do not set branch if commits are reachable (other
+        # branch exists)
+
+        # setup backup branch and checkout new version
+        back_name = self._backup_name(
+            ((h.name, h.commit.hexsha) for h in repo.heads),
+            cur
+        )
+        if back_name is not None:
+            back_head = repo.create_head(back_name, cur)
+
+        try:
+            active.commit = target
+            try:
+                active.checkout(True)
+            except:
+                active.commit = cur
+                raise
+        except:
+            if back_name is not None:
+                repo.delete_head(back_head)
+            raise
+
+        self.workTree.clean(self._index_stamp())
+
+    def iter_files(self, snapshot):
+        stack = [snapshot.tree]
+        while stack:
+            node = stack.pop()
+            for b in node.blobs:
+                yield b.path, b
+            stack.extend(node.trees)
+
+    def stream_data(self, blob, f):
+        blob.stream_data(f)
+
+    def find_file(self, snapshot, relN):
+        try:
+            blob = snapshot.tree / relN.replace(sep, "/")
+        except KeyError:
+            return None
+        if blob.type != "blob":
+            return None
+        return blob.size, blob
+
+    def iter_objects(self, snapshot):
+        for _, blob in self.iter_files(snapshot):
+            yield blob.binsha, blob.size
+
+    def diff(self, old, new):
+        changes = []
+        # subtrees with same SHA1 are same, they are not compared
+        stack = [("", None if old is None else old.tree, new.tree)]
+        while stack:
+            prefix, oldTree, newTree = stack.pop()
+            oldItems = {} if oldTree is None else dict(
+                (o.name, o) for o in oldTree
+            )
+            newItems = {} if newTree is None else dict(
+                (o.name, o) for o in newTree
+            )
+            for name in set(oldItems) | set(newItems):
+                a = oldItems.get(name)
+                b = newItems.get(name)
+                if a is not None and b is not None and a.binsha == b.binsha:
+                    continue
+                key = prefix + name
+                aTree = a is not None and a.type == "tree"
+                bTree = b is not None and b.type == "tree"
+                if aTree or bTree:
+                    stack.append((key + "/",
+                        a if aTree else None,
+                        b if bTree else None
+                    ))
+                # size is read from object header
+                aSize = a.size if a is not None and a.type == "blob" else None
+                bSize = b.size if b is not None and b.type == "blob" else None
+                if aSize is not None or bSize is not None:
+                    changes.append((key, aSize, bSize))
+        changes.sort()
+        return changes
+
+    def blob_of(self, blobId):
+        return Blob(self.repo, bytes.fromhex(blobId))
+
+    def iter_file_ids(self, snapshot):
+        # one process instead of a request per blob size
+        out = self.repo.git.ls_tree("-r", "-l", "-z", snapshot.hexsha)
+        for line in out.split("\0"):
+            if not line:
+                continue
+            meta, path = line.split("\t", 1)
+            _, kind, hexsha, size = meta.split()
+            if kind == "blob":
+                yield path, hexsha, int(size)
+
+
+class Compressor(object):
+    "Compresses objects of a file choosing whether it's worth it."
+
+    # objects compressed worse than that are stored as is
+    minGain = 0.9
+    # when compression does not help, it's retried for each N-th object
+    probePeriod = 16
+
+    def __init__(self, codec, level):
+        self.codec = codec
+        if codec == "zstd":
+            self._compress = ZstdCompressor(level = level).compress
+        elif codec == "zlib":
+            self._compress = lambda data: zlib_compress(data, level)
+        # compressed / raw, measured
+        self.ratio = None
+        self._skipped = 0
+
+    def __call__(self, data):
+        if self.codec == "none" or len(data) < 64:
+            return b"r" + data
+
+        if self.ratio is not None and self.ratio > self.minGain:
+            self._skipped += 1
+            if self._skipped < self.probePeriod:
+                return b"r" + data
+            self._skipped = 0
+
+        packed = self._compress(data)
+        ratio = len(packed) / float(len(data))
+        if self.ratio is None:
+            self.ratio = ratio
+        else:
+            self.ratio = (self.ratio + ratio) / 2
+        if ratio > self.minGain:
+            return b"r" + data
+        return CODEC_TAGS[self.codec] + packed
+
+
+class Compression(object):
+    "Settings of object compression in `ChunkStore`."
+
+    # (max file size, level): big files are compressed faster
+    levels = dict(
+        zlib = ((1 << 20, 6), (32 << 20, 3), (None, 1)),
+        zstd = ((1 << 20, 9), (32 << 20, 3), (None, 1)),
+    )
+
+    def __init__(self, codec = "auto"):
+        if codec == "auto":
+            codec = "zlib" if ZstdCompressor is None else "zstd"
+        elif codec == "zstd" and ZstdCompressor is None:
+            print("zstandard is not installed, using zlib")
+            codec = "zlib"
+        self.codec = codec
+
+    def for_size(self, size):
+        codec = self.codec
+        level = 0
+        for limit, level in self.levels.get(codec, ()):
+            if limit is None or size <= limit:
+                break
+        return Compressor(codec, level)
+
+
+CODEC_TAGS = dict(
+    zlib = b"z",
+    zstd = b"s",
+)
+
+
+def decompress_object(data):
+    tag = data[:1]
+    if tag == b"r":
+        return data[1:]
+    if tag == b"z":
+        return zlib_decompress(data[1:])
+    if tag == b"s":
+        if ZstdDecompressor is None:
+            raise RuntimeError("zstandard is required to read the storage"
+                " (python -m pip install zstandard)"
+            )
+        return ZstdDecompressor().decompress(data[1:])
+    raise ValueError("Unknown object codec %r" % tag)
+
+
+class FileLock(object):
+    "Lock shared by processes, it's held while `with` block runs."
+
+    def __init__(self, path):
+        self.path = path
+        self.f = None
+
+    def __enter__(self):
+        if self.f is None:
+            self.f = open(self.path, "a+b")
+        fd = self.f.fileno()
+        if lockf is not None:
+            lockf(fd, LOCK_EX)
+            return self
+        self.f.seek(0)
+        while True:
+            try:
+                locking(fd, LK_LOCK, 1)
+                return self
+            except OSError:
+                # `LK_LOCK` gives up after 10 seconds
+                pass
+
+    def __exit__(self, *_):
+        fd = self.f.fileno()
+        if lockf is not None:
+            lockf(fd, LOCK_UN)
+        else:
+            self.f.seek(0)
+            locking(fd, LK_UNLCK, 1)
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+
+class ChunkStore(object):
+    "Append-only content addressed storage of objects."
+
+    # Objects are appended to pack files. The index file is a sequence of
+    # `index_record`s locating objects in packs. Stored object data is
+    # prefixed with codec tag (see `Compressor`), an id is SHA1 of
+    # uncompressed data. Other processes (e.g. sharing the store) append
+    # objects under `lock` file, they are indexed when they are looked for.
+    index_record = Struct("<20sIQI")
+
+    # opened stores by path, see `open_shared`
+    shared = {}
+    sharedLock = Lock()
+
+    def __init__(self, path, packLimit = 256 << 20, compression = None,
+        readOnly = False
+    ):
+        self.path = path
+        # nothing is created or written, e.g. for reports
+        self.readOnly = readOnly
+        self.packLimit = packLimit
+        self.compression = compression or Compression("none")
+        self.lock = Lock()
+        self.index = {}
+        # bytes appended to packs, totally and by current thread
+        self.written = 0
+        self._threadWritten = local()
+        self._pack = None
+        self._readers = {}
+        # of `open_shared` store
+        self.key = None
+        self.users = 0
+
+    # Returns the store opened once per process, e.g. for all backups
+    # sharing it. `close` it as usually.
+    @classmethod
+    def open_shared(cls, path, **kw):
+        key = (normcase(realpath(path)), kw.get("readOnly", False))
+        with cls.sharedLock:
+            store = cls.shared.get(key)
+            if store is None:
+                store = cls(path, **kw)
+                store.open()
+                store.key = key
+                cls.shared[key] = store
+            store.users += 1
+        return store
+
+    def _pack_path(self, packNo):
+        return join(self.path, "%04u.pack" % packNo)
+
+    def open(self):
+        path = self.path
+        if not self.readOnly:
+            makedirs(path, exist_ok = True)
+
+        packSizes = {}
+        for n in listdir(path) if exists(path) else ():
+            if n.endswith(".pack"):
+                packSizes[int(n[:-5], base = 10)] = getsize(join(path, n))
+
+        indexPath = join(path, "index")
+        self._indexSize = 0
+        if self.readOnly:
+            # a record is appended after its data, a torn one is skipped
+            self._fileLock = nullcontext()
+            self._index = open(indexPath, "rb") if exists(indexPath) else None
+            self._read_index(packSizes)
+            self._packNo = 0
+            return
+
+        self._fileLock = FileLock(join(path, "lock"))
+        with self._fileLock:
+            self._index = open(indexPath, "a+b")
+            # a tail can be torn by a crash
+            size = self._index.seek(0, 2)
+            recSize = self.index_record.size
+            if size % recSize:
+                self._index.truncate(size - size % recSize)
+            self._indexSize = 0
+            self._read_index(packSizes)
+
+        self._packNo = max(packSizes) if packSizes else 0
+
+    # Indexes records appended since last call, under `_fileLock`.
+    def _read_index(self, packSizes = None):
+        f = self._index
+        if f is None:
+            return
+        f.flush()
+        f.seek(self._indexSize)
+        data = f.read()
+        rec = self.index_record
+        recSize = rec.size
+        index = self.index
+        for i in range(0, len(data) - recSize + 1, recSize):
+            oid, packNo, offset, length = rec.unpack_from(data, i)
+            # a pack tail can be lost by a crash
+            if packSizes is None or \
+                offset + length <= packSizes.get(packNo, -1):
+                index[oid] = (packNo, offset, length)
+        self._indexSize += len(data) - len(data) % recSize
+
+    def close(self):
+        if self.key is not None:
+            with self.sharedLock:
+                self.users -= 1
+                if self.users:
+                    return
+                del self.shared[self.key]
+                self.key = None
+
+        with self.lock:
+            if self._pack is not None:
+                self._pack.close()
+                self._pack = None
+            if self._index is not None:
+                self._index.close()
+            if not self.readOnly:
+                self._fileLock.close()
+            for f in self._readers.values():
+                f.close()
+            self._readers.clear()
+
+    def __contains__(self, oid):
+        return oid in self.index
+
+    @property
+    def written_by_thread(self):
+        return getattr(self._threadWritten, "n", 0)
+
+    # `compressor` is a `Compressor`, chosen by object size by default.
+    def put(self, data, compressor = None, oid = None):
+        if oid is None:
+            oid = sha1(data).digest()
+        if oid in self.index:
+            return oid
+
+        if self.readOnly:
+            raise RuntimeError("'%s' is opened read only" % self.path)
+        if compressor is None:
+            compressor = self.compression.for_size(len(data))
+        data = compressor(data)
+
+        with self.lock, self._fileLock:
+            self._read_index()
+            if oid in self.index:
+                return oid
+
+            # another process may have started next pack
+            packNo = self._packNo
+            while exists(self._pack_path(packNo + 1)):
+                packNo += 1
+            pack = self._pack
+            if pack is not None and packNo != self._packNo:
+                pack.close()
+                pack = None
+            if pack is None:
+                pack = open(self._pack_path(packNo), "ab")
+            end = pack.seek(0, 2)
+            if end >= self.packLimit:
+                pack.close()
+                packNo += 1
+                pack = open(self._pack_path(packNo), "ab")
+                end = 0
+            self._pack = pack
+            self._packNo = packNo
+
+            loc = (packNo, end, len(data))
+            pack.write(data)
+            # visible to other processes before the lock is released
+            pack.flush()
+            self.written += len(data)
+            threadWritten = self._threadWritten
+            threadWritten.n = getattr(threadWritten, "n", 0) + len(data)
+            self.index[oid] = loc
+            self._index.seek(0, 2)
+            self._index.write(self.index_record.pack(oid, *loc))
+            self._index.flush()
+            self._indexSize += self.index_record.size
+        return oid
+
+    def get(self, oid):
+        try:
+            packNo, offset, length = self.index[oid]
+        except KeyError:
+            # may be written by another process
+            with self.lock, self._fileLock:
+                self._read_index()
+            packNo, offset, length = self.index[oid]
+        with self.lock:
+            try:
+                f = self._readers[packNo]
+            except KeyError:
+                f = open(self._pack_path(packNo), "rb")
+                self._readers[packNo] = f
+            f.seek(offset)
+            data = f.read(length)
+        return decompress_object(data)
+
+    def sync(self):
+        if self.readOnly:
+            return
+        with self.lock:
+            # data must reach the disk before the index referencing it
+            pack = self._pack
+            if pack is not None:
+                pack.flush()
+                fsync(pack.fileno())
+            self._index.flush()
+            fsync(self._index.fileno())
+
+
+class ChunkStores(object):
+    """Objects are written to `store` unless one of read only `alternates`
+has them, as Git alternates do. E.g. `store` is shared by backups and an
+alternate is a store of a backup made before sharing."""
+
+    def __init__(self, store, alternates = ()):
+        self.store = store
+        self.stores = [store] + list(alternates)
+
+    @property
+    def written(self):
+        return self.store.written
+
+    @property
+    def written_by_thread(self):
+        return self.store.written_by_thread
+
+    def __contains__(self, oid):
+        return any(oid in s.index for s in self.stores)
+
+    def put(self, data, compressor = None):
+        oid = sha1(data).digest()
+        if oid in self:
+            return oid
+        return self.store.put(data, compressor, oid)
+
+    def _store_of(self, oid):
+        for s in self.stores:
+            if oid in s.index:
+                return s
+        # it may be written to `store` by another process
+        return self.store
+
+    def get(self, oid):
+        return self._store_of(oid).get(oid)
+
+    # Bytes the object takes in a pack.
+    def stored_size(self, oid):
+        store = self._store_of(oid)
+        if oid not in store:
+            store.get(oid)
+        return store.index[oid][2]
+
+    def sync(self):
+        self.store.sync()
+
+    def close(self):
+        for s in self.stores:
+            s.close()
+
+
+class Chunker(object):
+    "Content-defined chunking of a file."
+
+    # A boundary is placed after a window of bytes whose classes are equal
+    # to `magic`. I.e. it's a hash of a sliding window which only depends on
+    # local content, so an insertion only affects chunks around it. It's
+    # evaluated by `bytes.translate` and `bytes.find` in place of a
+    # per-byte rolling hash loop which is too slow in Python.
+    # There are 4 classes, so average distance between boundaries is
+    # 4 ** len(magic) = 16 KiB (plus `minSize`).
+    classes = bytes(((b * 167 + 13) & 0xFF) >> 6 for b in range(256))
+    magic = bytes([1, 3, 0, 2, 3, 1, 2])
+
+    def __init__(self, minSize = 2 << 10, maxSize = 64 << 10,
+        blockSize = 4 << 20
+    ):
+        self.minSize = minSize
+        self.maxSize = maxSize
+        self.blockSize = max(blockSize, maxSize)
+
+    def split(self, f):
+        minSize, maxSize = self.minSize, self.maxSize
+        classes, magic = self.classes, self.magic
+        w = len(magic)
+
+        data = b""
+        eof = False
+        while not eof:
+            block = f.read(self.blockSize)
+            if block:
+                data += block
+            else:
+                eof = True
+
+            cls = data.translate(classes)
+            size = len(data)
+            start = 0
+            while start < size:
+                if not eof and size - start < maxSize:
+                    break # a boundary may be in next block
+                end = cls.find(magic, start + minSize - w, start + maxSize)
+                if end < 0:
+                    end = min(start + maxSize, size)
+                else:
+                    end += w
+                yield data[start:end]
+                start = end
+            data = data[start:]
+
+
+class ChunkSnapshot(object):
+
+    def __init__(self, storage, hexsha):
+        self.storage = storage
+        self.hexsha = hexsha
+
+        manifest = loads(storage.store.get(bytes.fromhex(hexsha)))
+        self.message = manifest["message"]
+        self.committed_datetime = datetime.fromisoformat(manifest["date"])
+        self.parent_shas = manifest["parents"]
+        # "/" separated path -> (size, hex id of chunk list)
+        self.files = manifest["files"]
+
+    # not kept, so history is not kept in memory by its last snapshot
+    @property
+    def parents(self):
+        snapshot = self.storage.snapshot
+        return tuple(snapshot(p) for p in self.parent_shas)
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, ChunkSnapshot)
+        and self.hexsha == other.hexsha
+        )
+
+    def __hash__(self):
+        return hash(self.hexsha)
+
+    # for `LruCache`
+    def __len__(self):
+        return len(self.files) + 1
+
+
+class ChunkStorage(Storage):
+    """Files are split by `Chunker` and deduplicated chunks are kept in
+`ChunkStore`. A snapshot is a manifest listing chunks of its files.
+There is no working tree."""
+
+    # loaded manifests are cached up to that number of files
+    snapshotCacheSize = 1 << 16
+
+    def __init__(self, backupDir, chunker = None, compression = "auto"):
+        super(ChunkStorage, self).__init__(backupDir)
+        self.chunker = chunker or Chunker()
+        self.compression = Compression(compression)
+        self._snapshots = LruCache(self.snapshotCacheSize)
+
+    def open(self, readOnly = False):
+        backupDir = self.backupDir
+        head = join(backupDir, "HEAD")
+        if readOnly:
+            if not exists(head):
+                raise RuntimeError("No backup in '%s'" % backupDir)
+        elif not exists(head):
+            print("Initializing chunk storage in '%s'" % backupDir)
+            makedirs(join(backupDir, "refs"), exist_ok = True)
+            with open(head, "w") as f:
+                f.write("master")
+
+        paths = [join(backupDir, "packs")] + self.alternates()
+        sharedStore = self.sharedStore
+        if sharedStore and not readOnly:
+            shared = abspath(join(sharedStore, "chunks"))
+            if shared not in paths:
+                print("Sharing '%s' with other backups" % shared)
+                self.add_alternate(shared)
+                paths.append(shared)
+            # new objects are written to the shared store
+            paths.remove(shared)
+            paths.insert(0, shared)
+
+        stores = []
+        try:
+            for path in paths:
+                if stores and not exists(path):
+                    continue
+                stores.append(ChunkStore.open_shared(path,
+                    compression = self.compression,
+                    readOnly = readOnly
+                ))
+        except:
+            for store in stores:
+                store.close()
+            raise
+        self.store = ChunkStores(stores[0], stores[1:])
+
+        self._reset(self.current())
+
+    # Paths of other stores objects of this backup may be in.
+    def alternates(self):
+        try:
+            with open(join(self.backupDir, "alternates"), "r") as f:
+                return [l.strip() for l in f if l.strip()]
+        except FileNotFoundError:
+            return []
+
+    def add_alternate(self, path):
+        with open(join(self.backupDir, "alternates"), "a") as f:
+            f.write(path + "\n")
+            f.flush()
+            fsync(f.fileno())
+
+    def _reset(self, snapshot):
+        # `files` are staged, `committedFiles` are updated by `commit`
+        self.files = files = {}
+        self.committedFiles = {}
+        self.dirs = {}
+        if snapshot is not None:
+            for key, entry in snapshot.files.items():
+                files[key] = tuple(entry)
+                self._link(key)
+            self.committedFiles.update(files)
+        self.committedTree = self._tree(self.committedFiles)
+
+    # Digest of `files` to detect commits without changes.
+    @staticmethod
+    def _tree(files):
+        return sha1(dumps(files, sort_keys = True).encode("utf-8")).digest()
+
+    def close(self):
+        self.store.close()
+
+    def _link(self, key):
+        dirs = self.dirs
+        parts = key.split("/")
+        for i in range(len(parts)):
+            dirs.setdefault("/".join(parts[:i]), set()).add(parts[i])
+
+    def _unlink(self, key):
+        dirs = self.dirs
+        while key:
+            d, _, n = key.rpartition("/")
+            names = dirs[d]
+            names.discard(n)
+            if names or not d:
+                break
+            del dirs[d]
+            key = d
+
+    def journal_file(self):
+        return join(self.backupDir, "journal")
+
+    def path_index_file(self):
+        return join(self.backupDir, "paths")
+
+    def active_branch(self):
+        with open(join(self.backupDir, "HEAD"), "r") as f:
+            return f.read().strip()
+
+    def ref(self, name):
+        try:
+            with open(join(self.backupDir, "refs", name), "r") as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def set_ref(self, name, hexsha):
+        path = join(self.backupDir, "refs", name)
+        with open(path + ".tmp", "w") as f:
+            f.write(hexsha)
+            f.flush()
+            fsync(f.fileno())
+        replace(path + ".tmp", path)
+
+    def snapshot(self, hexsha):
+        s = self._snapshots.get(hexsha)
+        if s is None:
+            s = ChunkSnapshot(self, hexsha)
+            self._snapshots.put(hexsha, s)
+        return s
+
+    def refs(self):
+        for name in listdir(join(self.backupDir, "refs")):
+            if not name.endswith(".tmp"):
+                yield name, self.ref(name)
+
+    def heads(self):
+        return [self.snapshot(hexsha) for _, hexsha in self.refs()]
+
+    def current(self):
+        hexsha = self.ref(self.active_branch())
+        if hexsha is None:
+            return None
+        return self.snapshot(hexsha)
+
+    def switch(self, target):
+        cur = self.current()
+        back_name = self._backup_name(self.refs(), cur)
+        if back_name is not None:
+            self.set_ref(back_name, cur.hexsha)
+        self.set_ref(self.active_branch(), target.hexsha)
+        self._reset(self.snapshot(target.hexsha))
+
+    def listdir(self, relDir):
+        return list(self.dirs.get(relDir.replace(sep, "/"), ()))
+
+    def has(self, relN):
+        return relN.replace(sep, "/") in self.files
+
+    def stage(self, relN, fullN, force = False):
+        store = self.store
+        put = store.put
+        written = store.written_by_thread
+        size = 0
+        chunks = []
+        with open(fullN, "rb") as f:
+            compressor = self.compression.for_size(fstat(f.fileno()).st_size)
+            t0 = perf_counter()
+            for chunk in self.chunker.split(f):
+                size += len(chunk)
+                chunks.append(put(chunk, compressor))
+                self.account(len(chunk), store.written_by_thread - written,
+                    perf_counter() - t0
+                )
+                written = store.written_by_thread
+                t0 = perf_counter()
+        entry = (size, put(b"".join(chunks)).hex())
+        self.account(written = store.written_by_thread - written)
+
+        key = relN.replace(sep, "/")
+        if self.files.get(key) == entry:
+            return entry if force else None
+
+        print("Storing '%s' (%u chunks)" % (fullN, len(chunks)))
+        if key not in self.files:
+            self._link(key)
+        self.files[key] = entry
+        return entry
+
+    def remove(self, relN):
+        key = relN.replace(sep, "/")
+        if key in self.files:
+            del self.files[key]
+            self._unlink(key)
+
+    def commit(self, changes, message):
+        files = self.committedFiles
+        before = {}
+        for method, relN, entry in changes:
+            key = relN.replace(sep, "/")
+            if key not in before:
+                before[key] = files.get(key)
+            if method == "add":
+                files[key] = entry
+            elif method == "remove":
+                files.pop(key, None)
+
+        self.lastChanges = [
+            (key, None, 0) if files.get(key) is None else
+                (key, files[key][1], files[key][0])
+                    for key, entry in before.items() if files.get(key) != entry
+        ]
+
+        tree = self._tree(files)
+        if tree == self.committedTree:
+            return None
+
+        cur = self.current()
+        manifest = dict(
+            parents = [] if cur is None else [cur.hexsha],
+            date = datetime.now().astimezone().isoformat(),
+            message = message,
+            files = files,
+        )
+        with tracer.span("manifest", files = len(files)):
+            hexsha = self.store.put(
+                dumps(manifest, sort_keys = True).encode("utf-8")
+            ).hex()
+        with tracer.span("sync"):
+            self.store.sync()
+            self.set_ref(self.active_branch(), hexsha)
+        self.committedTree = tree
+        return self.snapshot(hexsha)
+
+    def iter_files(self, snapshot):
+        for key, (_, chunks) in snapshot.files.items():
+            yield join(*key.split("/")), chunks
+
+    def stream_data(self, blob, f):
+        get = self.store.get
+        chunks = get(bytes.fromhex(blob))
+        for i in range(0, len(chunks), 20):
+            f.write(get(chunks[i:i + 20]))
+
+    def find_file(self, snapshot, relN):
+        entry = snapshot.files.get(relN.replace(sep, "/"))
+        if entry is None:
+            return None
+        size, chunks = entry
+        return size, chunks
+
+    def iter_file_ids(self, snapshot):
+        for key, (size, chunks) in snapshot.files.items():
+            yield key, chunks, size
+
+    def iter_objects(self, snapshot):
+        store = self.store
+        for _, chunks in self.iter_files(snapshot):
+            chunks = store.get(bytes.fromhex(chunks))
+            for i in range(0, len(chunks), 20):
+                oid = chunks[i:i + 20]
+                yield oid, store.stored_size(oid)
+
+
+STORAGES = dict(
+    git = GitStorage,
+    chunks = ChunkStorage,
+)
+
+
+def dir_size(path):
+    return sum(
+        getsize(join(d, n)) for d, _, names in walk(path) for n in names
+    )
+
+
+def mib(size):
+    return "%.1f MiB" % (size / float(1 << 20))
+
+
+# Reports how much content of current versions of `storages` (pairs of
+# name and not opened storage) is same, within a backup and between them.
+# Sizes are as objects are stored, `git` ones are uncompressed.
+def dedup_report(storages, progress = None):
+    lines = []
+    total = 0
+    sizes = {}
+    for name, storage in storages:
+        if progress is not None:
+            progress(name)
+        objects = size = 0
+        storage.open(readOnly = True)
+        try:
+            cur = storage.current()
+            if cur is not None:
+                for oid, n in storage.iter_objects(cur):
+                    objects += 1
+                    size += n
+                    sizes[oid] = n
+        finally:
+            storage.close()
+        total += size
+        lines.append("%s: %u objects, %s, backup directory takes %s" % (
+            name, objects, mib(size), mib(dir_size(storage.backupDir))
+        ))
+
+    unique = sum(sizes.values())
+    lines.append("")
+    lines.append("Content %s, unique %s, deduplicated %s (%.1f%%)" % (
+        mib(total), mib(unique), mib(total - unique),
+        100. * (total - unique) / total if total else 0.
+    ))
+    sharedStore = Storage.sharedStore
+    if sharedStore and exists(sharedStore):
+        lines.append("Shared store '%s' takes %s" % (
+            sharedStore, mib(dir_size(sharedStore))
+        ))
+    return "\n".join(lines)
+
+
+class HistoryReader(object):
+    """Reads files of any snapshot of opened `storage` without checkout.
+Snapshots are found by time with an index of commit times. Content of
+blobs up to `maxCached` bytes is cached."""
+
+    def __init__(self, storage, cacheSize = 64 << 20, maxCached = 8 << 20):
+        self.storage = storage
+        self.cache = LruCache(cacheSize)
+        self.maxCached = maxCached
+        # sorted commit timestamps and hexsha of snapshots, by `_index`
+        self.times = []
+        self.hexshas = []
+        self._heads = None
+
+    def _index(self):
+        heads = set(h.hexsha for h in self.storage.heads())
+        if heads == self._heads:
+            return
+        # snapshots of same second are ordered as in history
+        entries = sorted(
+            (s.committed_datetime.timestamp(), -i, s.hexsha)
+                for i, s in enumerate(self.storage.iter_history())
+        )
+        self.times = [e[0] for e in entries]
+        self.hexshas = [e[2] for e in entries]
+        self._heads = heads
+
+    # Returns the last snapshot committed not later than `when` (a
+    # `datetime` or a timestamp), `None` if there was no snapshot yet.
+    def snapshot_at(self, when):
+        if isinstance(when, datetime):
+            when = when.timestamp()
+        self._index()
+        i = bisect_right(self.times, when)
+        if not i:
+            return None
+        return self.storage.snapshot(self.hexshas[i - 1])
+
+    # `rev` is a hexsha or its unique prefix.
+    def snapshot_of(self, rev):
+        rev = rev.lower()
+        if len(rev) == 40:
+            # no need to load history
+            return self.storage.snapshot(rev)
+        self._index()
+        found = [h for h in self.hexshas if h.startswith(rev)]
+        if len(found) != 1:
+            raise KeyError("%s snapshots match '%s'" % (
+                "No" if not found else "Many", rev
+            ))
+        return self.storage.snapshot(found[0])
+
+    # Writes content of `relN` in `snapshot` to `f`. Returns `False` if
+    # there is no such file.
+    def stream(self, relN, snapshot, f):
+        found = self.storage.find_file(snapshot, relN)
+        if found is None:
+            return False
+        size, blob = found
+        if size > self.maxCached:
+            self.storage.stream_data(blob, f)
+            return True
+        data = self.cache.get(blob)
+        if data is None:
+            buf = BytesIO()
+            self.storage.stream_data(blob, buf)
+            data = buf.getvalue()
+            self.cache.put(blob, data)
+        f.write(data)
+        return True
+
+    # Returns content of `relN` in `snapshot`, `None` if there is no such
+    # file.
+    def read(self, relN, snapshot):
+        buf = BytesIO()
+        if not self.stream(relN, snapshot, buf):
+            return None
+        return buf.getvalue()
+
+    # Describes difference of `relN` content in `old` and `new` snapshots.
+    # Files bigger than `maxSize` are not read, `None` is returned.
+    def compare(self, relN, old, new, maxSize = 1 << 20):
+        storage = self.storage
+        a = storage.find_file(old, relN)
+        b = storage.find_file(new, relN)
+        if a is None or b is None or max(a[0], b[0]) > maxSize:
+            return None
+        a = self.read(relN, old)
+        b = self.read(relN, new)
+        text = None
+        if b"\0" not in a and b"\0" not in b:
+            try:
+                text = a.decode("utf-8"), b.decode("utf-8")
+            except UnicodeDecodeError:
+                pass
+        if text is not None:
+            added = removed = 0
+            for l in unified_diff(text[0].splitlines(), text[1].splitlines(),
+                n = 0,
+                lineterm = ""
+            ):
+                if l.startswith("+") and not l.startswith("+++"):
+                    added += 1
+                elif l.startswith("-") and not l.startswith("---"):
+                    removed += 1
+            return "+%u -%u lines" % (added, removed)
+
+        # binary: the changed region between common prefix and suffix
+        n = min(len(a), len(b))
+        start = 0
+        while start < n and a[start] == b[start]:
+            start += 1
+        end = 0
+        while end < n - start and a[-1 - end] == b[-1 - end]:
+            end += 1
+        return "%u bytes at offset %u -> %u bytes" % (
+            len(a) - start - end, start, len(b) - start - end
+        )
 
-                    changes.clear()
-                    self.commit()
-                continue
 
-            relN = change[1]
-            if re_system_name.match(relN):
-                continue
-            elif filterOut and filterOut.match(relN):
-                print("Ignoring '%s' (Filter Out)" % relN)
-                continue
+# Returns not opened storage of existing `backupDir`, `None` if there is no
+# backup.
+def find_storage(backupDir):
+    if exists(join(backupDir, ".git")):
+        return GitStorage(backupDir)
+    if exists(join(backupDir, "HEAD")):
+        return ChunkStorage(backupDir)
+    return None
+
+
+# `when` is a timestamp or ISO 8601 date, local time by default.
+def parse_time(when):
+    try:
+        return float(when)
+    except ValueError:
+        return datetime.fromisoformat(when).timestamp()
+
+
+# Writes content of `relN` as it was at `when` or in `rev` snapshot (the
+# current one by default) to `output` file or standard output. Returns exit
+# code.
+def cat_file(backupDir, relN, when = None, rev = None, output = None):
+    storage = find_storage(backupDir)
+    if storage is None:
+        print("No backup in '%s'" % backupDir)
+        return 1
+    storage.open(readOnly = True)
+    try:
+        reader = HistoryReader(storage)
+        if rev:
+            snapshot = reader.snapshot_of(rev)
+        elif when:
+            snapshot = reader.snapshot_at(parse_time(when))
+        else:
+            snapshot = storage.current()
+        if snapshot is None:
+            print("No backed up version")
+            return 1
+
+        if output:
+            f = open(output, "wb")
+        else:
+            f = sys.__stdout__.buffer
+        try:
+            found = reader.stream(relN, snapshot, f)
+        finally:
+            if output:
+                f.close()
             else:
-                changes.add(change)
-            lastChange = time()
+                f.flush()
+        if not found:
+            print("No '%s' in %s" % (relN, snapshot.hexsha))
+            return 1
+        print("'%s' is from %s | %s" % (relN, snapshot.hexsha,
+            commit_time_str(snapshot)
+        ))
+        return 0
+    finally:
+        storage.close()
+
+
+# File openers of `export_snapshot` compression methods.
+TAR_COMPRESSORS = dict(
+    gz = lambda f : gzip_open(f, "wb", compresslevel = 6),
+    bz2 = lambda f : bz2_open(f, "wb"),
+    xz = lambda f : lzma_open(f, "wb")
+)
 
-        print("Stop backing up of '%s'" % saveDir)
 
+class CountingWriter(object):
 
-class GitGraph(object):
+    def __init__(self, f):
+        self.f = f
+        self.written = 0
 
-    def __init__(self):
-        self.cache = {}
-        self.roots = None
+    def write(self, data):
+        self.written += len(data)
+        return self.f.write(data)
 
-    def __getitem__(self, gitpython_commit):
-        return self.cache[gitpython_commit]
 
-    def __setitem__(self, gitpython_commit, commit):
-        self.cache[gitpython_commit] = commit
+# Writes files of `rev` snapshot (SHA1 or prefix, the current one by default)
+# of `storage` (not opened) to `f` as a tar archive compressed by
+# `compression` method (a key of `TAR_COMPRESSORS`). Content is streamed from
+# storage, only one buffer is in memory at once. Returns the snapshot.
+def export_snapshot(storage, f, rev = None, compression = None):
+    storage.open(readOnly = True)
+    try:
+        if rev:
+            snapshot = HistoryReader(storage).snapshot_of(rev)
+        else:
+            snapshot = storage.current()
+        if snapshot is None:
+            raise ValueError("No backed up version")
+        mtime = int(snapshot.committed_datetime.timestamp())
 
-    def get(self, *a, **kw):
-        return self.cache.get(*a, **kw)
+        if compression:
+            out = TAR_COMPRESSORS[compression](f)
+        else:
+            out = f
+        out = CountingWriter(out)
+        for key, blobId, size in sorted(storage.iter_file_ids(snapshot)):
+            info = TarInfo(key)
+            info.size = size
+            info.mtime = mtime
+            info.mode = 0o644
+            # as `TarFile.addfile` does but data are written by storage
+            out.write(info.tobuf(PAX_FORMAT))
+            start = out.written
+            storage.stream_data(storage.blob_of(blobId), out)
+            if out.written - start != size:
+                raise RuntimeError("Size of '%s' is %u instead of %u" % (
+                    key, out.written - start, size
+                ))
+            out.write(b"\0" * (-size % BLOCKSIZE))
+        # end of archive
+        out.write(b"\0" * (BLOCKSIZE * 2))
+        out.write(b"\0" * (-out.written % RECORDSIZE))
+        if compression:
+            out.f.close()
+        return snapshot
+    finally:
+        storage.close()
+
+
+# Returns ("/" separated path, relN) of archive member `name`. Raises
+# `ValueError` if it can point outside of `root` on any system.
+def archive_path(name, root):
+    parts = [p for p in name.split("/") if p not in ("", ".")]
+    if not parts or name.startswith("/") or any(
+        p == ".." or "\\" in p or ":" in p or sep in p or
+            (altsep and altsep in p) or splitdrive(p)[0]
+                for p in parts
+    ):
+        raise ValueError("Bad path '%s' in archive" % name)
+    relN = join(*parts)
+    root = normpath(abspath(root))
+    if not normpath(join(root, relN)).startswith(join(root, "")):
+        raise ValueError("Bad path '%s' in archive" % name)
+    return "/".join(parts), relN
+
+
+# Commits files of tar archive read from `f` (may be compressed) to
+# `storage` (not opened) as a new snapshot, other files are removed. Returns
+# the snapshot, `None` if the content is same as current.
+def import_archive(storage, f, message):
+    storage.open()
+    try:
+        cur = storage.current()
+        old = set() if cur is None else set(
+            key for key, _, _ in storage.iter_file_ids(cur)
+        )
+        changes = []
+        # `stage` accepts files, members are extracted one by one
+        with TemporaryDirectory() as tmp:
+            fullN = join(tmp, "member")
+            with tar_open(fileobj = f, mode = "r|*") as tar:
+                for info in tar:
+                    if not info.isfile():
+                        continue
+                    key, relN = archive_path(info.name, storage.backupDir)
+                    with open(fullN, "wb") as member:
+                        copyfileobj(tar.extractfile(info), member, 1 << 20)
+                    blob = storage.stage(relN, fullN, force = True)
+                    changes.append(("add", relN, blob))
+                    old.discard(key)
+        for key in sorted(old):
+            relN = join(*key.split("/"))
+            storage.remove(relN)
+            changes.append(("remove", relN, None))
+        return storage.commit(changes, message)
+    finally:
+        storage.close()
+
+
+# (save directory, not opened storage) of `Settings.saves` with backup.
+def saved_storages(saves):
+    ret = []
+    for save in saves:
+        saveDir, backupDir = save[:2]
+        storage = find_storage(backupDir) if backupDir else None
+        if storage is not None:
+            ret.append((saveDir, storage))
+    return ret
 
-    def iter_commits(self):
-        visited = set()
-        stack = list(self.roots)
-        while stack:
-            c = stack.pop(0)
-            if c in visited:
-                continue
-            visited.add(c)
-            yield c
-            stack.extend(c.children)
 
 class Commit(object):
+    "A snapshot as `GitSelector` shows it, made by history loading thread."
 
-    graph = GitGraph()
+    def __init__(self, backed):
+        self.backed = backed
+        self.hexsha = backed.hexsha
+        self.parentShas = [p.hexsha for p in backed.parents]
+        self.label = commit_time_str(backed) + " | " + backed.message
 
-    def __new__(type, backed, *a, **kw):
-        ret = type.graph.get(backed, None)
-        if ret is None:
-            ret = super().__new__(type)
-            ret.backed = backed
-            ret.children = []
-            type.graph[backed] = ret
-        return ret
 
-    @lazy
-    def parents(self):
-        ps = []
-        for p in self.backed.parents:
-            pc = Commit(p)
-            ps.append(pc)
-            pc.children.append(self)
-        return tuple(ps)
+def commit_time_str(commit):
+    return commit.committed_datetime.strftime("%Y.%m.%d %H:%M:%S %z")
 
-    @lazy
-    def committed_time_str(self):
-        return commit_time_str(self.backed)
 
-    @lazy
-    def label(self):
-        return self.committed_time_str + " | " + self.backed.message
+backup_re = compile("backup_([0-9]+)")
 
 
-def commit_time_str(commit):
-    return commit.committed_datetime.strftime("%Y.%m.%d %H:%M:%S %z")
+class Cancelled(Exception):
+    pass
 
 
-def build_commit_graph(*heads):
-    stack = list(heads)
-    roots = []
-    visited = set()
-    while stack:
-        c = stack.pop()
-        if c in visited:
-            continue
-        visited.add(c)
-        ps = c.parents
-        if not ps:
-            roots.append(c)
-            continue
-        for p in ps:
-            p.children.append(c)
-            stack.append(p)
+WorkProgressEvent, EVT_WORK_PROGRESS = NewEvent()
+WorkDoneEvent, EVT_WORK_DONE = NewEvent()
 
-    Commit.graph.roots = tuple(roots)
+class Worker(Thread):
+    """Runs `work(worker)` out of GUI thread. `work` posts its progress to
+`handler` window as `WorkProgressEvent`s. `WorkDoneEvent` is posted at end
+with `result`, `error` (an exception) and `cancelled` flag. Both events
+have `worker` attribute."""
 
-backup_re = compile("backup_([0-9]+)")
+    def __init__(self, handler, work, name = "Worker", period = 0.1):
+        super(Worker, self).__init__(name = name, daemon = True)
+        self.handler = handler
+        self.work = work
+        # of `progress`
+        self.period = period
+        self._posted = 0.
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    # Raises `Cancelled` if the work must be stopped.
+    def check(self):
+        if self.cancelled:
+            raise Cancelled()
+
+    def post(self, **kw):
+        self.check()
+        try:
+            PostEvent(self.handler, WorkProgressEvent(worker = self, **kw))
+        except RuntimeError:
+            # the handler is destroyed
+            self.cancelled = True
+            raise Cancelled()
+
+    # Like `post` but at most once per `period` seconds.
+    def progress(self, **kw):
+        self.check()
+        t = time()
+        if t - self._posted >= self.period:
+            self._posted = t
+            self.post(**kw)
+
+    def run(self):
+        result = error = None
+        cancelled = False
+        try:
+            result = self.work(self)
+        except Cancelled:
+            cancelled = True
+        except BaseException as e:
+            print_exc()
+            error = e
+        try:
+            PostEvent(self.handler, WorkDoneEvent(
+                worker = self,
+                result = result,
+                error = error,
+                cancelled = cancelled
+            ))
+        except RuntimeError:
+            pass
 
 
-class Strip(object):
+class TaskDialog(Dialog):
+    """Shows progress of `work` ran by a `Worker`, "Cancel" button cancels
+it. The dialog is destroyed when the work is done, then `onDone` is called
+with `WorkDoneEvent`."""
 
-    def __init__(self, c):
-        self.commits = [c]
-        start_j = c._j
-        self.start_j = start_j
-        self.end_j = start_j
+    def __init__(self, parent, title, work, onDone):
+        super(TaskDialog, self).__init__(parent, title = title)
+        self.onDone = onDone
 
-    def bind(self, c):
-        self.commits.append(c)
-        self.end_j = max(c._j, self.end_j)
+        sizer = BoxSizer(VERTICAL)
+        self.text = StaticText(self, label = title + "...", size = (500, -1))
+        sizer.Add(self.text, 1, EXPAND)
+        self.cancel = Button(self, label = "Cancel")
+        sizer.Add(self.cancel, 0, EXPAND)
+        sizer.SetSizeHints(self)
+        self.SetSizer(sizer)
+
+        self.Bind(EVT_BUTTON, self._on_cancel, self.cancel)
+        self.Bind(EVT_CLOSE, self._on_cancel)
+        self.Bind(EVT_WORK_PROGRESS, self._on_progress)
+        self.Bind(EVT_WORK_DONE, self._on_done)
+
+        self.worker = Worker(self, work, name = title)
+        self.worker.start()
+        self.Show()
+
+    def _on_cancel(self, _):
+        # the dialog is closed when the worker stops
+        self.worker.cancel()
+        self.cancel.Enable(False)
+        self.text.SetLabel("Cancelling...")
+
+    def _on_progress(self, e):
+        if not self.worker.cancelled:
+            self.text.SetLabel(e.text)
+
+    def _on_done(self, e):
+        self.Destroy()
+        self.onDone(e)
+
+
+# Returns [(timestamp, hexsha, blob id, size)] of snapshots of `storage`
+# (not opened) changing `relN`, the newest first. `check` is called per not
+# indexed snapshot.
+def file_history(storage, relN, check = None):
+    storage.open(readOnly = True)
+    try:
+        pathIndexFile = storage.path_index_file()
+        if pathIndexFile is None:
+            raise RuntimeError("History of files is not supported")
+        pathIndex = PathIndex.of(pathIndexFile)
+        pathIndex.update(storage, check)
+        return pathIndex.history(relN)
+    finally:
+        storage.close()
+
+
+# Returns text describing difference between snapshots `old` (SHA1 or
+# prefix, the current one if `None`) and `new` of `storage` (not opened).
+# Changes of at most `summaries` files are summarized by their content.
+def compare_snapshots(storage, old, new, summaries = 0, limit = None,
+    check = None
+):
+    storage.open(readOnly = True)
+    try:
+        reader = HistoryReader(storage)
+        if old is None:
+            oldSnapshot = storage.current()
+        else:
+            oldSnapshot = reader.snapshot_of(old)
+        newSnapshot = reader.snapshot_of(new)
+
+        changes = storage.diff(oldSnapshot, newSnapshot)
+        if not changes:
+            return "Same content"
+
+        lines = []
+        added = removed = 0
+        for key, oldSize, newSize in changes:
+            if oldSize is None:
+                added += 1
+            elif newSize is None:
+                removed += 1
+            if limit is not None and len(lines) >= limit:
+                continue
+            if oldSize is None:
+                line = "+ %s (%u bytes)" % (key, newSize)
+            elif newSize is None:
+                line = "- %s (%u bytes)" % (key, oldSize)
+            else:
+                line = "M %s (%u -> %u bytes)" % (key, oldSize, newSize)
+                if summaries > 0:
+                    if check is not None:
+                        check()
+                    summaries -= 1
+                    summary = reader.compare(key, oldSnapshot, newSnapshot)
+                    if summary is not None:
+                        line += ": " + summary
+            lines.append(line)
+        if len(lines) < len(changes):
+            lines.append("... %u more" % (len(changes) - len(lines)))
+        lines.append("%u added, %u removed, %u changed" % (
+            added, removed, len(changes) - added - removed
+        ))
+        return "\n".join(lines)
+    finally:
+        storage.close()
+
+
+# Posts history of `storage` to `BackupSelector` by batches of `Commit`s.
+def load_history(storage, worker, period = 0.1):
+    storage.open(readOnly = True)
+    try:
+        cur = storage.current()
+        current = None if cur is None else cur.hexsha
+        batch = []
+        posted = time()
+        for snapshot in storage.iter_history():
+            worker.check()
+            batch.append(Commit(snapshot))
+            t = time()
+            if t - posted >= period:
+                worker.post(current = current, commits = batch)
+                batch = []
+                posted = t
+        worker.post(current = current, commits = batch)
+    finally:
+        storage.close()
 
 
 CommitSelectedEvent, EVT_COMMIT_SELECTED = NewEvent()
 
 class GitSelector(Control):
+    """History graph, the newest snapshot is on the top. Commits are added by
+`add_commits` as they are loaded, a commit must be added after its
+children. A filter shows only some commits as a list."""
 
-    def __init__(self, parent, repo_dir, **kw):
+    def __init__(self, parent, **kw):
         super(GitSelector, self).__init__(parent, **kw)
 
         self._scrollbar = None
         self.height = 300
 
-        self.repo_dir = repo_dir
-
         self.scale, self.xshift, self.yshift = 4, 8, -8
         self.half_step = 1 << (self.scale - 1)
         self.text_offset_x = 8
 
-        self.read_repo()
+        # all added
+        self.commits = []
+        # hexsha -> note of shown commit, `None` - all commits are shown
+        self.filter = None
+        # row -> Commit
+        self.index = {}
+        self.lines = []
+        self.max_y = self.yshift
+        # hexsha of a commit expected in the lane (column) or `None`
+        self.lanes = []
+        # hexsha -> added children of a not yet added commit
+        self.children = {}
+        self.currentSha = None
+        self.current = None
+        # scroll to current commit when it's added
+        self._follow = True
 
         self.Bind(EVT_MOTION, self._on_mouse_motion)
         self._hl = None
@@ -603,78 +4633,95 @@ class GitSelector(Control):
         self.Bind(EVT_PAINT, self._on_paint)
 
         self._scroll = 0
-        self.scroll = self.current._y - self.half_step
         self.Bind(EVT_MOUSEWHEEL, self._on_mouse_wheel)
 
         self.Bind(EVT_ENTER_WINDOW, self._on_enter_window)
 
-    def read_repo(self):
-        try:
-            repo = Repo(self.repo_dir)
-        except:
-            print("Cannot refresh backup")
-            print(format_exc())
-            return
-
-        self.repo = repo
+    def __len__(self):
+        return len(self.commits)
 
-        heads = []
+    def add_commits(self, commits):
+        self.commits.extend(commits)
+        self._place(commits)
 
-        Commit.graph = graph = GitGraph()
+    def set_filter(self, filter):
+        self.filter = filter
+        self.index = {}
+        self.lines = []
+        self.lanes = []
+        self.children = {}
+        self.current = None
+        self._hl = None
+        self._follow = True
+        self._scroll = 0
+        self._place(self.commits)
 
-        for head in repo.heads:
-            c = Commit(head.commit)
-            if c in heads:
+    def _place(self, commits):
+        index, lines, lanes, children = (
+            self.index, self.lines, self.lanes, self.children
+        )
+        scale, xshift, yshift = self.scale, self.xshift, self.yshift
+        filter = self.filter
+
+        for c in commits:
+            hexsha = c.hexsha
+
+            if filter is not None:
+                if hexsha in filter:
+                    j = len(index) + 1
+                    index[j] = c
+                    c._x = xshift
+                    c._y = (j << scale) + yshift
+                    if hexsha == self.currentSha:
+                        self.current = c
                 continue
-            heads.append(c)
-
-        build_commit_graph(*heads)
 
-        # layout commits
-        stripes = []
-        for j, c in enumerate(graph.iter_commits()):
-            c._j = j
-            parents = c.parents
-
-            for p in parents:
+            # take a lane of a child, free lanes of other children
+            i = None
+            for k, expected in enumerate(lanes):
+                if expected == hexsha:
+                    lanes[k] = None
+                    if i is None:
+                        i = k
+            if i is None:
                 try:
-                    s = p._s
-                except AttributeError:
-                    # p's strip is already stolen by another child
+                    i = lanes.index(None)
+                except ValueError:
+                    i = len(lanes)
+                    lanes.append(None)
+
+            j = len(index) + 1
+            index[j] = c
+            c._x = (i << scale) + xshift
+            c._y = (j << scale) + yshift
+
+            for child in children.pop(hexsha, ()):
+                lines.append([c._x, c._y, child._x, child._y])
+
+            for n, p in enumerate(c.parentShas):
+                children.setdefault(p, []).append(c)
+                if p in lanes:
                     continue
+                if n == 0:
+                    lanes[i] = p
                 else:
-                    del p._s
-                    s.bind(c)
-                    c._s = s
-                    break
-            else:
-                # No free strip or c is root
-                c._s = s = Strip(c)
-                stripes.append(s)
-
-        for i, s in enumerate(stripes):
-            for c in s.commits:
-                c._i = i
+                    try:
+                        lanes[lanes.index(None)] = p
+                    except ValueError:
+                        lanes.append(p)
 
-        # self.g_width = i + 1
+            if hexsha == self.currentSha:
+                self.current = c
 
-        # assign coordinates
-        self.index = index = {}
-        max_j = len(graph.cache)
-        scale, xshift, yshift = self.scale, self.xshift, self.yshift
-        self.lines = lines = []
-        for c in graph.iter_commits():
-            c._x = (c._i << scale) + xshift
-            # graph grows to the top
-            inv_j = max_j - c._j
-            index[inv_j] = c
-            c._y = (inv_j << scale) + yshift
-            for p in c.parents:
-                lines.append([p._x, p._y, c._x, c._y])
+        self.max_y = (len(index) << scale) + yshift
+        self._update_scrollbar()
 
-        self.max_y = (max_j << scale) + yshift
+        cur = self.current
+        if self._follow and cur is not None:
+            self._follow = False
+            self.scroll = cur._y - self.half_step
 
-        self.current = graph[repo.active_branch.commit]
+        self.Refresh()
 
     @property
     def max_scroll(self):
@@ -695,6 +4742,7 @@ class GitSelector(Control):
         self.Refresh()
 
     def _on_mouse_wheel(self, e):
+        self._follow = False
         self.scroll -= e.GetWheelRotation()
 
     @property
@@ -711,23 +4759,25 @@ class GitSelector(Control):
         self._scrollbar = sb
         if sb is None:
             return
-        h = self.height
-        sb.SetScrollbar(self._scroll, h, self.max_scroll + h, h)
+        self._update_scrollbar()
         sb.Bind(EVT_SCROLL, self._on_scroll)
 
+    def _update_scrollbar(self):
+        sb = self._scrollbar
+        if sb:
+            h = self.height
+            sb.SetScrollbar(self._scroll, h, self.max_scroll + h, h)
+
     def _on_scroll(self, e):
+        self._follow = False
         self.scroll = e.GetPosition()
 
     def _on_size(self, event):
         event.Skip()
-        h = self.GetClientSize()[1]
-        self.height = h
+        self.height = self.GetClientSize()[1]
 
         # update scrolling
-        if self._scrollbar:
-            self._scrollbar.SetScrollbar(self._scroll, h, self.max_scroll + h,
-                h
-            )
+        self._update_scrollbar()
         self.scroll = self._scroll
 
         self.Refresh()
@@ -799,14 +4849,29 @@ class GitSelector(Control):
 
         hl, cur = self._hl, self.current
 
+        # only visible part of history is drawn
+        top = self.scroll - self.half_step
+        bottom = self.scroll + self.height + self.half_step
+
         for x1, y1, x2, y2 in self.lines:
+            if y1 < top and y2 < top or y1 > bottom and y2 > bottom:
+                continue
             dc.DrawLine(x1, y1 + scroll, x2, y2 + scroll)
 
         br = dc.GetBackground()
         prev_c = br.GetColour()
         revert_color = False
 
-        for c in Commit.graph.iter_commits():
+        index = self.index
+        filter = self.filter
+        scale, yshift = self.scale, self.yshift
+        for j in range(max(1, (top - yshift) >> scale),
+            ((bottom - yshift) >> scale) + 1
+        ):
+            c = index.get(j)
+            if c is None:
+                break
+
             while True:
                 if c is cur:
                     br.SetColour((0, 255, 0, 255))
@@ -821,8 +4886,12 @@ class GitSelector(Control):
             x = c._x
             y = c._y
 
+            label = c.label
+            if filter is not None:
+                label += " | " + filter[c.hexsha]
+
             dc.DrawCircle(x, y + scroll, 4)
-            dc.DrawText(c.label, x + text_offset_x, y + scroll + text_shift)
+            dc.DrawText(label, x + text_offset_x, y + scroll + text_shift)
 
             if revert_color:
                 br.SetColour(prev_c)
@@ -834,33 +4903,165 @@ class GitSelector(Control):
 
 
 class BackupSelector(Dialog):
+    "History of `storage` (not opened) is loaded by a `Worker`."
 
-    def __init__(self, parent, backupDir):
+    def __init__(self, parent, storage):
         super(Dialog, self).__init__(parent,
             style = DEFAULT_DIALOG_STYLE | RESIZE_BORDER
         )
         self.SetMinSize((300, 300))
 
-        sizer = BoxSizer(HORIZONTAL)
+        sizer = BoxSizer(VERTICAL)
 
-        selector = GitSelector(self, backupDir, size = (700, 500))
-        sizer.Add(selector, 1, EXPAND)
+        graphSizer = BoxSizer(HORIZONTAL)
+
+        self.selector = selector = GitSelector(self, size = (700, 500))
+        graphSizer.Add(selector, 1, EXPAND)
 
         scrollbar = ScrollBar(self, style = SB_VERTICAL)
         selector.scrollbar = scrollbar
-        sizer.Add(scrollbar, 0, EXPAND)
+        graphSizer.Add(scrollbar, 0, EXPAND)
+
+        sizer.Add(graphSizer, 1, EXPAND)
+
+        fileSizer = BoxSizer(HORIZONTAL)
+        fileSizer.Add(StaticText(self, label = "File"), 0, EXPAND)
+        self.file = TextCtrl(self)
+        self.file.SetToolTip("Show only versions changing that file"
+            " (relative to save directory), empty - show all versions"
+        )
+        fileSizer.Add(self.file, 1, EXPAND)
+        self.filterButton = Button(self, label = "Filter")
+        self.Bind(EVT_BUTTON, self._on_filter, self.filterButton)
+        fileSizer.Add(self.filterButton, 0, EXPAND)
+        sizer.Add(fileSizer, 0, EXPAND)
+
+        statusSizer = BoxSizer(HORIZONTAL)
+        self.status = StaticText(self, label = "Loading history...")
+        statusSizer.Add(self.status, 1, EXPAND)
+        cancel = Button(self, label = "Cancel")
+        self.Bind(EVT_BUTTON, self._on_cancel, cancel)
+        statusSizer.Add(cancel, 0, EXPAND)
+        sizer.Add(statusSizer, 0, EXPAND)
 
         sizer.SetSizeHints(self)
         self.SetSizer(sizer)
 
         selector.Bind(EVT_COMMIT_SELECTED, self._on_commit_selected)
 
+        self.Bind(EVT_WORK_PROGRESS, self._on_history)
+        self.Bind(EVT_WORK_DONE, self._on_work_done)
+        self.loader = Worker(self,
+            lambda worker : load_history(storage, worker),
+            name = "History Loader"
+        )
+        self.loader.start()
+
+        # another instance of the storage, `loader` uses the first one
+        self.newStorage = lambda : type(storage)(storage.backupDir)
+        self.filterer = None
+        self.comparer = None
+
+    def Destroy(self):
+        self.loader.cancel()
+        if self.filterer is not None:
+            self.filterer.cancel()
+        if self.comparer is not None:
+            self.comparer.cancel()
+        return super(BackupSelector, self).Destroy()
+
+    def _on_filter(self, _):
+        relN = self.file.GetValue().strip()
+        if not relN:
+            self.selector.set_filter(None)
+            return
+
+        storage = self.newStorage()
+        self.filterButton.Enable(False)
+        self.status.SetLabel("Looking for versions of '%s'..." % relN)
+        self.filterer = Worker(self,
+            lambda worker : file_history(storage, relN, worker.check),
+            name = "File History"
+        )
+        self.filterer.start()
+
+    def _on_work_done(self, e):
+        if e.worker is self.loader:
+            self._on_history_done(e)
+        elif e.worker is self.filterer:
+            self._on_filter_done(e)
+        elif e.worker is self.comparer:
+            self._on_compare_done(e)
+
+    def _on_filter_done(self, e):
+        self.filterer = None
+        self.filterButton.Enable(True)
+        if e.error is not None:
+            self.status.SetLabel("Cannot filter: %s" % e.error)
+            return
+        if e.cancelled:
+            return
+
+        self.selector.set_filter(dict(
+            (hexsha, "removed" if blobId is None else "%u bytes" % size)
+                for _, hexsha, blobId, size in e.result
+        ))
+        self.status.SetLabel("%u versions change the file, %u are loaded" % (
+            len(e.result), len(self.selector.index)
+        ))
+
+    def _on_history(self, e):
+        selector = self.selector
+        selector.currentSha = e.current
+        selector.add_commits(e.commits)
+        self.status.SetLabel("Loading history... %u versions" % len(selector))
+
+    def _on_history_done(self, e):
+        n = len(self.selector)
+        if e.error is not None:
+            self.status.SetLabel("Cannot load history: %s" % e.error)
+        elif e.cancelled:
+            self.status.SetLabel("Loading is cancelled, %u versions" % n)
+        else:
+            self.status.SetLabel("%u versions" % n)
+
+    def _on_cancel(self, _):
+        self.loader.cancel()
+        self.EndModal(ID_CANCEL)
+
     def _on_commit_selected(self, e):
+        if self.comparer is not None:
+            return
+
         c = e.commit
+        storage = self.newStorage()
+        self.status.SetLabel("Comparing with current version...")
+        self.comparer = Worker(self,
+            lambda worker : compare_snapshots(storage, None, c.hexsha,
+                summaries = 10,
+                limit = 20,
+                check = worker.check
+            ),
+            name = "Comparer"
+        )
+        self.comparer.commit = c
+        self.comparer.start()
+
+    def _on_compare_done(self, e):
+        c = e.worker.commit
+        self.comparer = None
+        if e.cancelled:
+            return
+        if e.error is not None:
+            diff = "Cannot compare: %s" % e.error
+        else:
+            diff = e.result
+        self.status.SetLabel("%u versions" % len(self.selector))
 
         dlg = MessageDialog(self,
             "Do you want to switch to that version?\n\n" +
-            "SHA1: %s\n\n%s\n\n" % (c.backed.hexsha, c.label) +
+            "SHA1: %s\n\n%s\n\n" % (c.hexsha, c.label) +
+            "Changes against current version:\n%s\n\n" % diff +
             "Files in both save and backup directories will be overwritten!",
             "Confirmation is required",
             YES_NO
@@ -870,13 +5071,16 @@ class BackupSelector(Dialog):
         if not switch:
             return
 
+        self.loader.cancel()
         self.target = c.backed
         self.EndModal(ID_OK)
 
 
 class SaveSettings(object):
 
-    def __init__(self, master, saveDirVal = None, backupDirVal = None):
+    def __init__(self, master, saveDirVal = None, backupDirVal = None,
+        storageVal = None, ignoreVal = None, lowImpactVal = False
+    ):
         self.master = master
 
         saveDirSizer = BoxSizer(HORIZONTAL)
@@ -907,10 +5111,13 @@ class SaveSettings(object):
             EXPAND
         )
         backupDirSizer.Add(self.backupDir, 1, EXPAND)
+        self.storage = Choice(master, choices = list(STORAGES))
+        self.storage.SetStringSelection(storageVal or "git")
+        backupDirSizer.Add(self.storage, 0, EXPAND)
         switch = Button(master, label = "Switch")
         master.Bind(EVT_BUTTON, self._on_switch, switch)
         backupDirSizer.Add(switch, 0, EXPAND)
-        override = Button(master, label = "Overwrite")
+        self.override = override = Button(master, label = "Overwrite")
         master.Bind(EVT_BUTTON, self._on_overwrite, override)
         backupDirSizer.Add(override, 0, EXPAND)
         selectBackupDir = Button(master, -1, "Select")
@@ -923,65 +5130,115 @@ class SaveSettings(object):
         filterOutSizer = BoxSizer(HORIZONTAL)
         filterOutSizer.Add(StaticText(master, label = "Filter Out"), 0, EXPAND)
         self.filterOut = TextCtrl(master)
+        self.filterOut.SetToolTip("Python's regular expression")
         filterOutSizer.Add(self.filterOut, 1, EXPAND)
+        filterOutSizer.Add(StaticText(master, label = "Ignore"), 0, EXPAND)
+        self.ignore = TextCtrl(master)
+        if ignoreVal:
+            self.ignore.SetValue(ignoreVal)
+        self.ignore.SetToolTip("gitignore-style patterns separated by ';'"
+            " (e.g. 'shadercache/; *.tmp; !keep.tmp')"
+        )
+        filterOutSizer.Add(self.ignore, 1, EXPAND)
 
         self.cbMonitor = CheckBox(master, label = "Monitor")
         master.Bind(EVT_CHECKBOX, self._on_monitor, self.cbMonitor)
+        self.cbLowImpact = CheckBox(master, label = "Low impact")
+        self.cbLowImpact.SetValue(bool(lowImpactVal))
+        self.cbLowImpact.SetToolTip("Back up slowly with low priority,"
+            " in favor of the game"
+        )
+
+        monitorSizer = BoxSizer(HORIZONTAL)
+        monitorSizer.Add(self.cbMonitor, 0, EXPAND)
+        monitorSizer.Add(self.cbLowImpact, 0, EXPAND)
 
         self.sizer = sizer = BoxSizer(VERTICAL)
         sizer.Add(saveDirSizer, 0, EXPAND)
         sizer.Add(backupDirSizer, 0, EXPAND)
         sizer.Add(filterOutSizer, 0, EXPAND)
-        sizer.Add(self.cbMonitor, 0, EXPAND)
+        sizer.Add(monitorSizer, 0, EXPAND)
 
         self.settingsWidgets = [
             selectSaveDir,
             self.saveDir,
             self.backupDir,
+            self.storage,
             switch,
             selectBackupDir,
-            self.filterOut
+            self.filterOut,
+            self.ignore,
+            self.cbLowImpact
         ]
 
+        # `TaskDialog` working with backup
+        self.task = None
+
     def _on_overwrite(self, _):
         self.ask_and_overwrite()
 
+    def make_storage(self):
+        return STORAGES[self.storage.GetStringSelection()](
+            self.backupDir.GetValue()
+        )
+
+    # Runs `work` by a `Worker`, the backup must not be used meanwhile.
+    # `onResult` is called with result of `work` unless it fails or is
+    # cancelled.
+    def _run_task(self, title, work, onResult, onCancel = None):
+        self._disable_settings()
+        self.cbMonitor.Enable(False)
+        self.override.Enable(False)
+
+        def on_done(e):
+            self.task = None
+            if not self.cbMonitor.IsChecked():
+                self._enable_settings()
+            self.cbMonitor.Enable(True)
+            self.override.Enable(True)
+
+            if e.error is not None:
+                with MessageDialog(self.master, str(e.error), "Error") as dlg:
+                    dlg.ShowModal()
+            elif e.cancelled:
+                if onCancel is not None:
+                    onCancel()
+            else:
+                onResult(e.result)
+
+        self.task = TaskDialog(self.master, title, work, on_done)
+
     def ask_and_overwrite(self):
         backupDir = self.backupDir.GetValue()
         savePath = self.saveDir.GetValue()
         if not (isdir(backupDir) and bool(savePath)):
             with MessageDialog(self.master, "Set paths up!", "Error") as dlg:
                 dlg.ShowModal()
-            return False
-
-        repo = Repo(backupDir)
-        if repo.is_dirty():
-            with MessageDialog(self.master,
-                "Backup repository '%s' is dirty" % backupDir,
-                "Error") as dlg:
-                dlg.ShowModal()
-            return False
-
-        active_branch = repo.active_branch
+            return
 
-        try:
-            c = active_branch.commit
-        except Exception as e:
-            hint = ""
+        storage = self.make_storage()
 
+        def work(worker):
+            worker.post(text = "Checking backup '%s'" % backupDir)
+            storage.open()
             try:
-                if active_branch.name == "master":
-                    hint = "Is backup empty?"
-            except:
-                pass
+                if storage.is_dirty():
+                    raise RuntimeError(
+                        "Backup repository '%s' is dirty" % backupDir
+                    )
+                c = storage.current()
+                if c is None:
+                    raise RuntimeError("No backed up version\n"
+                        "Is backup empty?"
+                    )
+                return c, commit_time_str(c) + " | " + c.message
+            finally:
+                storage.close()
 
-            with MessageDialog(self.master,
-                str(e) + "\n" + hint,
-                "Error") as dlg:
-                dlg.ShowModal()
-            return False
+        self._run_task("Checking backup", work, self._on_overwrite_checked)
 
-        label = commit_time_str(c) + " | " + c.message
+    def _on_overwrite_checked(self, current):
+        c, label = current
 
         dlg = MessageDialog(self.master,
             "Do you want to overwrite save data with current version?\n\n" +
@@ -993,93 +5250,53 @@ class SaveSettings(object):
         switch = dlg.ShowModal() == ID_YES
         dlg.Destroy()
         if not switch:
-            return False
+            return
 
         self._switch_to(c)
-        return True
 
     def _on_switch(self, _):
         backupDir = self.backupDir.GetValue()
         if not isdir(backupDir):
             return
-        with BackupSelector(self.master, backupDir) as dlg:
+
+        with BackupSelector(self.master, self.make_storage()) as dlg:
             res = dlg.ShowModal()
             if res != ID_OK:
                 return
             target = dlg.target
 
-        try:
-            self._switch_to(target)
-        except BaseException as e:
-            with MessageDialog(self.master, str(e), "Error") as dlg:
-                dlg.ShowModal()
+        self._switch_to(target)
 
     def _switch_to(self, target):
-        repo = Repo(self.backupDir.GetValue())
-
-        if repo.is_dirty():
-            raise RuntimeError("Backup repository is dirty")
-
-        active = repo.active_branch
-        cur = active.commit
-
-        if cur.hexsha != target.hexsha:
-            # select name for backup branch
-            backups = []
-            need_head = True
-            for h in repo.heads:
-                mi = backup_re.match(h.name)
-                if mi:
-                    backups.append(int(mi.group(1), base = 10))
-                    if h.commit.hexsha == cur.hexsha:
-                        need_head = False
-
-            if backups:
-                n = max(backups) + 1
-            else:
-                n = 0
-
-            # TODO: do not set branch if commits are reachable (other
-            # branch exists)
-
-            # setup backup branch and checkout new version
-            if need_head:
-                back_head = repo.create_head("backup_%u" % n, cur)
+        storage = self.make_storage()
+        saveDir = self.saveDir.GetValue()
+        hexsha = target.hexsha
 
+        def work(worker):
+            worker.post(text = "Switching backup to %s" % hexsha)
+            storage.open()
             try:
-                active.commit = target
-                try:
-                    active.checkout(True)
-                except:
-                    active.commit = cur
-                    raise
-            except:
-                if need_head:
-                    repo.delete_head(back_head)
-                raise
+                storage.checkout(storage.snapshot(hexsha), saveDir,
+                    progress = lambda relN : worker.progress(
+                        text = "Restoring " + relN
+                    )
+                )
+            finally:
+                storage.close()
 
-        save_path = self.saveDir.GetValue()
+        self._run_task("Restoring", work, self._on_restored,
+            onCancel = self._on_restore_cancelled
+        )
 
-        # remove files of current
-        stack = [cur.tree]
-        while stack:
-            node = stack.pop()
-            for b in node.blobs:
-                b_path = join(save_path, b.path)
-                if exists(b_path):
-                    remove(b_path)
-            stack.extend(node.trees)
+    def _on_restored(self, _):
+        print("Save directory '%s' is restored" % self.saveDir.GetValue())
 
-        # copy files from target
-        stack = [target.tree]
-        while stack:
-            node = stack.pop()
-            for b in node.blobs:
-                b_path = join(save_path, b.path)
-                makedirs(dirname(b_path), exist_ok = True)
-                with open(b_path, "wb+") as f:
-                    b.stream_data(f)
-            stack.extend(node.trees)
+    def _on_restore_cancelled(self):
+        with MessageDialog(self.master,
+            "Restoring is cancelled, save directory may be incomplete.\n"
+            "Use \"Overwrite\" to restore current version.",
+            "Warning") as dlg:
+            dlg.ShowModal()
 
     def _open_dir(self, path):
         if exists(path):
@@ -1204,11 +5421,14 @@ class SaveSettings(object):
                             self._enable_settings()
                             return
 
-            mt = MonitorThread(root, lambda : root2threads.pop(root))
-            bt = BackUpThread(root, backup, mt.changes, filterOutRe)
-            root2threads[root] = (mt, bt)
-            mt.start()
-            bt.start()
+            pathFilter = PathFilter.parse(self.ignore.GetValue(),
+                regex = filterOutRe
+            )
+            start_backup(root2threads, root, backup,
+                storage = self.storage.GetStringSelection(),
+                pathFilter = pathFilter,
+                lowImpact = self.cbLowImpact.GetValue()
+            )
         else:
             self._enable_settings()
 
@@ -1225,8 +5445,47 @@ class SaveSettings(object):
             self.saveDir.GetValue(),
             self.backupDir.GetValue(),
             self.filterOut.GetValue(),
+            self.storage.GetStringSelection(),
+            self.ignore.GetValue(),
+            self.cbLowImpact.GetValue(),
+        )
+
+
+class MetricsDialog(Dialog):
+
+    def __init__(self, parent, period = 1000):
+        super(MetricsDialog, self).__init__(parent,
+            title = "Metrics",
+            style = DEFAULT_DIALOG_STYLE | RESIZE_BORDER
         )
 
+        sizer = BoxSizer(VERTICAL)
+        self.text = TextCtrl(self,
+            size = (700, 500),
+            style = TE_MULTILINE | TE_READONLY | HSCROLL
+        )
+        sizer.Add(self.text, 1, EXPAND)
+        sizer.SetSizeHints(self)
+        self.SetSizer(sizer)
+
+        self._refresh()
+        self.timer = Timer(self)
+        self.Bind(EVT_TIMER, self._on_timer, self.timer)
+        self.timer.Start(period)
+        self.Bind(EVT_CLOSE, self._on_close, self)
+
+    def _refresh(self):
+        text = metrics.prometheus()
+        if text != self.text.GetValue():
+            self.text.ChangeValue(text)
+
+    def _on_timer(self, _):
+        self._refresh()
+
+    def _on_close(self, _):
+        self.timer.Stop()
+        self.Destroy()
+
 
 SHOW_TITLE_LIMIT = 100
 
@@ -1235,6 +5494,11 @@ class SaveMonitor(Frame):
     def __init__(self,
         logging = False,
         logFile = None,
+        logLevel = "INFO",
+        logMaxSize = 10 << 20,
+        logBackups = 3,
+        tracing = False,
+        traceFile = None,
     ):
         super(SaveMonitor, self).__init__(None,
             title = "Game Save Monitor"
@@ -1263,6 +5527,24 @@ class SaveMonitor(Frame):
         )
         self.Bind(EVT_MENU, self._on_log, self.loggingItem)
 
+        metricsItem = debugMenu.Append(ID_ANY, "&Metrics",
+            "Show metrics of monitoring and backing up"
+        )
+        self.Bind(EVT_MENU, self._on_metrics, metricsItem)
+
+        dedupItem = debugMenu.Append(ID_ANY, "&Deduplication",
+            "Report content which is same in backups"
+        )
+        self.Bind(EVT_MENU, self._on_dedup_report, dedupItem)
+
+        self.tracingItem = debugMenu.Append(ID_ANY,
+            "&Tracing",
+            "Record timings of backing up stages, the trace is saved when"
+            " unchecked",
+            ITEM_CHECK
+        )
+        self.Bind(EVT_MENU, self._on_tracing, self.tracingItem)
+
         aboutMenu = Menu()
         aboutItem = aboutMenu.Append(ID_ABOUT,
             "&About", "Information about this program"
@@ -1282,12 +5564,17 @@ class SaveMonitor(Frame):
 
         self.Bind(EVT_CLOSE, self._on_close, self)
 
+        logPipeline.level = LEVELS.get(logLevel, INFO)
+
         self._logFile = logFile
         if logFile is None:
             stream = NullStream()
         else:
             try:
-                stream = open(logFile, "a+")
+                stream = RotatingFile(logFile,
+                    maxSize = logMaxSize,
+                    backups = logBackups
+                )
             except:
                 print_exc()
                 print("Cannot log to %s" % logFile)
@@ -1297,6 +5584,9 @@ class SaveMonitor(Frame):
 
         self.logging = logging
 
+        self.traceFile = traceFile
+        self.tracing = tracing
+
     @property
     def logFile(self):
         return self._logFile
@@ -1312,15 +5602,62 @@ class SaveMonitor(Frame):
         self._logging = logging
         self.loggingItem.Check(logging)
 
-        global globalLogStream
         if logging:
-            globalLogStream = self._logStream
+            logPipeline.set_file(self._logStream)
         else:
-            globalLogStream = nullStream
+            logPipeline.set_file(None)
 
     def _on_log(self, __):
         self.logging = self.loggingItem.IsChecked()
 
+    @property
+    def tracing(self):
+        return tracer.enabled
+
+    @tracing.setter
+    def tracing(self, tracing):
+        self.tracingItem.Check(tracing)
+        if tracing == tracer.enabled:
+            return
+        tracer.enabled = tracing
+        if not tracing:
+            self.save_trace()
+
+    def save_trace(self):
+        if not self.traceFile:
+            return
+        try:
+            tracer.save(self.traceFile)
+        except:
+            print_exc()
+            print("Cannot save trace to %s" % self.traceFile)
+
+    def _on_tracing(self, __):
+        self.tracing = self.tracingItem.IsChecked()
+
+    def _on_metrics(self, __):
+        MetricsDialog(self).Show()
+
+    def _on_dedup_report(self, __):
+        storages = saved_storages(s.saveData for s in self.settings)
+
+        def work(worker):
+            return dedup_report(storages,
+                progress = lambda name : worker.post(text = "Reading " + name)
+            )
+
+        def on_done(e):
+            if e.error is not None:
+                text = "Cannot make report: %s" % e.error
+            elif e.cancelled:
+                return
+            else:
+                text = e.result
+            with MessageDialog(self, text, "Deduplication") as dlg:
+                dlg.ShowModal()
+
+        TaskDialog(self, "Deduplication report", work, on_done)
+
     def _on_add(self, _):
         self._add_settings(SaveSettings(self), False)
 
@@ -1360,11 +5697,17 @@ class SaveMonitor(Frame):
 
     def add_settings(self, saveDirVal, backupDirVal,
         filterOutVal = None,
+        storageVal = None,
+        ignoreVal = None,
+        lowImpactVal = False,
         hidden = False
     ):
         settings = SaveSettings(self,
             saveDirVal = saveDirVal,
-            backupDirVal = backupDirVal
+            backupDirVal = backupDirVal,
+            storageVal = storageVal,
+            ignoreVal = ignoreVal,
+            lowImpactVal = lowImpactVal
         )
         if filterOutVal is not None:
             settings.filterOut.SetValue(filterOutVal)
@@ -1379,6 +5722,14 @@ class SaveMonitor(Frame):
         self.mainSizer.SetSizeHints(self)
 
     def _on_close(self, e):
+        if e.CanVeto() and any(s.task for s in self.settings):
+            with MessageDialog(self,
+                "Wait until restoring is finished or cancel it.",
+                "Backup is in use") as dlg:
+                dlg.ShowModal()
+            e.Veto()
+            return
+
         for threads in list(self.root2threads.values()):
             for t in threads:
                 t.exit_request = True
@@ -1390,8 +5741,10 @@ class SaveMonitor(Frame):
         )
         e.Skip()
 
-        global globalLogStream
-        globalLogStream = nullStream
+        if self.tracing:
+            self.save_trace()
+
+        logPipeline.set_file(None)
         self._logStream.close()
 
     def _on_about(self, _):
@@ -1406,19 +5759,288 @@ class SaveMonitor(Frame):
         dlg.Destroy()
 
 
+def headless(s):
+    logPipeline.level = LEVELS.get(s.logLevel, INFO)
+    if s.logging:
+        try:
+            logPipeline.set_file(RotatingFile(s.logFile,
+                maxSize = s.logMaxSize,
+                backups = s.logBackups
+            ))
+        except:
+            print_exc()
+            print("Cannot log to %s" % s.logFile)
+
+    root2threads = {}
+    try:
+        serve_control(root2threads, s.controlSocket, s.controlPort)
+    except:
+        print_exc()
+        print("Cannot accept control commands")
+
+    for save in s.saves:
+        start_save(root2threads, *save)
+
+    print("Press Ctrl+C to stop")
+    try:
+        while root2threads:
+            sleep(0.5)
+    except KeyboardInterrupt:
+        pass
+
+    threads = list(root2threads.values())
+    for mt, bt in threads:
+        mt.exit_request = True
+        bt.exit_request = True
+    for _, bt in threads:
+        bt.join()
+
+    logPipeline.set_file(None)
+
+
 def main():
-    app = App()
+    ap = ArgumentParser(
+        description = "Monitors save directories and backs up changes."
+    )
+    ap.add_argument("--headless", action = "store_true",
+        help = "back up all saves from settings without window until Ctrl+C"
+    )
+    ap.add_argument("--dedup-report", action = "store_true",
+        help = "print how much content is same in backups"
+    )
+    ap.add_argument("--cat", metavar = "FILE",
+        help = "write backed up version of FILE (relative to save"
+            " directory) of --backup without checkout"
+    )
+    ap.add_argument("--log", metavar = "FILE",
+        help = "list backed up versions of FILE (relative to save directory)"
+            " of --backup"
+    )
+    ap.add_argument("--diff", metavar = "SHA1", nargs = "+",
+        help = "list files differing in two versions of --backup (SHA1 or"
+            " unique prefix), the current version is compared if one is given"
+    )
+    ap.add_argument("--summary", type = int, default = 0, metavar = "N",
+        help = "--diff also summarizes content changes of first N files"
+    )
+    ap.add_argument("--export", metavar = "SHA1", nargs = "?", const = "",
+        help = "write files of that version (the current one by default) of"
+            " --backup as a tar archive to --output or standard output"
+    )
+    ap.add_argument("--compress", choices = sorted(TAR_COMPRESSORS),
+        help = "--export compression, by default it's chosen by --output"
+            " extension"
+    )
+    ap.add_argument("--import", dest = "import_", metavar = "ARCHIVE",
+        help = "back up files of tar ARCHIVE (\"-\" - standard input) to"
+            " --backup as a new version, the backup must not be monitored"
+    )
+    ap.add_argument("--storage", choices = sorted(STORAGES), default = "git",
+        help = "storage of new --backup created by --import"
+    )
+    ap.add_argument("--backup", metavar = "DIRECTORY",
+        help = "backup directory for --cat, --log, --diff, --export and"
+            " --import"
+    )
+    ap.add_argument("--at", metavar = "TIME",
+        help = "--cat version as it was at TIME (ISO 8601 date or timestamp)"
+    )
+    ap.add_argument("--commit", metavar = "SHA1",
+        help = "--cat version from that snapshot (or unique prefix of SHA1)"
+    )
+    ap.add_argument("-o", "--output", metavar = "PATH",
+        help = "write --cat or --export result to that file instead of"
+            " standard output"
+    )
+    ap.add_argument("--control", metavar = "COMMAND",
+        help = "send a command to running instance and print reply:"
+            " status, flush, pause or resume, optionally followed by save"
+            " directory"
+    )
+    args = ap.parse_args()
+
+    if args.control:
+        s = Settings().__enter__()
+        try:
+            reply = send_control(args.control, s.controlSocket, s.controlPort)
+        except:
+            print_exc()
+            print("Cannot connect to running instance")
+            exit(1)
+        sys.__stdout__.write(dumps(reply, indent = 1) + "\n")
+        exit(0 if reply.get("ok") else 1)
+
+    if args.cat:
+        if not args.backup:
+            ap.error("--backup is required")
+        # standard output is for content
+        sys.stdout = LogStream(INFO, sys.__stderr__)
+        Storage.sharedStore = Settings().__enter__().sharedStore
+        try:
+            code = cat_file(args.backup, args.cat,
+                when = args.at,
+                rev = args.commit,
+                output = args.output
+            )
+        except:
+            print_exc()
+            code = 1
+        logPipeline.flush()
+        exit(code)
+
+    if args.log:
+        if not args.backup:
+            ap.error("--backup is required")
+        storage = find_storage(args.backup)
+        if storage is None:
+            print("No backup in '%s'" % args.backup)
+            exit(1)
+        Storage.sharedStore = Settings().__enter__().sharedStore
+        for timestamp, hexsha, blobId, size in file_history(storage, args.log):
+            print("%s %s %s" % (hexsha,
+                datetime.fromtimestamp(timestamp).astimezone().strftime(
+                    "%Y.%m.%d %H:%M:%S %z"
+                ),
+                "removed" if blobId is None else "%u bytes" % size
+            ))
+        logPipeline.flush()
+        return
+
+    if args.diff:
+        if not args.backup:
+            ap.error("--backup is required")
+        if len(args.diff) > 2:
+            ap.error("--diff accepts one or two versions")
+        storage = find_storage(args.backup)
+        if storage is None:
+            print("No backup in '%s'" % args.backup)
+            exit(1)
+        Storage.sharedStore = Settings().__enter__().sharedStore
+        old, new = ([None] + args.diff)[-2:]
+        try:
+            sys.__stdout__.write(compare_snapshots(storage, old, new,
+                summaries = args.summary
+            ) + "\n")
+            code = 0
+        except:
+            print_exc()
+            code = 1
+        logPipeline.flush()
+        exit(code)
+
+    if args.export is not None:
+        if not args.backup:
+            ap.error("--backup is required")
+        storage = find_storage(args.backup)
+        if storage is None:
+            print("No backup in '%s'" % args.backup)
+            exit(1)
+        compression = args.compress
+        if compression is None and args.output:
+            ext = args.output.rsplit(".", 1)[-1].lower()
+            compression = dict(tgz = "gz", txz = "xz", tbz2 = "bz2").get(ext,
+                ext if ext in TAR_COMPRESSORS else None
+            )
+        # standard output is for the archive
+        sys.stdout = LogStream(INFO, sys.__stderr__)
+        Storage.sharedStore = Settings().__enter__().sharedStore
+        if args.output:
+            f = open(args.output, "wb", buffering = 1 << 20)
+        else:
+            f = sys.__stdout__.buffer
+        try:
+            snapshot = export_snapshot(storage, f, args.export, compression)
+            print("Exported %s | %s" % (snapshot.hexsha,
+                commit_time_str(snapshot)
+            ))
+            code = 0
+        except:
+            print_exc()
+            code = 1
+        finally:
+            if args.output:
+                f.close()
+            else:
+                f.flush()
+        logPipeline.flush()
+        exit(code)
+
+    if args.import_:
+        if not args.backup:
+            ap.error("--backup is required")
+        storage = find_storage(args.backup)
+        if storage is None:
+            if not isdir(args.backup):
+                makedirs(args.backup)
+            storage = STORAGES[args.storage](args.backup)
+        Storage.sharedStore = Settings().__enter__().sharedStore
+        if args.import_ == "-":
+            f = sys.__stdin__.buffer
+            name = "standard input"
+        else:
+            f = open(args.import_, "rb", buffering = 1 << 20)
+            name = args.import_
+        try:
+            snapshot = import_archive(storage, f, "Import of " + name)
+        finally:
+            if args.import_ != "-":
+                f.close()
+        if snapshot is None:
+            print("Content is same as current")
+        else:
+            print("Imported as %s" % snapshot.hexsha)
+        logPipeline.flush()
+        return
+
+    if args.dedup_report:
+        s = Settings().__enter__()
+        Storage.sharedStore = s.sharedStore
+        sys.__stdout__.write(dedup_report(saved_storages(s.saves)) + "\n")
+        return
 
     with Settings() as s:
+        Storage.sharedStore = s.sharedStore
+        BackUpThread.stableMaxWait = s.stableMaxWait
+        BackUpThread.checkWriters = s.checkWriters
+        scheduler.slots = max(1, s.workers)
+        ioLimiter.rate = s.ioLimit
+        BackUpThread.lowImpactRate = s.lowImpactRate
+
+        if s.metricsFile:
+            MetricsFileWriter(s.metricsFile).start()
+        if s.metricsPort:
+            try:
+                serve_metrics(s.metricsPort)
+            except:
+                print_exc()
+                print("Cannot serve metrics on port %s" % s.metricsPort)
+
+        if args.headless:
+            headless(s)
+            return
+
+        app = App()
+
         mon = SaveMonitor(
             logging = s.logging,
             logFile = s.logFile,
+            logLevel = s.logLevel,
+            logMaxSize = s.logMaxSize,
+            logBackups = s.logBackups,
+            tracing = s.tracing,
+            traceFile = s.traceFile,
         )
         for i, save in enumerate(s.saves):
             mon.add_settings(*save,
                 hidden = i in s.hidden,
             )
 
+        try:
+            serve_control(mon.root2threads, s.controlSocket, s.controlPort)
+        except:
+            print_exc()
+            print("Cannot accept control commands")
+
         mon.Show(True)
 
         app.MainLoop()
@@ -1427,6 +6049,7 @@ def main():
         s.hidden = mon.hidden
         s.logging = mon.logging
         s.logFile = mon.logFile
+        s.tracing = mon.tracing
 
 
 if __name__ == "__main__":
@@ -0,0 +1,54 @@
+import sys
+from os import (
+    makedirs
+)
+from os.path import (
+    abspath,
+    dirname,
+    join
+)
+
+import pytest
+
+# `savemon.py` is a script, not an installed package
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from savemon import (
+    STORAGES
+)
+
+
+@pytest.fixture
+def saveDir(tmp_path):
+    (tmp_path / "save").mkdir()
+    return str(tmp_path / "save")
+
+
+# Each test using it runs for each storage back-end.
+@pytest.fixture(params = sorted(STORAGES))
+def storage(request, tmp_path):
+    (tmp_path / "backup").mkdir()
+    storage = STORAGES[request.param](str(tmp_path / "backup"))
+    storage.open()
+    yield storage
+    storage.close()
+
+
+# `commit(storage, {relN : content or None}, message)` writes files to
+# `saveDir` (`None` removes them) and commits them as `CommitThread` does.
+@pytest.fixture
+def commit(saveDir):
+    def commit(storage, content, message):
+        changes = []
+        for relN, data in content.items():
+            fullN = join(saveDir, relN)
+            if data is None:
+                storage.remove(relN)
+                changes.append(("remove", relN, None))
+                continue
+            makedirs(dirname(fullN), exist_ok = True)
+            with open(fullN, "wb") as f:
+                f.write(data)
+            changes.append(("add", relN, storage.stage(relN, fullN, True)))
+        return storage.commit(changes, message)
+    return commit
@@ -0,0 +1,96 @@
+from os.path import (
+    join
+)
+from io import (
+    BytesIO
+)
+from tarfile import (
+    TarInfo,
+    open as tar_open
+)
+
+import pytest
+
+from savemon import (
+    TAR_COMPRESSORS,
+    HistoryReader,
+    export_snapshot,
+    import_archive
+)
+
+
+def reopened(storage):
+    # functions for command line open and close storages themselves
+    return type(storage)(storage.backupDir)
+
+
+def member(name, data):
+    info = TarInfo(name)
+    info.size = len(data)
+    return info, BytesIO(data)
+
+
+@pytest.mark.parametrize("compression", [None] + sorted(TAR_COMPRESSORS))
+def test_export_import(storage, commit, tmp_path, compression):
+    content = {"a" : b"1" * 1000, join("d", "b") : b"", join("d", "c") : b"2"}
+    snapshot = commit(storage, content, "one")
+    commit(storage, {"a" : b"newer"}, "two")
+
+    f = BytesIO()
+    export_snapshot(reopened(storage), f, snapshot.hexsha[:10], compression)
+    f.seek(0)
+    with tar_open(fileobj = f, mode = "r:*") as tar:
+        members = dict(
+            (i.name, tar.extractfile(i).read()) for i in tar.getmembers()
+        )
+    assert members == dict(
+        (relN.replace("\\", "/"), data) for relN, data in content.items()
+    )
+
+    (tmp_path / "imported").mkdir()
+    imported = type(storage)(str(tmp_path / "imported"))
+    f.seek(0)
+    first = import_archive(imported, f, "import")
+    f.seek(0)
+    assert import_archive(imported, f, "again") is None
+
+    imported.open()
+    try:
+        reader = HistoryReader(imported)
+        for relN, data in content.items():
+            assert reader.read(relN, first) == data
+    finally:
+        imported.close()
+
+
+def test_import_removes_missing_files(storage, commit):
+    commit(storage, {"a" : b"1", "b" : b"2"}, "one")
+    f = BytesIO()
+    with tar_open(fileobj = f, mode = "w") as tar:
+        tar.addfile(*member("b", b"3"))
+    f.seek(0)
+    snapshot = import_archive(reopened(storage), f, "import")
+    storage.close()
+    storage.open()
+    assert storage.current().hexsha == snapshot.hexsha
+    assert [relN for relN, _ in storage.iter_files(snapshot)] == ["b"]
+
+
+@pytest.mark.parametrize("name", [
+    "../a",
+    "d/../../a",
+    "/a",
+    "..\\..\\a",
+    "d\\a",
+    "C:\\a",
+    "C:a",
+    "d/C:a"
+])
+def test_import_rejects_outer_paths(storage, name):
+    f = BytesIO()
+    with tar_open(fileobj = f, mode = "w") as tar:
+        tar.addfile(*member(name, b"1"))
+    f.seek(0)
+    with pytest.raises(ValueError):
+        import_archive(reopened(storage), f, "import")
+    assert storage.current() is None
@@ -0,0 +1,120 @@
+from collections import (
+    deque
+)
+from os.path import (
+    join
+)
+from queue import (
+    Queue
+)
+from time import (
+    sleep
+)
+
+import pytest
+
+from savemon import (
+    STORAGES,
+    BackUpThread,
+    GitStorage,
+    tracer
+)
+
+# actions of `MonitorThread`
+CREATED, DELETED, UPDATED = range(1, 4)
+
+
+def write(saveDir, relN, data):
+    with open(join(saveDir, relN), "wb") as f:
+        f.write(data)
+
+
+class BackUp(object):
+    "Runs `BackUpThread` without `MonitorThread`, events are put by tests."
+
+    def __init__(self, storageName, saveDir, backupDir):
+        self.storageName = storageName
+        self.saveDir = saveDir
+        self.backupDir = backupDir
+        self.events = Queue()
+        self.thread = None
+
+    def start(self, **kw):
+        self.storage = STORAGES[self.storageName](self.backupDir)
+        bt = BackUpThread(self.saveDir, self.backupDir, self.events,
+            storage = self.storage,
+            **kw
+        )
+        bt.delay = 0.1
+        bt.start()
+        assert bt.scanned.wait(30)
+        self.thread = bt
+        return bt
+
+    def stop(self):
+        bt = self.thread
+        if bt is not None:
+            bt.exit_request = True
+            bt.join()
+            self.thread = None
+
+    def change(self, relN, data, action = UPDATED):
+        write(self.saveDir, relN, data)
+        self.events.put((action, relN))
+        assert self.thread.flush(30)
+
+
+@pytest.fixture(params = sorted(STORAGES))
+def backUp(request, saveDir, tmp_path):
+    (tmp_path / "backup").mkdir()
+    backUp = BackUp(request.param, saveDir, str(tmp_path / "backup"))
+    yield backUp
+    backUp.stop()
+
+
+def test_storage_is_closed_at_stop(backUp):
+    backUp.start()
+    backUp.change("a", b"1", CREATED)
+    storage = backUp.storage
+    backUp.stop()
+    if isinstance(storage, GitStorage):
+        assert storage.blobs.proc is None
+        assert storage.commits.proc is None
+    else:
+        assert storage.store.store._index.closed
+
+
+def test_changes_are_journaled_during_storm(backUp):
+    backUp.start()
+    journalFile = backUp.storage.journal_file()
+    # events come more often than checks are made
+    for i in range(100):
+        relN = "a%u" % i
+        write(backUp.saveDir, relN, b"1")
+        backUp.events.put((CREATED, relN))
+        sleep(0.02)
+        with open(journalFile, "r") as f:
+            if f.read():
+                break
+    with open(journalFile, "r") as f:
+        assert '"a0"' in f.read()
+
+
+def test_delivered_changes_are_traced_by_batch(backUp, monkeypatch):
+    monkeypatch.setattr(tracer, "enabled", True)
+    monkeypatch.setattr(tracer, "events", deque())
+    backUp.start()
+    # as `MonitorThread` does
+    tracer.batch = tracer.open_batch(backUp.saveDir)
+    try:
+        with tracer.span("deliver"):
+            backUp.change("a", b"1", CREATED)
+    finally:
+        tracer.batch = None
+
+    batches = dict(
+        (e["name"], e["args"].get("batch")) for e in tracer.events
+            if e["name"] in ("deliver", "check", "commit")
+    )
+    assert len(batches) == 3
+    assert len(set(batches.values())) == 1
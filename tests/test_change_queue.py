@@ -0,0 +1,44 @@
+from os.path import (
+    join
+)
+
+from savemon import (
+    RESCAN,
+    ChangeQueue
+)
+
+UPDATED = 3
+
+
+def test_path_is_kept_once_with_last_action():
+    q = ChangeQueue(capacity = 10)
+    q.put((1, "a"))
+    q.put((UPDATED, "b"))
+    q.put((UPDATED, "a"))
+    assert list(q) == [(UPDATED, "a"), (UPDATED, "b")]
+    assert q.get_nowait() == (UPDATED, "a")
+    assert len(q) == 1
+
+
+def test_deepest_paths_collapse_to_rescan():
+    q = ChangeQueue(capacity = 4)
+    for i in range(5):
+        q.put((UPDATED, join("d", "f%u" % i)))
+    assert list(q) == [(RESCAN, "d")]
+    # changes inside a directory waiting for rescan are dropped
+    q.put((UPDATED, join("d", "g")))
+    assert list(q) == [(RESCAN, "d")]
+    assert q.get_nowait() == (RESCAN, "d")
+    q.put((UPDATED, join("d", "g")))
+    assert list(q) == [(UPDATED, join("d", "g"))]
+
+
+def test_queued_parent_becomes_rescan():
+    q = ChangeQueue(capacity = 4)
+    q.put((UPDATED, "a"))
+    q.put((UPDATED, join("a", "b")))
+    for i in range(3):
+        q.put((UPDATED, join("a", "b", "c%u" % i, "f")))
+    # collapsed children are rescanned as a part of their parent
+    assert list(q) == [(UPDATED, "a"), (RESCAN, join("a", "b"))]
+    assert q.rescans == set([join("a", "b")])
@@ -0,0 +1,215 @@
+import sys
+from io import (
+    BytesIO
+)
+from os import (
+    environ,
+    listdir,
+    pathsep
+)
+from os.path import (
+    join
+)
+from random import (
+    Random
+)
+from hashlib import (
+    sha1
+)
+from subprocess import (
+    Popen
+)
+
+import pytest
+
+from savemon import (
+    Chunker,
+    ChunkStore,
+    ChunkStorage,
+    ChunkStores,
+    Compression
+)
+
+
+def random_bytes(size, seed = 0):
+    return Random(seed).getrandbits(size << 3).to_bytes(size, "little")
+
+
+def split(data, **kw):
+    return list(Chunker(**kw).split(BytesIO(data)))
+
+
+def test_chunks_make_up_file():
+    data = random_bytes(1 << 20)
+    chunks = split(data, blockSize = 100 << 10)
+    assert b"".join(chunks) == data
+    assert len(chunks) > 1
+    for chunk in chunks[:-1]:
+        assert 2 << 10 <= len(chunk) <= 64 << 10
+
+
+def test_empty_file():
+    assert b"".join(split(b"")) == b""
+
+
+def test_insertion_changes_few_chunks():
+    data = random_bytes(1 << 20)
+    offset = len(data) // 2
+    changed = data[:offset] + b"inserted" + data[offset:]
+    before = set(split(data))
+    after = split(changed)
+    assert len([c for c in after if c not in before]) <= 2
+
+
+@pytest.mark.parametrize("codec", ["none", "zlib"])
+def test_store_round_trip(tmp_path, codec):
+    path = str(tmp_path / "store")
+    store = ChunkStore(path, compression = Compression(codec))
+    store.open()
+    text = b"compressible " * 1000
+    noise = random_bytes(10000)
+    oids = [store.put(text), store.put(noise)]
+    # same content is stored once
+    written = store.written
+    assert store.put(text) == oids[0]
+    assert store.written == written
+    assert store.get(oids[0]) == text
+    store.sync()
+    store.close()
+
+    store = ChunkStore(path)
+    store.open()
+    try:
+        assert oids[0] in store
+        assert [store.get(oid) for oid in oids] == [text, noise]
+    finally:
+        store.close()
+
+
+def test_packs_are_limited(tmp_path):
+    path = str(tmp_path / "store")
+    store = ChunkStore(path, packLimit = 1000)
+    store.open()
+    oids = [store.put(random_bytes(600, seed)) for seed in range(4)]
+    store.close()
+    assert len([n for n in listdir(path) if n.endswith(".pack")]) > 1
+
+    store = ChunkStore(path, packLimit = 1000)
+    store.open()
+    try:
+        assert store.get(oids[-1]) == random_bytes(600, 3)
+    finally:
+        store.close()
+
+
+def test_torn_index_tail_is_ignored(tmp_path):
+    path = str(tmp_path / "store")
+    store = ChunkStore(path)
+    store.open()
+    oid = store.put(b"data")
+    store.close()
+    with open(join(path, "index"), "ab") as f:
+        f.write(b"\1" * 7)
+
+    store = ChunkStore(path)
+    store.open()
+    try:
+        assert store.get(oid) == b"data"
+        assert len(store.index) == 1
+    finally:
+        store.close()
+
+
+def test_alternates_are_read_only(tmp_path):
+    old = ChunkStore(str(tmp_path / "old"))
+    old.open()
+    oldOid = old.put(b"old")
+    new = ChunkStore(str(tmp_path / "new"))
+    new.open()
+
+    stores = ChunkStores(new, [old])
+    try:
+        assert stores.put(b"old") == oldOid
+        assert oldOid not in new
+        newOid = stores.put(b"new")
+        assert newOid in new and newOid not in old
+        assert stores.get(oldOid) == b"old"
+        assert stores.get(newOid) == b"new"
+    finally:
+        stores.close()
+
+
+def test_shared_store_is_opened_once(tmp_path):
+    path = str(tmp_path / "shared")
+    a = ChunkStore.open_shared(path)
+    b = ChunkStore.open_shared(path)
+    assert a is b
+    oid = a.put(b"data")
+    a.close()
+    # still opened by another user
+    assert b.get(oid) == b"data"
+    b.close()
+    c = ChunkStore.open_shared(path)
+    assert c is not a
+    c.close()
+
+
+def test_loaded_snapshots_are_limited(tmp_path, saveDir, commit):
+    class SmallCacheStorage(ChunkStorage):
+        snapshotCacheSize = 20
+
+    storage = SmallCacheStorage(str(tmp_path / "backup"))
+    storage.open()
+    try:
+        for i in range(50):
+            commit(storage, {"a" : b"%u" % i, "b%u" % i : b"b"}, "v%u" % i)
+        assert len(list(storage.iter_history())) == 50
+        assert storage._snapshots.size <= 20
+        assert len(storage._snapshots.items) < 50
+    finally:
+        storage.close()
+
+
+PUTTER = """
+import sys
+from savemon import ChunkStore
+store = ChunkStore(sys.argv[1], packLimit = 100000)
+store.open()
+for i in range(2000):
+    store.put(("%s %u " % (sys.argv[2], i)).encode() * 100)
+store.sync()
+store.close()
+"""
+
+
+def test_processes_append_to_same_store(tmp_path):
+    path = str(tmp_path / "store")
+    env = dict(environ,
+        PYTHONPATH = pathsep.join(sys.path)
+    )
+    procs = [
+        Popen([sys.executable, "-c", PUTTER, path, name], env = env)
+            for name in "ab"
+    ]
+    store = ChunkStore(path, packLimit = 100000)
+    store.open()
+    try:
+        mine = [store.put(b"c %u " % i * 100) for i in range(2000)]
+        for p in procs:
+            assert p.wait() == 0
+        for i, oid in enumerate(mine):
+            assert store.get(oid) == b"c %u " % i * 100
+        # objects of other processes are found in shared index and packs
+        for name in "ab":
+            for i in range(2000):
+                data = ("%s %u " % (name, i)).encode() * 100
+                assert store.get(sha1(data).digest()) == data
+    finally:
+        store.close()
+
+    store = ChunkStore(path)
+    store.open()
+    try:
+        assert len(store.index) == 6000
+    finally:
+        store.close()
@@ -0,0 +1,113 @@
+from os import (
+    remove,
+    utime
+)
+from os.path import (
+    exists,
+    join
+)
+from time import (
+    sleep,
+    time
+)
+
+import pytest
+
+from savemon import (
+    CommitThread,
+    GitStorage,
+    metrics
+)
+
+
+@pytest.fixture
+def gitStorage(tmp_path):
+    (tmp_path / "backup").mkdir()
+    storage = GitStorage(str(tmp_path / "backup"))
+    storage.open()
+    yield storage
+    storage.close()
+
+
+# Returns changes of a batch as `BackUpThread` stages them.
+def staged(storage, saveDir, content, force = False):
+    changes = []
+    for relN, data in content.items():
+        fullN = join(saveDir, relN)
+        with open(fullN, "wb") as f:
+            f.write(data)
+        changes.append(("add", relN, storage.stage(relN, fullN, force)))
+    return changes
+
+
+@pytest.fixture
+def committer(gitStorage, saveDir):
+    committer = CommitThread(saveDir, gitStorage)
+    committer.retryMin = 0.1
+    committer.start()
+    yield committer
+    committer.finish()
+
+
+def test_commit_is_deferred_while_index_is_locked(gitStorage, saveDir,
+    committer
+):
+    lock = gitStorage.lock_file()
+    with open(lock, "w"):
+        n = committer.put(staged(gitStorage, saveDir, {"a" : b"1"}))
+        sleep(0.5)
+        # the thread is not blocked
+        assert committer.is_alive() and committer.committed == 0
+        assert committer.retryAt is not None
+    remove(lock)
+    committer.wait(n)
+    assert committer.committed == n
+    assert [relN for relN, _ in gitStorage.iter_files(gitStorage.current())
+    ] == ["a"]
+
+
+def test_forgotten_index_lock_is_removed(gitStorage, saveDir, committer):
+    lock = gitStorage.lock_file()
+    open(lock, "w").close()
+    old = time() - 2 * committer.lockGrace
+    utime(lock, (old, old))
+    committer.wait(committer.put(staged(gitStorage, saveDir, {"a" : b"1"})))
+    assert not exists(lock)
+    assert gitStorage.current() is not None
+
+
+def test_waiting_batches_are_committed_together(gitStorage, saveDir,
+    committer
+):
+    lock = gitStorage.lock_file()
+    with open(lock, "w"):
+        for relN in "abc":
+            n = committer.put(staged(gitStorage, saveDir, {relN : b"1"}))
+        # staging is not blocked by deferred commit
+        assert n == 3
+    remove(lock)
+    committer.wait(n)
+    assert len(list(gitStorage.iter_history())) == 1
+    assert sorted(relN for relN, _ in gitStorage.iter_files(
+        gitStorage.current()
+    )) == ["a", "b", "c"]
+
+
+def test_failed_committing_stops_staging(gitStorage, saveDir):
+    committer = CommitThread(saveDir, gitStorage)
+    with pytest.raises(RuntimeError):
+        committer.put([])
+
+
+def test_same_tree_is_not_committed(gitStorage, saveDir, committer):
+    committer.wait(committer.put(staged(gitStorage, saveDir, {"a" : b"1"})))
+    snapshot = gitStorage.current()
+    # e.g. replayed changes are staged again
+    committer.wait(committer.put(
+        staged(gitStorage, saveDir, {"a" : b"1"}, force = True)
+    ))
+    assert gitStorage.current().hexsha == snapshot.hexsha
+    assert committer.lastCommit[0] == snapshot.hexsha
+    assert metrics.values[
+        ("savemon_empty_commits_skipped_total", saveDir)
+    ] == 1
@@ -0,0 +1,46 @@
+from os.path import (
+    join
+)
+
+from savemon import (
+    Storage,
+    compare_snapshots
+)
+
+
+def reopened(storage):
+    # functions for command line open and close storages themselves
+    return type(storage)(storage.backupDir)
+
+
+def test_diff(storage, commit):
+    first = commit(storage, {
+        "a" : b"1\n2\n",
+        join("d", "b") : b"2",
+        join("d", "c") : b"3",
+        join("x", "y") : b"same"
+    }, "one")
+    second = commit(storage, {
+        "a" : b"1\n22\n3\n",
+        join("d", "b") : None,
+        join("d", "n") : b"new"
+    }, "two")
+    assert storage.diff(first, second) == [
+        ("a", 4, 7),
+        ("d/b", 1, None),
+        ("d/n", None, 3)
+    ]
+    assert storage.diff(first, first) == []
+    assert len(storage.diff(None, first)) == 4
+    # the generic implementation has same result
+    assert Storage.diff(storage, first, second) == \
+        storage.diff(first, second)
+
+    text = compare_snapshots(reopened(storage), first.hexsha,
+        second.hexsha[:10],
+        summaries = 1
+    )
+    assert "M a (4 -> 7 bytes): +2 -1 lines" in text
+    assert "1 added, 1 removed, 1 changed" in text
+    assert compare_snapshots(reopened(storage), None, second.hexsha) == \
+        "Same content"
@@ -0,0 +1,76 @@
+from os.path import (
+    join
+)
+from queue import (
+    Queue
+)
+from socket import (
+    socket
+)
+
+import pytest
+
+from savemon import (
+    BackUpThread,
+    ChunkStorage,
+    send_control,
+    serve_control
+)
+
+# `MonitorThread` action
+UPDATED = 3
+
+
+@pytest.fixture
+def root2threads(saveDir, tmp_path):
+    backupDir = str(tmp_path / "backup")
+    bt = BackUpThread(saveDir, backupDir, Queue(),
+        storage = ChunkStorage(backupDir)
+    )
+    bt.delay = 0.1
+    bt.start()
+    assert bt.scanned.wait(30)
+    yield {saveDir : (None, bt)}
+    bt.exit_request = True
+    bt.join()
+
+
+def free_port():
+    with socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture(params = ["socket", "port"])
+def address(request, tmp_path):
+    if request.param == "socket":
+        return dict(path = str(tmp_path / "savemon.sock"))
+    return dict(port = free_port())
+
+
+def test_control_commands(root2threads, saveDir, address):
+    server = serve_control(root2threads, **address)
+    try:
+        reply = send_control("status", **address)
+        assert reply["ok"]
+        assert [s["root"] for s in reply["roots"]] == [saveDir]
+        assert reply["roots"][0]["lastCommit"] is None
+
+        bt = root2threads[saveDir][1]
+        with open(join(saveDir, "a"), "wb") as f:
+            f.write(b"1")
+        bt.qchanges.put((UPDATED, "a"))
+        reply = send_control("flush " + saveDir, **address)
+        assert reply["ok"] and reply["roots"][0]["lastCommit"]
+
+        assert send_control("pause", **address)["roots"][0]["paused"]
+        assert bt.paused
+        send_control("resume", **address)
+        assert not bt.paused
+
+        assert not send_control("nothing", **address)["ok"]
+        reply = send_control("status " + join(saveDir, "x"), **address)
+        assert not reply["ok"] and "not monitored" in reply["error"]
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,56 @@
+from os.path import (
+    join
+)
+from re import (
+    compile
+)
+
+from savemon import (
+    PathFilter,
+    glob_to_re
+)
+
+
+def test_glob_to_re():
+    def match(glob, path):
+        return bool(compile(glob_to_re(glob) + "\\Z").match(path))
+
+    assert match("*.sav", "a.sav")
+    assert not match("*.sav", "d/a.sav")
+    assert match("**/a.sav", "a.sav")
+    assert match("**/a.sav", "d/e/a.sav")
+    assert match("d/**", "d/e/a.sav")
+    assert match("slot?.sav", "slot1.sav")
+    assert not match("slot?.sav", "slot/.sav")
+    assert match("[!a]b", "cb") and not match("[!a]b", "ab")
+    assert match("\\*", "*") and not match("\\*", "a")
+
+
+def test_path_filter():
+    f = PathFilter.parse("shadercache/; *.tmp; !keep.tmp; /top.sav")
+    assert f
+    assert f.ignored("shadercache", True)
+    # directories only
+    assert not f.ignored("shadercache", False)
+    assert f.ignored(join("shadercache", "x", "y.bin"))
+    assert f.ignored(join("d", "a.tmp"))
+    assert not f.ignored("keep.tmp")
+    assert f.ignored("top.sav")
+    assert not f.ignored(join("d", "top.sav"))
+    assert not f.ignored("slot1.sav")
+    assert not PathFilter.parse("")
+
+
+def test_path_filter_calls_is_dir_if_needed():
+    calls = []
+
+    def isDir():
+        calls.append(1)
+        return True
+
+    f = PathFilter(["cache/"])
+    assert not f.ignored("a.sav", isDir)
+    assert calls == []
+    assert f.ignored("cache", isDir)
+    assert calls == [1]
+
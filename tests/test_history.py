@@ -0,0 +1,72 @@
+from time import (
+    time
+)
+
+from savemon import (
+    STORAGES,
+    HistoryReader,
+    LruCache,
+    PathIndex,
+    file_history
+)
+
+
+def test_same_second_snapshots_are_ordered_by_history(storage, commit):
+    # commit times have one second resolution
+    snapshots = [
+        commit(storage, {"a" : b"%u" % i}, "v%u" % i) for i in range(4)
+    ]
+    shas = [s.hexsha for s in snapshots]
+
+    history = file_history(type(storage)(storage.backupDir), "a")
+    assert [v[1] for v in history] == shas[::-1]
+
+    reader = HistoryReader(storage)
+    assert reader.snapshot_at(time() + 10).hexsha == shas[-1]
+    assert reader.read("a", reader.snapshot_of(shas[1][:10])) == b"1"
+
+
+def test_path_index_is_reloaded(storage, commit):
+    first = commit(storage, {"a" : b"1", "b" : b"2"}, "one")
+    second = commit(storage, {"a" : None}, "two")
+    pathIndexFile = storage.path_index_file()
+    index = PathIndex(pathIndexFile)
+    index.update(storage)
+
+    # a new instance reads the file
+    index = PathIndex(pathIndexFile)
+    assert index.indexed.keys() == set([first.hexsha, second.hexsha])
+    index.update(storage)
+    assert [(v[1], v[2]) for v in index.history("a")][0] == (
+        second.hexsha, None
+    )
+    assert [v[1] for v in index.history("b")] == [first.hexsha]
+
+
+def test_relative_backup_directory(tmp_path, monkeypatch, commit):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "backup").mkdir()
+    storage = STORAGES["git"]("backup")
+    storage.open()
+    try:
+        snapshot = commit(storage, {"a" : b"1"}, "one")
+        assert HistoryReader(storage).read("a", snapshot) == b"1"
+    finally:
+        storage.close()
+
+
+def test_lru_cache():
+    cache = LruCache(10)
+    cache.put("a", b"1234")
+    cache.put("b", b"1234")
+    assert cache.get("a") == b"1234"
+    # "b" is the least recently used
+    cache.put("c", b"1234")
+    assert cache.get("b") is None
+    assert cache.get("a") == b"1234"
+    assert cache.get("c") == b"1234"
+    assert cache.size == 8
+    assert (cache.hits, cache.misses) == (3, 1)
+    cache.put("a", b"12345678")
+    assert cache.get("c") is None
+    assert cache.size == 8
@@ -0,0 +1,70 @@
+from os.path import (
+    join
+)
+
+from savemon import (
+    Journal
+)
+
+
+def test_journal(tmp_path):
+    path = str(tmp_path / "journal")
+    assert Journal(path).replay() == (None, None)
+
+    journal = Journal(path)
+    journal.open()
+    journal.add("a")
+    journal.add(join("d", "b"))
+    journal.add("a")
+    journal.sync(force = True)
+    journal.close()
+
+    journal = Journal(path)
+    paths, since = journal.replay()
+    assert paths == ["a", join("d", "b")]
+    assert since is not None
+    journal.open()
+    journal.add("c")
+    journal.clear()
+    journal.close()
+    assert Journal(path).replay()[0] == []
+
+    # nothing is journaled without a path
+    journal = Journal(None)
+    journal.open()
+    journal.add("a")
+    journal.sync(force = True)
+    assert journal.replay() == (None, None)
+
+
+def test_journal_syncs_many_paths_at_once(tmp_path):
+    journal = Journal(str(tmp_path / "journal"))
+    journal.syncInterval = 1000.
+    journal.maxPending = 3
+    journal.open()
+    journal.sync()
+    journal.add("a")
+    journal.add("b")
+    journal.sync()
+    assert Journal(journal.path).replay()[0] == []
+    journal.add("c")
+    journal.sync()
+    assert Journal(journal.path).replay()[0] == ["a", "b", "c"]
+    journal.close()
+
+
+def test_journal_is_limited(tmp_path):
+    journal = Journal(str(tmp_path / "journal"))
+    journal.maxJournaled = 2
+    journal.open()
+    for relN in "abcd":
+        journal.add(relN)
+    assert len(journal.journaled) == 0
+    journal.sync(force = True)
+    # everything is to be checked
+    assert Journal(journal.path).replay() == (None, None)
+
+    journal.clear()
+    journal.add("e")
+    journal.close()
+    assert Journal(journal.path).replay()[0] == ["e"]
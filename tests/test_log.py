@@ -0,0 +1,46 @@
+from time import (
+    sleep
+)
+
+from savemon import (
+    INFO,
+    LogPipeline
+)
+
+
+class Console(object):
+    "Cannot encode all characters, as a Windows console."
+
+    def __init__(self):
+        self.lines = []
+
+    def write(self, text):
+        text.encode("ascii")
+        self.lines.append(text)
+
+    def flush(self):
+        pass
+
+
+def test_write_errors_do_not_stop_writing():
+    pipeline = LogPipeline()
+    console, logFile = Console(), Console()
+    logFile.write = logFile.lines.append
+    pipeline.set_file(logFile)
+    pipeline.start()
+
+    for text in ["a\n", "é\n", "b\n"]:
+        pipeline.put(INFO, console, text)
+    pipeline.flush()
+    assert console.lines == ["a\n", "b\n"]
+    assert logFile.lines[:3] == ["a\n", "é\n", "b\n"]
+    assert "1 log records are not written" in logFile.lines[3]
+
+    # the thread is still writing
+    pipeline.put(INFO, console, "c\n")
+    pipeline._wake.set()
+    for _ in range(100):
+        if console.lines[-1] == "c\n":
+            break
+        sleep(0.01)
+    assert console.lines[-1] == "c\n"
@@ -0,0 +1,53 @@
+from urllib.request import (
+    urlopen
+)
+
+import savemon
+from savemon import (
+    Metrics,
+    serve_metrics
+)
+
+
+def test_prometheus_export():
+    m = Metrics()
+    m.inc("events_total", "a")
+    m.inc("events_total", "a", 2)
+    m.set("queue_depth", 'b"\\', 5)
+    m.observe("check_seconds", "a", 0.003)
+    m.observe("check_seconds", "a", 100.)
+    pending = [1, 2]
+    m.watch("pending", "a", pending.__len__)
+    pending.append(3)
+
+    lines = m.prometheus().splitlines()
+    assert "# TYPE events_total counter" in lines
+    assert 'events_total{root="a"} 3' in lines
+    assert 'queue_depth{root="b\\"\\\\"} 5' in lines
+    assert 'pending{root="a"} 3' in lines
+    # buckets are cumulative
+    assert 'check_seconds_bucket{root="a",le="0.001"} 0' in lines
+    assert 'check_seconds_bucket{root="a",le="0.005"} 1' in lines
+    assert 'check_seconds_bucket{root="a",le="60.0"} 1' in lines
+    assert 'check_seconds_bucket{root="a",le="+Inf"} 2' in lines
+    assert 'check_seconds_count{root="a"} 2' in lines
+
+    # the last value is kept
+    m.unwatch("a")
+    pending.append(4)
+    assert 'pending{root="a"} 3' in m.prometheus().splitlines()
+
+
+def test_metrics_are_served(monkeypatch):
+    # not the ones of other tests
+    monkeypatch.setattr(savemon, "metrics", Metrics())
+    savemon.metrics.inc("savemon_test_total", "served")
+    server = serve_metrics(0)
+    try:
+        url = "http://127.0.0.1:%u/metrics" % server.server_address[1]
+        with urlopen(url) as r:
+            text = r.read().decode("utf-8")
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert 'savemon_test_total{root="served"} 1' in text.splitlines()
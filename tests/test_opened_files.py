@@ -0,0 +1,24 @@
+from os.path import (
+    isdir
+)
+
+import pytest
+
+from savemon import (
+    file_in_use,
+    files_being_written
+)
+
+pytestmark = pytest.mark.skipif(not isdir("/proc"), reason = "needs /proc")
+
+
+def test_files_being_written(tmp_path):
+    written, read = str(tmp_path / "written"), str(tmp_path / "read")
+    for path in (written, read):
+        open(path, "wb").close()
+    assert files_being_written([written, read]) == set()
+
+    with open(written, "ab"), open(read, "rb"):
+        assert files_being_written([written, read]) == set([written])
+        assert file_in_use(written) and file_in_use(read)
+    assert not file_in_use(written)
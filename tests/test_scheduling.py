@@ -0,0 +1,73 @@
+from threading import (
+    Event,
+    Thread
+)
+from time import (
+    perf_counter,
+    sleep
+)
+
+from savemon import (
+    FairScheduler,
+    Storage,
+    TokenBucket,
+    scheduler
+)
+
+
+def test_token_bucket():
+    assert TokenBucket().take(1 << 30) == 0.
+    bucket = TokenBucket(rate = 100000)
+    delay = bucket.take(10000)
+    assert 0.05 < delay < 0.2
+    # debt of previous callers is paid by next ones
+    assert bucket.take(10000) > delay
+
+
+def test_fair_scheduler():
+    scheduler = FairScheduler(slots = 1)
+    order = []
+
+    def work(root):
+        scheduler.acquire(root)
+        order.append(root)
+        scheduler.release()
+
+    scheduler.acquire("busy")
+    threads = []
+    for root in ["a", "a", "b"]:
+        t = Thread(target = work, args = (root,))
+        t.start()
+        threads.append(t)
+        # wait for it to queue
+        while sum(scheduler.waiting.values()) < len(threads):
+            sleep(0.001)
+    scheduler.release()
+    for t in threads:
+        t.join()
+    # "b" is not delayed by all work of "a"
+    assert order == ["a", "b", "a"]
+
+
+def test_slot_is_released_while_throttled(monkeypatch):
+    monkeypatch.setattr(scheduler, "slots", 1)
+    storage = Storage("backup")
+    storage.limiter = TokenBucket(rate = 100000)
+    throttled = Event()
+
+    def stage():
+        with scheduler.slot("a"):
+            throttled.set()
+            # 0.5 seconds at that rate
+            storage.account(read = 50000)
+
+    t = Thread(target = stage)
+    t.start()
+    throttled.wait()
+    t0 = perf_counter()
+    with scheduler.slot("b"):
+        waited = perf_counter() - t0
+    t.join()
+    assert waited < 0.4
+    assert storage.bytesRead == 50000
+    assert scheduler.busy == 0
@@ -0,0 +1,182 @@
+"Same checks for each storage back-end of `STORAGES`."
+
+from os import (
+    walk
+)
+from os.path import (
+    exists,
+    join
+)
+from random import (
+    Random
+)
+
+import pytest
+
+from savemon import (
+    HistoryReader,
+    Storage,
+    compare_snapshots,
+    dedup_report,
+    dir_size,
+    file_history,
+    saved_storages
+)
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def reopened(storage):
+    # functions for command line open and close storages themselves
+    return type(storage)(storage.backupDir)
+
+
+# Names of backed up files, Git working tree also has ".git".
+def listdir(storage, relDir):
+    return sorted(n for n in storage.listdir(relDir) if n != ".git")
+
+
+# Names and sizes of all files in `path`.
+def tree(path):
+    return sorted(
+        (join(d, n), len(read(join(d, n))))
+            for d, _, names in walk(path) for n in names
+    )
+
+
+def test_empty(storage):
+    assert storage.current() is None
+    assert list(storage.iter_history()) == []
+    assert not storage.is_dirty()
+
+
+def test_round_trip(storage, saveDir, commit):
+    big = bytes(range(256)) * 1024
+    first = commit(storage, {
+        "a" : b"1",
+        join("d", "b") : b"2",
+        join("d", "e", "big") : big
+    }, "one")
+    second = commit(storage, {"a" : b"3", join("d", "b") : None}, "two")
+    assert storage.current().hexsha == second.hexsha
+    assert [s.hexsha for s in storage.iter_history()] == [
+        second.hexsha, first.hexsha
+    ]
+    assert [s.hexsha for s in storage.heads()] == [second.hexsha]
+    assert [p.hexsha for p in second.parents] == [first.hexsha]
+    assert listdir(storage, "") == ["a", "d"]
+    assert storage.has("a") and not storage.has(join("d", "b"))
+
+    files = dict(
+        (relN, storage.find_file(second, relN)[0])
+            for relN, _ in storage.iter_files(second)
+    )
+    assert files == {"a" : 1, join("d", "e", "big") : len(big)}
+    assert sorted(storage.iter_file_ids(second))[0][::2] == ("a", 1)
+
+    storage.checkout(first, saveDir)
+    assert storage.current().hexsha == first.hexsha
+    assert read(join(saveDir, "a")) == b"1"
+    assert read(join(saveDir, "d", "b")) == b"2"
+    assert read(join(saveDir, "d", "e", "big")) == big
+
+    storage.checkout(second, saveDir)
+    assert read(join(saveDir, "a")) == b"3"
+    assert not exists(join(saveDir, "d", "b"))
+    # the previous branch is kept
+    assert set(s.hexsha for s in storage.heads()) >= set([second.hexsha])
+
+
+def test_same_content_is_not_committed(storage, commit):
+    commit(storage, {"a" : b"1"}, "one")
+    assert commit(storage, {"a" : b"1"}, "same") is None
+    assert storage.lastChanges == []
+    commit(storage, {"a" : b"2", "b" : b"3"}, "two")
+    assert sorted(c[0] for c in storage.lastChanges) == ["a", "b"]
+
+
+def test_reopen(storage, commit):
+    snapshot = commit(storage, {"a" : b"1"}, "one")
+    storage.close()
+    storage.open()
+    assert storage.current().hexsha == snapshot.hexsha
+    assert listdir(storage, "") == ["a"]
+
+
+def test_dirty_state_after_abort(storage, saveDir, commit):
+    commit(storage, {"a" : b"1"}, "one")
+    assert not storage.is_dirty()
+    fullN = join(saveDir, "a")
+    with open(fullN, "wb") as f:
+        f.write(b"2")
+    # left uncommitted by an aborted run
+    storage.stage("a", fullN, True)
+    storage.close()
+    storage.open()
+    # next run stages it again
+    commit(storage, {"a" : b"2"}, "two")
+    assert not storage.is_dirty()
+
+
+def test_shared_store(storage, commit, tmp_path, monkeypatch):
+    shared = str(tmp_path / "shared")
+    monkeypatch.setattr(Storage, "sharedStore", shared)
+    # not compressible
+    data = Random(0).getrandbits(800000).to_bytes(100000, "little")
+    backups = []
+    for name in ("one", "two"):
+        (tmp_path / name).mkdir()
+        backup = type(storage)(str(tmp_path / name))
+        backup.open()
+        try:
+            snapshot = commit(backup, {"a" : data}, name)
+            assert HistoryReader(backup).read("a", snapshot) == data
+        finally:
+            backup.close()
+        backups.append((name, backup))
+        # objects are not kept by backups, a Git one has a working tree
+        assert dir_size(backup.backupDir) < len(data) * 1.5
+
+    assert len(data) < dir_size(shared) < len(data) * 1.5
+    assert "deduplicated 0.1 MiB (50.0%)" in dedup_report(backups)
+
+
+def test_reports_do_not_change_backups(storage, commit, tmp_path,
+    monkeypatch
+):
+    snapshot = commit(storage, {"a" : b"1" * 1000, "b" : b"2"}, "one")
+    storage.close()
+    (tmp_path / "other").mkdir()
+    before = tree(str(tmp_path))
+    monkeypatch.setattr(Storage, "sharedStore", str(tmp_path / "shared"))
+
+    storages = saved_storages([
+        ("save", storage.backupDir),
+        ("other", str(tmp_path / "other")),
+        ("missing", str(tmp_path / "missing"))
+    ])
+    assert [name for name, _ in storages] == ["save"]
+    text = dedup_report(storages)
+    assert text.startswith("save: 2 objects")
+    assert compare_snapshots(reopened(storage), None, snapshot.hexsha) == \
+        "Same content"
+    assert [v[1] for v in file_history(reopened(storage), "a")] == [
+        snapshot.hexsha
+    ]
+    # only the index of file history is added, it is rebuilt if missing
+    pathIndexFile = storage.path_index_file()
+    assert [f for f in tree(str(tmp_path)) if f[0] != pathIndexFile] == \
+        before
+    assert not exists(str(tmp_path / "shared"))
+    storage.open()
+
+
+def test_read_only_open_needs_backup(storage, tmp_path):
+    (tmp_path / "empty").mkdir()
+    empty = type(storage)(str(tmp_path / "empty"))
+    with pytest.raises(Exception):
+        empty.open(readOnly = True)
+    assert not any(tmp_path.joinpath("empty").iterdir())
@@ -0,0 +1,61 @@
+import savemon
+from savemon import (
+    Worker,
+    load_history
+)
+
+
+def run(work, monkeypatch, cancel = False):
+    events = []
+    monkeypatch.setattr(savemon, "PostEvent",
+        lambda handler, e : events.append(e)
+    )
+    worker = Worker(None, work)
+    if cancel:
+        worker.cancel()
+    worker.start()
+    worker.join(30)
+    assert not worker.is_alive()
+    assert all(e.worker is worker for e in events)
+    return events[:-1], events[-1]
+
+
+def test_history_is_loaded_in_background(storage, commit, monkeypatch):
+    snapshots = [
+        commit(storage, {"a" : b"%u" % i}, "v%u" % i) for i in range(3)
+    ]
+    storage.close()
+    reopened = type(storage)(storage.backupDir)
+
+    progress, done = run(
+        lambda worker : load_history(reopened, worker, period = 0),
+        monkeypatch
+    )
+    storage.open()
+    assert done.error is None and not done.cancelled
+    commits = [c for e in progress for c in e.commits]
+    # the newest first, with the current one
+    assert [c.hexsha for c in commits] == [
+        s.hexsha for s in snapshots[::-1]
+    ]
+    assert progress[0].current == snapshots[-1].hexsha
+    assert commits[-1].parentShas == []
+
+
+def test_work_errors_and_cancelling(monkeypatch):
+    def fail(worker):
+        worker.progress(done = 1)
+        # at most once per period
+        worker.progress(done = 2)
+        raise ValueError("failed")
+
+    progress, done = run(fail, monkeypatch)
+    assert [e.done for e in progress] == [1]
+    assert isinstance(done.error, ValueError) and not done.cancelled
+
+    def wait(worker):
+        while True:
+            worker.check()
+
+    progress, done = run(wait, monkeypatch, cancel = True)
+    assert progress == [] and done.cancelled and done.result is None